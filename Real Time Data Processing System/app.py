@@ -1,19 +1,39 @@
-from flask import Flask, render_template, request, flash, redirect, url_for
+from flask import Flask, render_template, request, flash, redirect, url_for, send_file, abort
 from weather_service import WeatherService
+from graph_cache import GraphCache
 import os
-from config import CITIES
+from config import CITIES, GRAPH_DIRECTORY, GRAPH_WORKERS, SUMMARY_WINDOW
 
 app = Flask(__name__)
 app.secret_key = 'MyL(Q.()(=7%86-5509i'
 weather_service = WeatherService()
+graph_cache = GraphCache(GRAPH_DIRECTORY, GRAPH_WORKERS)
 
 @app.route("/")
 def index():
     city_name = request.args.get('city', 'Delhi')
     cities = weather_service.db.get_daily_summaries(city_name)
     alerts = weather_service.get_alerts(city_name)
-    forecast = weather_service.fetch_weather_forecast(city_name, CITIES[city_name])
-    return render_template("index.html", cities=CITIES.keys(), summaries=cities, alerts=alerts, forecasts=forecast)
+    # Served from the forecast cache; upstream latency only reaches a page for a city never fetched before
+    coords = weather_service.locations.get(city_name) or CITIES.get(city_name)
+    forecast = weather_service.get_forecast(city_name, coords) if coords else None
+    return render_template("index.html", cities=CITIES.keys(), summaries=cities, alerts=alerts, forecasts=forecast or [])
+
+@app.route("/graph/<city>.png")
+def graph(city):
+    try:
+        return send_graph(city)
+    except FileNotFoundError:
+        # A newer graph rendered between get() and send_file removed this one; serve the newest instead
+        return send_graph(city)
+
+def send_graph(city):
+    # Rendered on the first request after each new reading; otherwise served from the cache with its ETag
+    last_timestamp = weather_service.db.get_last_reading_timestamp(city)
+    if last_timestamp is None:
+        abort(404)
+    path = graph_cache.get(city, last_timestamp, lambda: weather_service.db.get_window_readings(city, SUMMARY_WINDOW))
+    return send_file(os.path.abspath(path), mimetype="image/png")
 
 @app.route("/start")
 def start():
@@ -28,7 +48,5 @@ def stop():
     return redirect(url_for('index'))
 
 if __name__ == "__main__":
-    if not os.path.exists('static/graphs'):
-        os.makedirs('static/graphs')
-    
+    weather_service.warm_forecasts(CITIES)
     app.run(debug=True)
@@ -0,0 +1,85 @@
+"""Write throughput of one update cycle's readings, alerts and summaries, per-row versus batched.
+
+    per-row   what WeatherDB did before: connect, insert, commit and close for every row
+    batched   the current write path: one WAL connection, one executemany per table, one transaction
+
+    python benchmark_database.py [--cities 1000 5000] [--cycles 3]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from database import WeatherDB
+
+def cycle_rows(cities, timestamp, rng):
+    readings, alerts, summaries = [], [], []
+    for i in range(cities):
+        city = f"City{i}"
+        temperature = rng.uniform(10, 40)
+        readings.append({"city": city, "temp": temperature, "feels_like": temperature - 1, "humidity": 50,
+                         "wind_speed": 5, "condition": "Clear", "timestamp": timestamp})
+        if temperature > 35:
+            alerts.append({"city": city, "alert_type": "temperature", "message": f"High temperature alert for {city}",
+                           "timestamp": timestamp})
+        summaries.append({"city": city, "date": time.strftime("%Y-%m-%d %H:%M:%S"), "avg_temp": temperature,
+                          "max_temp": temperature, "min_temp": temperature, "avg_humidity": 50, "avg_wind_speed": 5,
+                          "dominant_condition": "Clear", "summary_data": {"readings_count": 1}})
+    return readings, alerts, summaries
+
+def write_per_row(db_name, readings, alerts, summaries):
+    for sql, rows in ((
+        '''INSERT INTO weather_readings (city, temperature, feels_like, humidity, wind_speed, condition, timestamp)
+           VALUES (:city, :temp, :feels_like, :humidity, :wind_speed, :condition, :timestamp)''', readings), (
+        '''INSERT INTO alerts (city, alert_type, message, timestamp)
+           VALUES (:city, :alert_type, :message, :timestamp)''', alerts), (
+        '''INSERT INTO daily_summaries (city, date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition, summary_data)
+           VALUES (:city, :date, :avg_temp, :max_temp, :min_temp, :avg_humidity, :avg_wind_speed, :dominant_condition, '{}')''', summaries)):
+        for row in rows:
+            conn = sqlite3.connect(db_name)
+            conn.execute(sql, row)
+            conn.commit()
+            conn.close()
+
+def write_batched(db, readings, alerts, summaries):
+    with db.transaction():
+        db.save_weather_readings(readings)
+        db.save_alerts(alerts)
+        db.save_daily_summaries(summaries)
+
+def run(cities, cycles, seed=0):
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        per_row_path = os.path.join(directory, "per_row.db")
+        db = WeatherDB(per_row_path)
+        db.connection().execute("PRAGMA journal_mode=DELETE")  # The rollback journal the old code ran with
+        db.close()
+        batched = WeatherDB(os.path.join(directory, "batched.db"))
+
+        results = {}
+        for name, write in (("per-row", lambda rows: write_per_row(per_row_path, *rows)),
+                            ("batched", lambda rows: write_batched(batched, *rows))):
+            total_rows, elapsed = 0, 0.0
+            for cycle in range(cycles):
+                rows = cycle_rows(cities, cycle * 300, rng)
+                start = time.perf_counter()
+                write(rows)
+                elapsed += time.perf_counter() - start
+                total_rows += sum(map(len, rows))
+            results[name] = total_rows / elapsed
+        batched.close()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cities", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--cycles", type=int, default=3)
+    arguments = parser.parse_args(argv)
+    for cities in arguments.cities:
+        results = run(cities, arguments.cycles)
+        print(f"{cities:6} cities: per-row {results['per-row']:10.0f} rows/s   batched {results['batched']:10.0f} rows/s"
+              f"   ({results['batched'] / results['per-row']:.0f}x)")
+
+if __name__ == "__main__":
+    main()
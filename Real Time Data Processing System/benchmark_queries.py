@@ -0,0 +1,81 @@
+"""Query latency of WeatherDB lookups as the tables grow, with and without the secondary indexes.
+
+Each size fills weather_readings with that many rows spread over --cities cities at 5-minute
+intervals, plus an alert per 101 readings and a summary per 11, then times each lookup and the
+retention delete with the indexes and again after dropping them.
+
+    python benchmark_queries.py [--sizes 100000 1000000 3000000] [--cities 1000] [--repeat 20]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+from database import WeatherDB, MIGRATIONS
+
+def fill(db, size, cities, rng):
+    def readings():
+        for i in range(size):
+            yield f"City{i % cities}", rng.uniform(10, 40), (i // cities) * 300
+
+    with db.transaction() as c:
+        c.executemany("INSERT INTO weather_readings (city, temperature, feels_like, humidity, wind_speed, condition, timestamp) "
+                      "VALUES (?, ?, ?, 50, 5, 'Clear', ?)", ((city, t, t, timestamp) for city, t, timestamp in readings()))
+        c.execute("INSERT INTO alerts (city, alert_type, message, timestamp) "
+                  "SELECT city, 'temperature', 'High temperature', timestamp FROM weather_readings WHERE id % 101 = 0")
+        c.execute("INSERT INTO daily_summaries (city, date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition, summary_data) "
+                  "SELECT city, datetime(timestamp, 'unixepoch'), temperature, temperature, temperature, 50, 5, 'Clear', '{}' "
+                  "FROM weather_readings WHERE id % 11 = 0")
+        c.execute("ANALYZE")
+
+def latency_ms(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return sorted(samples)[len(samples) // 2] * 1000
+
+def measure(db, size, cities, repeat, rng):
+    city = lambda: f"City{rng.randrange(cities)}"
+    date = datetime.fromtimestamp(0).strftime("%Y-%m-%d %H:%M:%S")
+    # Deletes nothing, so every repetition does the same search
+    cutoff = datetime.fromtimestamp(-86400)
+    return {
+        "recent_readings": latency_ms(lambda: db.get_recent_readings(city(), 288), repeat),
+        "alerts": latency_ms(lambda: db.get_alerts(city()), repeat),
+        "summary_by_date": latency_ms(lambda: db.get_daily_summaries(city(), date), repeat),
+        "delete_old": latency_ms(lambda: db.delete_old_readings(cutoff), repeat),
+    }
+
+def run(sizes, cities, repeat, seed=0):
+    rng = random.Random(seed)
+    index_names = [statement.split()[5] for statement in MIGRATIONS[0] if statement.startswith("CREATE INDEX")]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            db = WeatherDB(os.path.join(directory, f"weather_{size}.db"))
+            fill(db, size, cities, rng)
+            indexed = measure(db, size, cities, repeat, rng)
+            with db.transaction() as c:
+                for name in index_names:
+                    c.execute(f"DROP INDEX {name}")
+            scanned = measure(db, size, cities, repeat, rng)
+            db.close()
+            results.append((size, indexed, scanned))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000, 3000000])
+    parser.add_argument("--cities", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=20)
+    arguments = parser.parse_args(argv)
+    print(f"{'rows':>9} {'query':16} {'indexed ms':>11} {'no index ms':>12}")
+    for size, indexed, scanned in run(arguments.sizes, arguments.cities, arguments.repeat):
+        for query in indexed:
+            print(f"{size:9} {query:16} {indexed[query]:11.3f} {scanned[query]:12.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 OPENWEATHER_API_KEY = os.getenv('API_KEY')
+OPENWEATHER_URL = os.getenv('OPENWEATHER_URL', 'https://api.openweathermap.org/data/2.5')
 CITIES = {
     "Delhi": {"lat": 28.6139, "lon": 77.2090},
     "Mumbai": {"lat": 19.0760, "lon": 72.8777},
@@ -14,6 +15,31 @@ CITIES = {
     "Hyderabad": {"lat": 17.3850, "lon": 78.4867}
 }
 
-UPDATE_INTERVAL = 300  # 5 minutes in seconds
+LOCATIONS_FILE = os.getenv('LOCATIONS_FILE')  # CSV or JSON of monitored locations; else the locations table, else CITIES
+
+UPDATE_INTERVAL = 300  # 5 minutes in seconds; the polling interval of locations that do not set their own
+POLL_JITTER = 0.1  # Each poll is scheduled up to this fraction of its interval early or late
+API_RATE_LIMIT = 1.0  # Weather API requests per second on average (the free plan allows 60 a minute)
+API_BURST = 10  # Requests that may be sent at once after a quiet period
 TEMPERATURE_THRESHOLD = 20  # Celsius
 CONSECUTIVE_ALERTS = 1  # Number of consecutive readings above threshold to trigger alert
+SUMMARY_WINDOW = 24 * 60 * 60  # Seconds of readings each summary covers, ending at the newest; may exceed a day
+RAW_RETENTION = 7 * 24 * 60 * 60  # Seconds raw readings are kept; must cover SUMMARY_WINDOW, older history is read from the rollups
+HOURLY_RETENTION = 90 * 24 * 60 * 60  # Seconds hourly rollups are kept
+DAILY_RETENTION = 10 * 365 * 24 * 60 * 60  # Seconds daily rollups are kept
+SUMMARY_RETENTION = 7 * 24 * 60 * 60  # Seconds rows of daily_summaries, one per city and poll, are kept
+RETENTION_INTERVAL = 10 * 60  # Seconds between passes deleting expired rows while the service runs
+RETENTION_CHUNK = 5000  # Rows deleted per transaction, so writes from polling wait for one chunk at most
+VACUUM_PAGES = 1000  # Free pages returned to the filesystem after each chunk
+HISTORY_POINTS = 500  # History queries read the finest tier that answers them in at most this many rows
+GRAPH_DIRECTORY = 'static/graphs'  # Rendered temperature graphs, one per city and newest reading
+GRAPH_WORKERS = 2  # Processes rendering graphs on request
+
+FORECAST_TTL = 60 * 60  # Seconds a forecast is served before it is refreshed in the background
+FORECAST_RETRY = 60  # Seconds between refresh attempts while upstream fails; the last forecast is served meanwhile
+FORECAST_COLD_WAIT = 2  # Seconds a page waits for a city's first forecast before rendering without it
+
+FETCH_CONCURRENCY = 64  # Requests in flight at once, and pooled connections kept alive
+FETCH_TIMEOUT = (3.05, 10)  # Connect and read timeouts in seconds, per attempt
+FETCH_RETRIES = 3  # Retries after connection errors, timeouts and 429/5xx responses
+FETCH_BACKOFF = 0.5  # Retry n waits FETCH_BACKOFF * 2 ** (n - 1) seconds, or what Retry-After asks
@@ -1,10 +1,47 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import Callable, Dict, Optional
+import time
 from database import WeatherDB
+from config import RAW_RETENTION, HOURLY_RETENTION, DAILY_RETENTION, SUMMARY_RETENTION, RETENTION_CHUNK, VACUUM_PAGES
+
+# Seconds each rollup tier is kept, by resolution
+ROLLUP_RETENTION: Dict[int, int] = {60 * 60: HOURLY_RETENTION, 24 * 60 * 60: DAILY_RETENTION}
+
+def purge_expired(db: WeatherDB, now: Optional[float] = None, chunk: int = RETENTION_CHUNK,
+                  running: Callable[[], bool] = lambda: True) -> int:
+    """Delete rows older than their tier's retention, `chunk` rows per transaction; returns how many.
+
+    Each chunk commits on its own, so the service's writes never wait behind one large delete, and
+    the pages it frees are vacuumed before the next. Stops between chunks once running() is false.
+    A database created before incremental vacuum is switched to it by one full VACUUM, on its first
+    purge rather than every time it is opened.
+    """
+    now = time.time() if now is None else now
+    deletes = [
+        lambda limit: db.delete_old_readings(datetime.fromtimestamp(now - RAW_RETENTION), limit),
+        lambda limit: db.delete_old_summaries(datetime.fromtimestamp(now - SUMMARY_RETENTION), limit),
+    ]
+    for resolution, seconds in ROLLUP_RETENTION.items():
+        deletes.append(lambda limit, resolution=resolution, seconds=seconds:
+                       db.delete_old_rollups(resolution, datetime.fromtimestamp(now - seconds), limit))
+    deleted = 0
+    for delete in deletes:
+        while running():
+            count = delete(chunk)
+            deleted += count
+            db.incremental_vacuum(VACUUM_PAGES)
+            if count < chunk:
+                break
+    # After the deletes, so the rewrite leaves out the pages they freed
+    if running():
+        db.enable_incremental_vacuum()
+    return deleted
 
 def clean_old_data():
+    # The service purges as it runs; this is for databases it is not running against
     db = WeatherDB()
-    cutoff_date = datetime.now() - timedelta(days=7)  # Keep data for the last 7 days
-    db.delete_old_readings(cutoff_date)
+    purge_expired(db)
+    db.close()
 
 if __name__ == "__main__":
     clean_old_data()
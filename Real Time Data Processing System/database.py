@@ -1,108 +1,272 @@
 import sqlite3
 from datetime import datetime
 import json
-from typing import Dict
+from typing import Dict, List
+import threading
+from contextlib import contextmanager
 import time
 
+# Widths in seconds of the rollup tiers the readings are summed into as they arrive, finest first
+ROLLUP_RESOLUTIONS = (60 * 60, 24 * 60 * 60)
+
+ROLLUP_COLUMNS = "resolution, city, bucket, condition, readings_count, temp_sum, temp_min, temp_max, humidity_sum, wind_speed_sum"
+
+# Schema changes applied to existing databases in order; PRAGMA user_version records how many have run
+MIGRATIONS = [
+    # 1: indexes for the per-city lookups and the retention delete, which otherwise scan whole tables
+    [
+        "CREATE INDEX IF NOT EXISTS idx_weather_readings_city_timestamp ON weather_readings (city, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_weather_readings_timestamp ON weather_readings (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_alerts_city_timestamp ON alerts (city, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_daily_summaries_city_date ON daily_summaries (city, date)",
+        "ANALYZE",
+    ],
+    # 2: monitored locations, for deployments polling more places than config.CITIES
+    [
+        "CREATE TABLE IF NOT EXISTS locations (name TEXT PRIMARY KEY, lat REAL, lon REAL, interval REAL)",
+    ],
+    # 3: rollups, one row per tier, city, bucket and condition, backfilled from the stored readings;
+    #    and the indexes the chunked retention deletes search
+    [
+        '''CREATE TABLE IF NOT EXISTS rollups (resolution INTEGER, city TEXT, bucket INTEGER, condition TEXT,
+           readings_count INTEGER, temp_sum REAL, temp_min REAL, temp_max REAL, humidity_sum REAL, wind_speed_sum REAL)''',
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_rollups_key ON rollups (resolution, city, bucket, condition)",
+        "CREATE INDEX IF NOT EXISTS idx_rollups_resolution_bucket ON rollups (resolution, bucket)",
+        "CREATE INDEX IF NOT EXISTS idx_daily_summaries_date ON daily_summaries (date)",
+        *[f'''INSERT INTO rollups ({ROLLUP_COLUMNS})
+              SELECT {resolution}, city, timestamp - timestamp % {resolution}, condition, COUNT(*), SUM(temperature),
+                     MIN(temperature), MAX(temperature), SUM(humidity), SUM(wind_speed)
+              FROM weather_readings GROUP BY city, timestamp - timestamp % {resolution}, condition'''
+          for resolution in ROLLUP_RESOLUTIONS],
+        "ANALYZE",
+    ],
+]
+
 class WeatherDB:
     def __init__(self, db_name="weather_data.db"):
         self.db_name = db_name
+        self._local = threading.local()
         self.init_db()
 
-    def init_db(self):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS weather_readings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            city TEXT,
-            temperature REAL,
-            feels_like REAL,
-            humidity REAL,
-            wind_speed REAL,
-            condition TEXT,
-            timestamp INTEGER
-        )''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS daily_summaries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            city TEXT,
-            date TEXT,
-            avg_temp REAL,
-            max_temp REAL,
-            min_temp REAL,
-            avg_humidity REAL,
-            avg_wind_speed REAL,
-            dominant_condition TEXT,
-            summary_data TEXT
-        )''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            city TEXT,
-            alert_type TEXT,
-            message TEXT,
-            timestamp INTEGER
-        )''')
-        
+    def connection(self) -> sqlite3.Connection:
+        # One long-lived connection per thread; in WAL mode readers never wait for the writer
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, isolation_level=None, timeout=30)
+            # Takes effect only in a database without tables yet, so it must precede the switch to WAL
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed writes as one transaction; nested blocks join the outer one."""
+        conn = self.connection()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
         conn.commit()
-        conn.close()
 
-    def delete_old_readings(self, cutoff_date: datetime):
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def init_db(self):
+        with self.transaction() as c:
+            c.execute('''CREATE TABLE IF NOT EXISTS weather_readings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                city TEXT,
+                temperature REAL,
+                feels_like REAL,
+                humidity REAL,
+                wind_speed REAL,
+                condition TEXT,
+                timestamp INTEGER
+            )''')
+            
+            c.execute('''CREATE TABLE IF NOT EXISTS daily_summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                city TEXT,
+                date TEXT,
+                avg_temp REAL,
+                max_temp REAL,
+                min_temp REAL,
+                avg_humidity REAL,
+                avg_wind_speed REAL,
+                dominant_condition TEXT,
+                summary_data TEXT
+            )''')
+            
+            c.execute('''CREATE TABLE IF NOT EXISTS alerts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                city TEXT,
+                alert_type TEXT,
+                message TEXT,
+                timestamp INTEGER
+            )''')
+        self.migrate()
+
+    def migrate(self):
+        with self.transaction() as c:
+            current = c.execute("PRAGMA user_version").fetchone()[0]
+            for version, statements in enumerate(MIGRATIONS[current:], start=current + 1):
+                for statement in statements:
+                    c.execute(statement)
+                c.execute(f"PRAGMA user_version = {version}")
+
+    # The retention deletes remove at most `limit` rows (all when negative) and return how many they removed
+
+    def delete_old_readings(self, cutoff_date: datetime, limit: int = -1) -> int:
         cutoff_timestamp = int(cutoff_date.timestamp())
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("DELETE FROM weather_readings WHERE timestamp < ?", (cutoff_timestamp,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as c:
+            return c.execute("DELETE FROM weather_readings WHERE id IN (SELECT id FROM weather_readings WHERE timestamp < ? LIMIT ?)",
+                             (cutoff_timestamp, limit)).rowcount
+
+    def delete_old_rollups(self, resolution: int, cutoff_date: datetime, limit: int = -1) -> int:
+        cutoff_timestamp = int(cutoff_date.timestamp())
+        with self.transaction() as c:
+            return c.execute("DELETE FROM rollups WHERE rowid IN (SELECT rowid FROM rollups WHERE resolution = ? AND bucket < ? LIMIT ?)",
+                             (resolution, cutoff_timestamp, limit)).rowcount
+
+    def delete_old_summaries(self, cutoff_date: datetime, limit: int = -1) -> int:
+        cutoff = cutoff_date.strftime("%Y-%m-%d %H:%M:%S")
+        with self.transaction() as c:
+            return c.execute("DELETE FROM daily_summaries WHERE id IN (SELECT id FROM daily_summaries WHERE date < ? LIMIT ?)",
+                             (cutoff, limit)).rowcount
+
+    def enable_incremental_vacuum(self) -> bool:
+        """Switch a database created before incremental vacuum to it; True when that took a full VACUUM."""
+        conn = self.connection()
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        # The mode of a database with tables only changes on a VACUUM, which rewrites the whole file
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def incremental_vacuum(self, pages: int = 0):
+        """Return up to `pages` free pages to the filesystem, all of them when 0; commits an open transaction."""
+        # execute() steps the pragma once, freeing a single page; executescript runs it to completion
+        self.connection().executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+
+    # The batch writers take dicts with the keyword arguments of the single-row methods, plus a timestamp
+    # for readings and alerts, and insert them with one executemany
+
+    def save_weather_readings(self, readings: List[Dict]):
+        """Insert the readings and add them to the bucket of each rollup tier they fall in."""
+        with self.transaction() as c:
+            c.executemany('''INSERT INTO weather_readings (city, temperature, feels_like, humidity, wind_speed, condition, timestamp)
+                             VALUES (:city, :temp, :feels_like, :humidity, :wind_speed, :condition, :timestamp)''', readings)
+            for resolution in ROLLUP_RESOLUTIONS:
+                c.executemany(f'''INSERT INTO rollups ({ROLLUP_COLUMNS})
+                                  VALUES ({resolution}, :city, :timestamp - :timestamp % {resolution}, :condition, 1, :temp, :temp, :temp, :humidity, :wind_speed)
+                                  ON CONFLICT (resolution, city, bucket, condition) DO UPDATE SET
+                                  readings_count = readings_count + 1, temp_sum = temp_sum + excluded.temp_sum,
+                                  temp_min = MIN(temp_min, excluded.temp_min), temp_max = MAX(temp_max, excluded.temp_max),
+                                  humidity_sum = humidity_sum + excluded.humidity_sum, wind_speed_sum = wind_speed_sum + excluded.wind_speed_sum''', readings)
+
+    def save_daily_summaries(self, summaries: List[Dict]):
+        with self.transaction() as c:
+            c.executemany('''INSERT INTO daily_summaries (city, date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition, summary_data)
+                             VALUES (:city, :date, :avg_temp, :max_temp, :min_temp, :avg_humidity, :avg_wind_speed, :dominant_condition, :summary_data)''',
+                          [{**summary, "summary_data": json.dumps(summary["summary_data"])} for summary in summaries])
+
+    def save_alerts(self, alerts: List[Dict]):
+        with self.transaction() as c:
+            c.executemany('''INSERT INTO alerts (city, alert_type, message, timestamp)
+                             VALUES (:city, :alert_type, :message, :timestamp)''', alerts)
 
     def save_weather_reading(self, city: str, temp: float, feels_like: float, humidity: float, wind_speed: float, condition: str):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute('''INSERT INTO weather_readings (city, temperature, feels_like, humidity, wind_speed, condition, timestamp)
-                     VALUES (?, ?, ?, ?, ?, ?, ?)''', (city, temp, feels_like, humidity, wind_speed, condition, int(time.time())))
-        conn.commit()
-        conn.close()
+        self.save_weather_readings([{"city": city, "temp": temp, "feels_like": feels_like, "humidity": humidity,
+                                     "wind_speed": wind_speed, "condition": condition, "timestamp": int(time.time())}])
 
     def save_daily_summary(self, city: str, date: str, avg_temp: float, max_temp: float, min_temp: float, avg_humidity: float, avg_wind_speed: float, dominant_condition: str, summary_data: Dict):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute('''INSERT INTO daily_summaries (city, date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition, summary_data)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', (city, date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition, json.dumps(summary_data)))
-        conn.commit()
-        conn.close()
+        self.save_daily_summaries([{"city": city, "date": date, "avg_temp": avg_temp, "max_temp": max_temp, "min_temp": min_temp,
+                                    "avg_humidity": avg_humidity, "avg_wind_speed": avg_wind_speed,
+                                    "dominant_condition": dominant_condition, "summary_data": summary_data}])
 
     def save_alert(self, city: str, alert_type: str, message: str):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute('''INSERT INTO alerts (city, alert_type, message, timestamp)
-                     VALUES (?, ?, ?, ?)''', (city, alert_type, message, int(time.time())))
-        conn.commit()
-        conn.close()
+        self.save_alerts([{"city": city, "alert_type": alert_type, "message": message, "timestamp": int(time.time())}])
+
+    def save_locations(self, locations: Dict[str, Dict]):
+        with self.transaction() as c:
+            c.executemany("INSERT OR REPLACE INTO locations (name, lat, lon, interval) VALUES (?, ?, ?, ?)",
+                          [(name, location["lat"], location["lon"], location.get("interval")) for name, location in locations.items()])
+
+    def get_locations(self) -> Dict[str, Dict]:
+        locations = {}
+        for name, lat, lon, interval in self.connection().execute("SELECT name, lat, lon, interval FROM locations"):
+            locations[name] = {"lat": lat, "lon": lon}
+            if interval:
+                locations[name]["interval"] = interval
+        return locations
 
     def get_alerts(self, city: str):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT city, alert_type, message, timestamp FROM alerts WHERE city = ?", (city,))
-        alerts = [{"city": row[0], "alert_type": row[1], "message": row[2], "timestamp": datetime.fromtimestamp(row[3]).strftime('%Y-%m-%d %H:%M')} for row in c.fetchall()]
-        conn.close()
-        return alerts
+        c = self.connection().execute("SELECT city, alert_type, message, timestamp FROM alerts WHERE city = ?", (city,))
+        return [{"city": row[0], "alert_type": row[1], "message": row[2], "timestamp": datetime.fromtimestamp(row[3]).strftime('%Y-%m-%d %H:%M')} for row in c.fetchall()]
 
     def get_recent_readings(self, city: str, limit: int):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
-        c.execute("SELECT temperature, humidity, wind_speed, condition, timestamp FROM weather_readings WHERE city = ? ORDER BY timestamp DESC LIMIT ?", (city, limit))
-        readings = [{"temperature": row[0], "humidity": row[1], "wind_speed": row[2], "condition": row[3], "timestamp": row[4]} for row in c.fetchall()]
-        conn.close()
-        return readings
+        c = self.connection().execute("SELECT temperature, humidity, wind_speed, condition, timestamp FROM weather_readings WHERE city = ? ORDER BY timestamp DESC LIMIT ?", (city, limit))
+        return [{"temperature": row[0], "humidity": row[1], "wind_speed": row[2], "condition": row[3], "timestamp": row[4]} for row in c.fetchall()]
+
+    def get_last_reading_timestamp(self, city: str):
+        return self.connection().execute("SELECT MAX(timestamp) FROM weather_readings WHERE city = ?", (city,)).fetchone()[0]
+
+    def get_window_readings(self, city: str, seconds: int):
+        """Readings of the last `seconds` before the city's newest reading, oldest first."""
+        c = self.connection().execute('''SELECT temperature, humidity, wind_speed, condition, timestamp FROM weather_readings
+                                         WHERE city = ? AND timestamp > (SELECT MAX(timestamp) FROM weather_readings WHERE city = ?) - ?
+                                         ORDER BY timestamp''', (city, city, seconds))
+        return [{"temperature": row[0], "humidity": row[1], "wind_speed": row[2], "condition": row[3], "timestamp": row[4]} for row in c.fetchall()]
+
+    def get_readings(self, city: str, start: int, end: int):
+        """Raw readings with start <= timestamp < end, oldest first."""
+        c = self.connection().execute('''SELECT temperature, humidity, wind_speed, condition, timestamp
+                                         FROM weather_readings WHERE city = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp''', (city, start, end))
+        return [{"temperature": row[0], "humidity": row[1], "wind_speed": row[2], "condition": row[3], "timestamp": row[4]} for row in c.fetchall()]
+
+    def get_rollups(self, city: str, resolution: int, start: int, end: int):
+        """Readings from start to end aggregated per `resolution` seconds, oldest first.
+
+        Each bucket has the fields of a raw reading, with averages and the dominant condition, plus
+        min_temp, max_temp and readings_count; its timestamp is the start of the bucket.
+        """
+        c = self.connection().execute('''SELECT bucket, condition, readings_count, temp_sum, temp_min, temp_max, humidity_sum, wind_speed_sum
+                                         FROM rollups WHERE resolution = ? AND city = ? AND bucket >= ? AND bucket < ?
+                                         ORDER BY bucket''', (resolution, city, start - start % resolution, end))
+        buckets = {}
+        for bucket, condition, count, temp_sum, temp_min, temp_max, humidity_sum, wind_speed_sum in c.fetchall():
+            row = buckets.get(bucket)
+            if row is None:
+                row = buckets[bucket] = {"timestamp": bucket, "readings_count": 0, "temp_sum": 0.0, "min_temp": temp_min,
+                                         "max_temp": temp_max, "humidity_sum": 0.0, "wind_speed_sum": 0.0, "conditions": {}}
+            row["readings_count"] += count
+            row["temp_sum"] += temp_sum
+            row["min_temp"] = min(row["min_temp"], temp_min)
+            row["max_temp"] = max(row["max_temp"], temp_max)
+            row["humidity_sum"] += humidity_sum or 0
+            row["wind_speed_sum"] += wind_speed_sum or 0
+            row["conditions"][condition] = count
+        return [{"temperature": row["temp_sum"] / row["readings_count"], "humidity": row["humidity_sum"] / row["readings_count"],
+                 "wind_speed": row["wind_speed_sum"] / row["readings_count"],
+                 "condition": max(row["conditions"], key=row["conditions"].get), "timestamp": row["timestamp"],
+                 "min_temp": row["min_temp"], "max_temp": row["max_temp"], "readings_count": row["readings_count"]}
+                for row in buckets.values()]
 
     def get_daily_summaries(self, city: str, date=None):
-        conn = sqlite3.connect(self.db_name)
-        c = conn.cursor()
+        c = self.connection()
         if date is None:
-            c.execute("SELECT date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition FROM daily_summaries WHERE city = ?", (city,))
+            c = c.execute("SELECT date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition FROM daily_summaries WHERE city = ?", (city,))
         else:
-            c.execute("SELECT date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition FROM daily_summaries WHERE city = ? AND date = ?", (city, date))
-        summaries = [{"city": city, "date": row[0], "avg_temp": row[1], "max_temp": row[2], "min_temp": row[3], "avg_humidity": row[4], "avg_wind_speed": row[5], "dominant_condition": row[6]} for row in c.fetchall()]
-        conn.close()
-        return summaries
+            c = c.execute("SELECT date, avg_temp, max_temp, min_temp, avg_humidity, avg_wind_speed, dominant_condition FROM daily_summaries WHERE city = ? AND date = ?", (city, date))
+        return [{"city": city, "date": row[0], "avg_temp": row[1], "max_temp": row[2], "min_temp": row[3], "avg_humidity": row[4], "avg_wind_speed": row[5], "dominant_condition": row[6]} for row in c.fetchall()]
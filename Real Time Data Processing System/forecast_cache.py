@@ -0,0 +1,78 @@
+import threading
+import time
+from concurrent.futures import Executor, TimeoutError
+from typing import Callable, Dict, List, Optional
+
+class ForecastCache:
+    """Forecast per city, served from memory and refreshed in the background once older than ttl.
+
+    A stale forecast is returned at once while one refresh per city runs on the executor; requests
+    arriving meanwhile share that refresh. When upstream fails the last known forecast is kept and
+    the next attempt waits retry_interval. Only a city never fetched before waits for upstream, and
+    at most cold_wait seconds.
+    """
+
+    def __init__(self, fetch: Callable[[str, Dict[str, float]], Optional[List[Dict]]], executor: Executor,
+                 ttl: float, retry_interval: float, cold_wait: float, clock=time.monotonic):
+        self.fetch = fetch
+        self.executor = executor
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.cold_wait = cold_wait
+        self.clock = clock
+        self._entries = {}  # city -> (forecast, expires)
+        self._retry_at = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get(self, city: str, coords: Dict[str, float]) -> Optional[List[Dict]]:
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(city)
+            if entry is not None and now < entry[1]:
+                self.hits += 1
+                return entry[0]
+            future = self._refresh(city, coords, now)
+            if entry is not None:
+                self.stale_hits += 1
+                return entry[0]
+            self.misses += 1
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=self.cold_wait)
+        except TimeoutError:
+            return None
+
+    def refresh(self, city: str, coords: Dict[str, float]):
+        """Start a background refresh unless one is running or upstream failed within retry_interval."""
+        with self._lock:
+            return self._refresh(city, coords, self.clock())
+
+    def _refresh(self, city, coords, now):
+        future = self._refreshing.get(city)
+        if future is None and now >= self._retry_at.get(city, 0):
+            self.refreshes += 1
+            future = self._refreshing[city] = self.executor.submit(self._run, city, coords)
+        return future
+
+    def _run(self, city, coords):
+        try:
+            forecast = self.fetch(city, coords)
+        except Exception:
+            forecast = None
+        with self._lock:
+            del self._refreshing[city]
+            if forecast is not None:
+                self._entries[city] = (forecast, self.clock() + self.ttl)
+                self._retry_at.pop(city, None)
+                return forecast
+            self.failures += 1
+            self._retry_at[city] = self.clock() + self.retry_interval
+            entry = self._entries.get(city)
+            return entry[0] if entry is not None else None
@@ -0,0 +1,91 @@
+import glob
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List
+
+def render_temperature_graph(city: str, readings: List[Dict], path: str):
+    """Draw the temperature trend to path. Runs in a worker process, which imports matplotlib on its first graph."""
+    from matplotlib.figure import Figure
+
+    dates = [datetime.fromtimestamp(reading['timestamp']).strftime('%Y-%m-%d %H:%M') for reading in readings]
+    temps = [reading['temperature'] for reading in readings]
+
+    figure = Figure(figsize=(10, 5))
+    axes = figure.subplots()
+    axes.plot(dates, temps, marker='o', label='Temperature (°C)', color='b')
+    axes.set_title(f'Temperature Trend for {city}')
+    axes.set_xlabel('Time')
+    axes.set_ylabel('Temperature (°C)')
+    axes.tick_params(axis='x', labelrotation=45)
+    axes.grid()
+    axes.legend()
+    figure.tight_layout()
+    figure.savefig(f"{path}.tmp", format="png")
+    os.replace(f"{path}.tmp", path)
+
+class GraphCache:
+    """Temperature graphs rendered on request and kept on disk by (city, newest reading timestamp).
+
+    A graph is drawn at most once per new reading, in a process pool so rendering neither holds
+    the GIL of the web server nor runs on the ingest thread; concurrent requests for the same
+    graph wait on one render. Older graphs of a city are deleted once a newer one is written.
+    """
+
+    def __init__(self, directory: str, workers: int = 2):
+        self.directory = directory
+        self.workers = workers
+        os.makedirs(directory, exist_ok=True)
+        self._pool = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.renders = 0
+
+    def _city_prefix(self, city: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(city.encode("utf-8")).hexdigest()[:16])
+
+    def path(self, city: str, last_timestamp: int) -> str:
+        return f"{self._city_prefix(city)}_{last_timestamp}.png"
+
+    def get(self, city: str, last_timestamp: int, load_readings: Callable[[], List[Dict]]) -> str:
+        """Return the path of the graph for city as of last_timestamp, rendering it from load_readings() if needed."""
+        path = self.path(city, last_timestamp)
+        if os.path.exists(path):
+            self.hits += 1
+            return path
+        readings = load_readings()
+        with self._lock:
+            future = self._pending.get(path)
+            if future is None:
+                if self._pool is None:
+                    # spawn, since forking the threaded web server could copy held locks into the worker
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                future = self._pool.submit(render_temperature_graph, city, readings, path)
+                self._pending[path] = future
+                self.renders += 1
+        try:
+            future.result()
+        finally:
+            with self._lock:
+                self._pending.pop(path, None)
+        self._remove_older(city, last_timestamp)
+        return path
+
+    def _remove_older(self, city: str, last_timestamp: int):
+        prefix = self._city_prefix(city)
+        for old in glob.glob(glob.escape(prefix) + "_*.png"):
+            timestamp = old[len(prefix) + 1:-len(".png")]
+            if timestamp.isdigit() and int(timestamp) < last_timestamp:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass  # Already removed by another request
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -0,0 +1,94 @@
+import math
+from collections import deque
+from typing import Dict, List, Optional
+
+class RollingWindow:
+    """Summary aggregates of one city's readings over the last `seconds`, updated in O(1) per reading.
+
+    The window ends at the newest reading, so a restart or a gap in polling does not empty it.
+    Averages come from running sums, the extremes from monotonic deques of (sequence, temperature)
+    and the dominant condition from counts that are decremented as readings expire.
+    """
+
+    def __init__(self, seconds: int):
+        self.seconds = seconds
+        self.readings = deque()  # (timestamp, temperature, humidity, wind_speed, condition)
+        self.first = 0  # sequence number of readings[0]
+        self.newest = None
+        self.max_temps = deque()  # decreasing temperatures, as (sequence, temperature)
+        self.min_temps = deque()  # increasing temperatures
+        self.condition_counts = {}
+        self.temperature_sum = 0.0
+        self.humidity_sum = 0.0
+        self.wind_speed_sum = 0.0
+        self._evicted = 0
+
+    @classmethod
+    def from_readings(cls, seconds: int, readings: List[Dict]):
+        """Rebuild a window from stored readings in timestamp order, e.g. WeatherDB.get_window_readings."""
+        window = cls(seconds)
+        for reading in readings:
+            window.add(reading["timestamp"], reading["temperature"], reading["humidity"],
+                       reading["wind_speed"], reading["condition"])
+        return window
+
+    def __len__(self):
+        return len(self.readings)
+
+    def add(self, timestamp: int, temperature: float, humidity: float, wind_speed: float, condition: str):
+        sequence = self.first + len(self.readings)
+        self.readings.append((timestamp, temperature, humidity, wind_speed, condition))
+        self.temperature_sum += temperature
+        self.humidity_sum += humidity
+        self.wind_speed_sum += wind_speed
+        self.condition_counts[condition] = self.condition_counts.get(condition, 0) + 1
+        while self.max_temps and self.max_temps[-1][1] <= temperature:
+            self.max_temps.pop()
+        self.max_temps.append((sequence, temperature))
+        while self.min_temps and self.min_temps[-1][1] >= temperature:
+            self.min_temps.pop()
+        self.min_temps.append((sequence, temperature))
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+        self._expire(self.newest - self.seconds)
+
+    def _expire(self, cutoff: int):
+        readings = self.readings
+        while readings and readings[0][0] <= cutoff:
+            _, temperature, humidity, wind_speed, condition = readings.popleft()
+            self.temperature_sum -= temperature
+            self.humidity_sum -= humidity
+            self.wind_speed_sum -= wind_speed
+            count = self.condition_counts[condition] - 1
+            if count:
+                self.condition_counts[condition] = count
+            else:
+                del self.condition_counts[condition]
+            self.first += 1
+            self._evicted += 1
+        while self.max_temps and self.max_temps[0][0] < self.first:
+            self.max_temps.popleft()
+        while self.min_temps and self.min_temps[0][0] < self.first:
+            self.min_temps.popleft()
+        # Subtracting expired values accumulates rounding error; re-summing once per window length
+        # of expiries bounds it and stays O(1) amortized
+        if self._evicted >= max(len(readings), 1):
+            self.temperature_sum = math.fsum(reading[1] for reading in readings)
+            self.humidity_sum = math.fsum(reading[2] for reading in readings)
+            self.wind_speed_sum = math.fsum(reading[3] for reading in readings)
+            self._evicted = 0
+
+    def summary(self) -> Optional[Dict]:
+        count = len(self.readings)
+        if not count:
+            return None
+        return {
+            "avg_temp": self.temperature_sum / count,
+            "max_temp": self.max_temps[0][1],
+            "min_temp": self.min_temps[0][1],
+            "avg_humidity": self.humidity_sum / count,
+            "avg_wind_speed": self.wind_speed_sum / count,
+            "dominant_condition": max(self.condition_counts, key=self.condition_counts.get),
+            "readings_count": count,
+            "condition_distribution": dict(self.condition_counts),
+        }
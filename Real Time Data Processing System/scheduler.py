@@ -0,0 +1,130 @@
+import csv
+import heapq
+import json
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _fill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> bool:
+        with self._lock:
+            self._fill(self.clock())
+            # Sleeping wait_time() can leave a rounding error short of a whole token
+            if self.tokens >= 1 - 1e-9:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available."""
+        with self._lock:
+            self._fill(self.clock())
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+class PollScheduler:
+    """Polls each location once per its own interval, in order of next due time, within an API quota.
+
+    Locations sit in a heap keyed by next due time. Each location polls on its own grid, a random
+    phase within its first interval plus whole intervals, so every location is polled within one
+    interval of starting, load is spread evenly and delays do not accumulate. Later polls are moved
+    up to `jitter` of the interval off their grid point so locations sharing an interval do not
+    fall into step. A location that falls more than a whole interval behind counts as a missed
+    deadline and its grid restarts from now.
+    """
+
+    def __init__(self, locations: Dict[str, Dict], bucket: TokenBucket, default_interval: float,
+                 jitter: float = 0.1, clock=time.monotonic, rng: Optional[random.Random] = None):
+        self.locations = locations
+        self.bucket = bucket
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.clock = clock
+        self.rng = rng or random.Random()
+        now = clock()
+        # (due, grid point, name); due is the grid point moved by jitter
+        self.heap = []
+        for name in locations:
+            slot = now + self.interval(name) * self.rng.random()
+            self.heap.append((slot, slot, name))
+        heapq.heapify(self.heap)
+        self.dispatched = 0
+        self.missed = 0
+        self.max_lateness = 0.0
+
+    def interval(self, name: str) -> float:
+        return self.locations[name].get("interval") or self.default_interval
+
+    def _next(self, name, slot, now):
+        interval = self.interval(name)
+        if slot + interval * (1 + self.jitter) < now:
+            self.missed += 1
+            slot = now
+        return self._jittered(slot + interval, interval, name)
+
+    def _jittered(self, slot, interval, name):
+        return slot + interval * self.rng.uniform(-self.jitter, self.jitter), slot, name
+
+    def next_batch(self, limit: int) -> Dict[str, Dict]:
+        """Take up to `limit` due locations, one token each; empty when none is due or the quota is spent."""
+        now = self.clock()
+        batch = {}
+        while self.heap and self.heap[0][0] <= now and len(batch) < limit and self.bucket.take():
+            due, slot, name = self.heap[0]
+            heapq.heapreplace(self.heap, self._next(name, slot, now))
+            self.max_lateness = max(self.max_lateness, now - due)
+            batch[name] = self.locations[name]
+        self.dispatched += len(batch)
+        return batch
+
+    def wait_time(self) -> float:
+        """Seconds until next_batch can return a location."""
+        if not self.heap:
+            return float("inf")
+        return max(self.heap[0][0] - self.clock(), self.bucket.wait_time())
+
+    def run(self, dispatch: Callable[[Dict[str, Dict]], None], running: Callable[[], bool],
+            sleep: Callable[[float], None] = time.sleep, limit: int = 64, max_sleep: float = 1.0):
+        """Hand due batches to dispatch until running() is false, sleeping in between."""
+        while running():
+            batch = self.next_batch(limit)
+            if batch:
+                dispatch(batch)
+            else:
+                # Wakes at least every max_sleep so a stop request is noticed
+                sleep(min(self.wait_time(), max_sleep))
+
+def load_locations(path: str) -> Dict[str, Dict]:
+    """Read locations from a CSV file with name, lat, lon and optional interval columns, or from JSON.
+
+    JSON may be an object of name -> {"lat", "lon", "interval"} like config.CITIES, or a list of
+    objects with a "name" field.
+    """
+    if path.endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as file:
+            rows = list(csv.DictReader(file))
+    else:
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        rows = [{"name": name, **coords} for name, coords in data.items()] if isinstance(data, dict) else data
+    locations = {}
+    for row in rows:
+        location = {"lat": float(row["lat"]), "lon": float(row["lon"])}
+        if row.get("interval"):
+            location["interval"] = float(row["interval"])
+        locations[row["name"]] = location
+    return locations
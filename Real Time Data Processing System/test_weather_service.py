@@ -1,7 +1,23 @@
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 import pytest
 from unittest.mock import patch, MagicMock
-from weather_service import WeatherService
-from database import WeatherDB
+from weather_service import WeatherService, create_session
+from database import WeatherDB, MIGRATIONS, ROLLUP_RESOLUTIONS
+from data_cleanup import purge_expired
+from rolling_window import RollingWindow
+from forecast_cache import ForecastCache
+from scheduler import PollScheduler, TokenBucket, load_locations
+from concurrent.futures import ThreadPoolExecutor
 from config import CITIES
 
 # Test cases for WeatherService
@@ -17,7 +33,7 @@ def test_api_connection(weather_service):
     assert weather_service is not None
     assert weather_service.db is not None
 
-@patch('weather_service.requests.get')
+@patch('weather_service.requests.Session.get')
 def test_fetch_weather_data(mock_get, weather_service):
     """Test fetching weather data from the API."""
     mock_response = MagicMock()
@@ -49,11 +65,11 @@ def test_temperature_conversion(weather_service):
     assert celsius_temp == pytest.approx(26.85, rel=1e-2)
 
 @patch.object(WeatherDB, 'save_weather_reading')
-@patch.object(WeatherDB, 'get_recent_readings')
+@patch.object(WeatherDB, 'get_window_readings')
 @patch.object(WeatherDB, 'save_daily_summary')
-def test_daily_summary_calculation(mock_save_daily_summary, mock_get_recent_readings, mock_save_weather_reading, weather_service):
+def test_daily_summary_calculation(mock_save_daily_summary, mock_get_window_readings, mock_save_weather_reading, weather_service):
     """Test calculation of daily summaries."""
-    mock_get_recent_readings.return_value = [
+    mock_get_window_readings.return_value = [
         {"temperature": 30 + i, "humidity": 50, "wind_speed": 5, "condition": "Clear", "timestamp": 1609459200 + i * 300}
         for i in range(5)
     ]
@@ -85,3 +101,604 @@ def test_consecutive_alerts(weather_service):
 
     weather_service.check_temperature_threshold("Delhi", 34)  # Below threshold reset
     assert weather_service.consecutive_alerts["Delhi"] == 0  # Should reset to 0
+
+class FakeOpenWeather(BaseHTTPRequestHandler):
+    """Serves /weather like OpenWeather, with per-city delays and failures set on the server."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        query = parse_qs(urlparse(self.path).query)
+        city = query["lat"][0]
+        with server.lock:
+            server.requests += 1
+            server.clients.add(self.client_address)
+            attempt = server.attempts[city] = server.attempts.get(city, 0) + 1
+        time.sleep(server.delays.get(city, server.delay))
+        if attempt <= server.failures.get(city, 0):
+            status, body = 503, b"{}"
+        else:
+            status = 200
+            body = json.dumps({
+                "main": {"temp": 300, "feels_like": 298, "humidity": 50},
+                "weather": [{"main": "Clear"}],
+                "wind": {"speed": 5},
+                "dt": 1609459200
+            }).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # The client timed out and went away
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def fake_openweather():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenWeather)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.clients = set()
+    server.attempts = {}
+    server.delay = 0.0
+    server.delays = {}
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def fake_cities(count):
+    # The fake server identifies a city by its latitude
+    return {f"City{i}": {"lat": i, "lon": 0} for i in range(count)}
+
+def test_fetch_all_concurrent(fake_openweather):
+    """A cycle over hundreds of cities takes a few fetch latencies, over pooled keep-alive connections."""
+    fake_openweather.delay = 0.2
+    service = WeatherService(concurrency=128)
+    service.base_url = fake_openweather.url
+    cities = fake_cities(256)
+
+    start = time.perf_counter()
+    results = service.fetch_all_weather_data(cities)
+    elapsed = time.perf_counter() - start
+
+    assert len(results) == 256
+    assert all(data is not None and data["condition"] == "Clear" for data in results.values())
+    assert elapsed < 256 * 0.2 / 10  # Sequential fetching takes 51 seconds
+    assert len(fake_openweather.clients) <= 128
+
+def test_fetch_retries_with_backoff(fake_openweather):
+    """Transient 503s are retried; a city that keeps failing gives None without affecting the others."""
+    service = WeatherService(concurrency=8)
+    service.base_url = fake_openweather.url
+    service.session = create_session(8, retries=3, backoff=0.01)
+    fake_openweather.failures = {"1": 2, "2": 10}
+
+    results = service.fetch_all_weather_data(fake_cities(4))
+
+    assert results["City0"] is not None
+    assert results["City1"] is not None
+    assert results["City2"] is None
+    assert fake_openweather.attempts == {"0": 1, "1": 3, "2": 4, "3": 1}
+
+def test_fetch_timeout_bounds_cycle(fake_openweather):
+    """A hung request is abandoned after its timeout instead of stalling the cycle."""
+    service = WeatherService(concurrency=8)
+    service.base_url = fake_openweather.url
+    service.session = create_session(8, retries=1, backoff=0)
+    service.timeout = (1, 0.2)
+    fake_openweather.delays = {"0": 5}
+
+    start = time.perf_counter()
+    results = service.fetch_all_weather_data(fake_cities(8))
+    elapsed = time.perf_counter() - start
+
+    assert results["City0"] is None
+    assert all(results[f"City{i}"] is not None for i in range(1, 8))
+    assert elapsed < 2
+
+def weather_reading(temperature):
+    return {"temperature": temperature, "feels_like": temperature, "humidity": 50, "wind_speed": 5,
+            "condition": "Clear", "dt": 1609459200}
+
+def test_process_cycle_single_transaction(tmp_path, weather_service):
+    """A cycle's readings, alerts and summaries are committed together on the thread's WAL connection."""
+    weather_service.db = WeatherDB(str(tmp_path / "weather.db"))
+    conn = weather_service.db.connection()
+    assert conn is weather_service.db.connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    results = {f"City{i}": weather_reading(15 + i) for i in range(10)}
+    results["Broken"] = None
+    weather_service.process_weather_data(results)
+
+    assert conn.execute("SELECT COUNT(*) FROM weather_readings").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM daily_summaries").fetchone()[0] == 10
+    assert conn.execute("SELECT COUNT(*) FROM alerts").fetchone()[0] == 4  # Above the 20°C threshold
+    assert weather_service.db.get_daily_summaries("City9")[0]["max_temp"] == 24
+
+    # A failure anywhere in the cycle rolls back its readings too
+    with patch.object(WeatherDB, "save_daily_summaries", side_effect=RuntimeError):
+        with pytest.raises(RuntimeError):
+            weather_service.process_weather_data(results)
+    assert conn.execute("SELECT COUNT(*) FROM weather_readings").fetchone()[0] == 10
+    assert not conn.in_transaction
+    weather_service.db.close()
+
+def test_migration_adds_indexes(tmp_path):
+    """A database created before the indexes existed gets them, and keeps its rows, when opened.
+
+    Opening it does not rewrite the file; its first purge switches it to incremental vacuum.
+    """
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE weather_readings (id INTEGER PRIMARY KEY AUTOINCREMENT, city TEXT, temperature REAL, "
+                 "feels_like REAL, humidity REAL, wind_speed REAL, condition TEXT, timestamp INTEGER)")
+    conn.execute("INSERT INTO weather_readings (city, temperature, timestamp) VALUES ('Delhi', 30, 1609459200)")
+    conn.commit()
+    conn.close()
+
+    db = WeatherDB(path)
+    c = db.connection()
+    indexes = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"idx_weather_readings_city_timestamp", "idx_weather_readings_timestamp",
+            "idx_alerts_city_timestamp", "idx_daily_summaries_city_date"} <= indexes
+    assert c.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+    assert c.execute("PRAGMA auto_vacuum").fetchone()[0] == 0  # None, as it was created
+    assert db.get_recent_readings("Delhi", 10)[0]["temperature"] == 30
+    assert db.get_rollups("Delhi", 3600, 1609459200, 1609462800)[0]["readings_count"] == 1
+    purge_expired(db, now=1609459200 + 3600)
+    assert c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2  # Incremental
+    assert db.get_recent_readings("Delhi", 10)[0]["temperature"] == 30
+    assert not db.enable_incremental_vacuum()
+    db.close()
+
+def test_queries_use_indexes(tmp_path):
+    """EXPLAIN QUERY PLAN of every statement a lookup or the retention delete runs searches an index."""
+    from datetime import datetime
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    c = db.connection()
+    statements = []
+    c.set_trace_callback(statements.append)
+    db.get_recent_readings("Delhi", 288)
+    db.get_window_readings("Delhi", 86400)
+    db.get_alerts("Delhi")
+    db.get_daily_summaries("Delhi")
+    db.get_daily_summaries("Delhi", "2024-01-01")
+    db.get_readings("Delhi", 0, 86400)
+    db.get_rollups("Delhi", 3600, 0, 86400)
+    db.delete_old_readings(datetime(2024, 1, 1), 100)
+    db.delete_old_rollups(3600, datetime(2024, 1, 1), 100)
+    db.delete_old_summaries(datetime(2024, 1, 1), 100)
+    c.set_trace_callback(None)
+
+    expected = {
+        "weather_readings WHERE city": "idx_weather_readings_city_timestamp",
+        "FROM alerts": "idx_alerts_city_timestamp",
+        "daily_summaries WHERE city": "idx_daily_summaries_city_date",
+        "weather_readings WHERE timestamp": "idx_weather_readings_timestamp",
+        "FROM rollups WHERE resolution = 3600 AND city": "idx_rollups_key",
+        "FROM rollups WHERE resolution = 3600 AND bucket": "idx_rollups_resolution_bucket",
+        "daily_summaries WHERE date": "idx_daily_summaries_date",
+    }
+    checked = 0
+    for statement in statements:
+        for fragment, index in expected.items():
+            if fragment in statement:
+                plan = " ".join(row[3] for row in c.execute(f"EXPLAIN QUERY PLAN {statement}"))
+                assert f"USING INDEX {index}" in plan or f"USING COVERING INDEX {index}" in plan, (statement, plan)
+                assert "TEMP B-TREE" not in plan
+                checked += 1
+    assert checked == 10
+    db.close()
+
+def random_readings(rng, count, start=1609459200, step=300):
+    conditions = ("Clear", "Clouds", "Rain")
+    return [{"city": rng.choice(("Delhi", "Mumbai")), "temp": rng.uniform(-10, 45), "feels_like": 0,
+             "humidity": rng.uniform(0, 100), "wind_speed": rng.uniform(0, 20), "condition": rng.choice(conditions),
+             "timestamp": start + i * step} for i in range(count)]
+
+def test_rollups_match_raw_readings(tmp_path):
+    """Rollups filled as readings arrive equal aggregates recomputed from the raw rows, and the migration's backfill."""
+    rng = random.Random(0)
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    readings = random_readings(rng, 3000)
+    for start in range(0, len(readings), 97):
+        db.save_weather_readings(readings[start:start + 97])
+    end = readings[-1]["timestamp"] + 1
+
+    for resolution in ROLLUP_RESOLUTIONS:
+        buckets = db.get_rollups("Delhi", resolution, 0, end)
+        raw = db.get_readings("Delhi", 0, end)
+        assert sum(bucket["readings_count"] for bucket in buckets) == len(raw)
+        for bucket in buckets:
+            inside = [r for r in raw if bucket["timestamp"] <= r["timestamp"] < bucket["timestamp"] + resolution]
+            assert bucket["readings_count"] == len(inside)
+            assert bucket["temperature"] == pytest.approx(sum(r["temperature"] for r in inside) / len(inside))
+            assert bucket["min_temp"] == min(r["temperature"] for r in inside)
+            assert bucket["max_temp"] == max(r["temperature"] for r in inside)
+            assert bucket["humidity"] == pytest.approx(sum(r["humidity"] for r in inside) / len(inside))
+            counts = {}
+            for r in inside:
+                counts[r["condition"]] = counts.get(r["condition"], 0) + 1
+            assert counts[bucket["condition"]] == max(counts.values())
+
+    incremental = {resolution: db.get_rollups("Mumbai", resolution, 0, end) for resolution in ROLLUP_RESOLUTIONS}
+    c = db.connection()
+    c.execute("DELETE FROM rollups")
+    c.execute("PRAGMA user_version = 2")
+    db.close()
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    for resolution in ROLLUP_RESOLUTIONS:
+        backfilled = db.get_rollups("Mumbai", resolution, 0, end)
+        assert [b["readings_count"] for b in backfilled] == [b["readings_count"] for b in incremental[resolution]]
+        assert [b["temperature"] for b in backfilled] == pytest.approx([b["temperature"] for b in incremental[resolution]])
+    db.close()
+
+def test_purge_expired_in_chunks(tmp_path):
+    """Each tier keeps its own history; rows go in bounded transactions and freed pages are vacuumed."""
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    c = db.connection()
+    assert c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    day = 86400
+    now = 1609459200 + 30 * day
+    # A month of readings every 5 minutes, the summaries written alongside them by every cycle
+    db.save_weather_readings(random_readings(random.Random(1), 30 * 288))
+    summary = {"city": "Delhi", "avg_temp": 20, "max_temp": 20, "min_temp": 20, "avg_humidity": 50,
+               "avg_wind_speed": 5, "dominant_condition": "Clear", "summary_data": {}}
+    db.save_daily_summaries([{**summary, "date": datetime.fromtimestamp(now - hour * 3600).strftime("%Y-%m-%d %H:%M:%S")}
+                             for hour in range(1, 30 * 24 + 1)])
+    hourly_before = c.execute("SELECT COUNT(*) FROM rollups WHERE resolution = 3600").fetchone()[0]
+    pages_before = c.execute("PRAGMA page_count").fetchone()[0]
+
+    statements = []
+    c.set_trace_callback(statements.append)
+    deleted = purge_expired(db, now=now, chunk=500)
+    c.set_trace_callback(None)
+
+    assert c.execute("SELECT MIN(timestamp) FROM weather_readings").fetchone()[0] >= now - 7 * day
+    assert c.execute("SELECT COUNT(*) FROM weather_readings").fetchone()[0] == 7 * 288
+    assert c.execute("SELECT COUNT(*) FROM daily_summaries").fetchone()[0] == 7 * 24
+    # A month is inside the hourly and daily retention
+    assert c.execute("SELECT COUNT(*) FROM rollups WHERE resolution = 3600").fetchone()[0] == hourly_before
+    assert deleted == 23 * 288 + 23 * 24
+    commits = sum(statement == "COMMIT" for statement in statements)
+    assert commits >= deleted // 500
+    assert c.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    assert c.execute("PRAGMA page_count").fetchone()[0] < pages_before
+
+    assert purge_expired(db, now=now, running=lambda: False) == 0
+    assert purge_expired(db, now=now + 365 * day) == 7 * 288 + 7 * 24 + hourly_before
+    db.close()
+
+def test_history_reads_coarse_tiers(tmp_path, weather_service):
+    """Short ranges come from raw readings, long ones from hourly or daily rollups of bounded size."""
+    weather_service.db = WeatherDB(str(tmp_path / "weather.db"))
+    now = int(time.time())
+    start = now - 60 * 86400
+    weather_service.db.save_weather_readings(random_readings(random.Random(2), 60 * 288, start=start))
+
+    recent = weather_service.get_history("Delhi", now - 3 * 3600, now)
+    assert recent and "readings_count" not in recent[0]
+    week = weather_service.get_history("Delhi", now - 7 * 86400, now)
+    assert week[1]["timestamp"] - week[0]["timestamp"] == 3600
+    months = weather_service.get_history("Delhi", start, now)
+    assert months[1]["timestamp"] - months[0]["timestamp"] == 86400
+    assert len(months) <= 61
+    assert sum(day["readings_count"] for day in months) == len(weather_service.db.get_readings("Delhi", start, now))
+    weather_service.db.close()
+
+@pytest.mark.parametrize("seconds", [3600, 86400, 7 * 86400])
+def test_rolling_window_matches_recomputation(seconds):
+    """Incremental aggregates equal a full recomputation over the readings inside the window, for any length."""
+    rng = random.Random(seconds)
+    window = RollingWindow(seconds)
+    readings = []
+    timestamp = 1609459200
+    for _ in range(3000):
+        timestamp += rng.choice((300, 300, 300, 600, 3600))
+        reading = (timestamp, rng.uniform(-10, 45), rng.uniform(0, 100), rng.uniform(0, 20),
+                   rng.choice(("Clear", "Clouds", "Rain")))
+        readings.append(reading)
+        window.add(*reading)
+
+        inside = [r for r in readings if r[0] > timestamp - seconds]
+        summary = window.summary()
+        assert summary["readings_count"] == len(inside)
+        assert summary["avg_temp"] == pytest.approx(sum(r[1] for r in inside) / len(inside))
+        assert summary["max_temp"] == max(r[1] for r in inside)
+        assert summary["min_temp"] == min(r[1] for r in inside)
+        assert summary["avg_humidity"] == pytest.approx(sum(r[2] for r in inside) / len(inside))
+        assert summary["avg_wind_speed"] == pytest.approx(sum(r[3] for r in inside) / len(inside))
+        counts = {}
+        for r in inside:
+            counts[r[4]] = counts.get(r[4], 0) + 1
+        assert summary["condition_distribution"] == counts
+        assert counts[summary["dominant_condition"]] == max(counts.values())
+
+def test_rolling_window_rebuilt_after_restart(tmp_path):
+    """A new service rebuilds each city's window from the stored readings and carries on from it."""
+    path = str(tmp_path / "weather.db")
+    service = WeatherService()
+    service.db = WeatherDB(path)
+    for temperature in (10, 30, 20):
+        service.process_weather_data({"Delhi": weather_reading(temperature)})
+    before = service.window("Delhi").summary()
+
+    restarted = WeatherService()
+    restarted.db = WeatherDB(path)
+    assert restarted.window("Delhi").summary() == before
+    restarted.process_weather_data({"Delhi": weather_reading(40)})
+    summary = restarted.db.get_daily_summaries("Delhi")[-1]
+    assert summary["max_temp"] == 40
+    assert summary["min_temp"] == 10
+    assert summary["avg_temp"] == 25
+
+def test_matplotlib_imported_lazily():
+    """Starting the web app and the service does not import matplotlib."""
+    code = "import sys, app; print('matplotlib' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert output.strip() == "False"
+
+def test_graph_route_renders_on_demand(tmp_path, monkeypatch):
+    """A graph is rendered once per newest reading, then served from the cache; older graphs are removed."""
+    import app as weather_app
+    from graph_cache import GraphCache
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    cache = GraphCache(str(tmp_path / "graphs"), workers=1)
+    monkeypatch.setattr(weather_app.weather_service, "db", db)
+    monkeypatch.setattr(weather_app, "graph_cache", cache)
+    client = weather_app.app.test_client()
+
+    assert client.get("/graph/Nowhere.png").status_code == 404
+    db.save_weather_readings([{"city": "Delhi", "temp": 20 + i, "feels_like": 20, "humidity": 50, "wind_speed": 5,
+                               "condition": "Clear", "timestamp": 1609459200 + i * 300} for i in range(12)])
+    try:
+        first = client.get("/graph/Delhi.png")
+        assert first.status_code == 200
+        assert first.data.startswith(b"\x89PNG")
+        assert client.get("/graph/Delhi.png").data == first.data
+        assert client.get("/graph/Delhi.png", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+        assert (cache.renders, cache.hits) == (1, 2)
+
+        db.save_weather_readings([{"city": "Delhi", "temp": 40, "feels_like": 40, "humidity": 50, "wind_speed": 5,
+                                   "condition": "Clear", "timestamp": 1609459200 + 12 * 300}])
+        assert client.get("/graph/Delhi.png").status_code == 200
+        assert cache.renders == 2
+        assert [path.name for path in (tmp_path / "graphs").iterdir()] == [
+            os.path.basename(cache.path("Delhi", 1609459200 + 12 * 300))]
+    finally:
+        cache.close()
+        db.close()
+
+def test_graph_route_survives_concurrent_removal(tmp_path, monkeypatch):
+    """A graph removed by a newer render after the cache returned its path is served anew, not a 500."""
+    import app as weather_app
+    from graph_cache import GraphCache
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    cache = GraphCache(str(tmp_path / "graphs"), workers=1)
+    monkeypatch.setattr(weather_app.weather_service, "db", db)
+    monkeypatch.setattr(weather_app, "graph_cache", cache)
+    client = weather_app.app.test_client()
+    db.save_weather_readings([{"city": "Delhi", "temp": 20 + i, "feels_like": 20, "humidity": 50, "wind_speed": 5,
+                               "condition": "Clear", "timestamp": 1609459200 + i * 300} for i in range(12)])
+    get = cache.get
+    calls = []
+
+    def get_then_remove(city, last_timestamp, load_readings):
+        # The first caller loses the race: its file is unlinked before send_file opens it
+        path = get(city, last_timestamp, load_readings)
+        calls.append(path)
+        if len(calls) == 1:
+            os.remove(path)
+        return path
+
+    monkeypatch.setattr(cache, "get", get_then_remove)
+    try:
+        response = client.get("/graph/Delhi.png")
+        assert response.status_code == 200
+        assert response.data.startswith(b"\x89PNG")
+        assert len(calls) == 2
+        assert cache.renders == 2
+    finally:
+        cache.close()
+        db.close()
+
+class FakeForecasts:
+    """Upstream forecast fetch that counts calls and can be held open or made to fail."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.fail = False
+
+    def __call__(self, city, coords):
+        self.calls += 1
+        self.release.wait(5)
+        return None if self.fail else [{"city": city, "version": self.calls}]
+
+@pytest.fixture
+def forecast_cache():
+    clock = [1000.0]
+    upstream = FakeForecasts()
+    executor = ThreadPoolExecutor(max_workers=4)
+    cache = ForecastCache(upstream, executor, ttl=3600, retry_interval=60, cold_wait=0.5, clock=lambda: clock[0])
+    yield cache, upstream, clock
+    upstream.release.set()
+    executor.shutdown()
+
+def test_forecast_cache_ttl_and_stale_while_revalidate(forecast_cache):
+    """Fresh forecasts come from memory; stale ones are served at once while one refresh runs."""
+    cache, upstream, clock = forecast_cache
+    coords = {"lat": 0, "lon": 0}
+    assert cache.get("Delhi", coords) == [{"city": "Delhi", "version": 1}]
+    clock[0] += 3599
+    assert cache.get("Delhi", coords)[0]["version"] == 1
+    assert upstream.calls == 1
+
+    clock[0] += 2
+    upstream.release.clear()
+    start = time.perf_counter()
+    results = list(ThreadPoolExecutor(max_workers=8).map(lambda _: cache.get("Delhi", coords), range(20)))
+    assert time.perf_counter() - start < 0.5
+    assert all(result[0]["version"] == 1 for result in results)
+    assert upstream.calls == 2  # Twenty stale reads, one refresh
+
+    upstream.release.set()
+    cache.refresh("Delhi", coords).result()
+    assert cache.get("Delhi", coords)[0]["version"] == 2
+    assert (cache.hits, cache.stale_hits, cache.misses, cache.refreshes) == (2, 20, 1, 2)
+
+def test_forecast_cache_falls_back_when_upstream_fails(forecast_cache):
+    """A failed refresh keeps the last known forecast and is not retried before retry_interval."""
+    cache, upstream, clock = forecast_cache
+    coords = {"lat": 0, "lon": 0}
+    cache.get("Delhi", coords)
+    upstream.fail = True
+    clock[0] += 3601
+    assert cache.refresh("Delhi", coords).result()[0]["version"] == 1
+    assert cache.get("Delhi", coords)[0]["version"] == 1
+    assert cache.refresh("Delhi", coords) is None
+    assert upstream.calls == 2
+
+    upstream.fail = False
+    clock[0] += 61
+    assert cache.refresh("Delhi", coords).result()[0]["version"] == 3
+    assert cache.failures == 1
+
+def test_forecast_cache_cold_wait_bounded(forecast_cache):
+    """A city's first page view waits at most cold_wait for upstream, and a failed first fetch gives None."""
+    cache, upstream, clock = forecast_cache
+    coords = {"lat": 0, "lon": 0}
+    upstream.release.clear()
+    start = time.perf_counter()
+    assert cache.get("Delhi", coords) is None
+    assert time.perf_counter() - start < 1
+    upstream.release.set()
+    cache.refresh("Delhi", coords).result()
+    assert cache.get("Delhi", coords)[0]["version"] == 1
+
+    upstream.fail = True
+    assert cache.get("Mumbai", coords) is None
+
+class SimulatedClock:
+    """Stands in for time.monotonic and time.sleep, so hours of scheduling run in seconds."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def simulate(locations, rate, burst, duration, interval=300, fetch_seconds=0.0, seed=0):
+    """Run a PollScheduler for duration simulated seconds; return it with the dispatch times of every location."""
+    clock = SimulatedClock()
+    scheduler = PollScheduler(locations, TokenBucket(rate, burst, clock), interval, jitter=0.1,
+                              clock=clock, rng=random.Random(seed))
+    polls = {name: [] for name in locations}
+
+    def dispatch(batch):
+        for name in batch:
+            polls[name].append(clock.now)
+        clock.sleep(fetch_seconds)
+
+    scheduler.run(dispatch, lambda: clock.now < duration, sleep=clock.sleep)
+    return scheduler, polls
+
+def test_scheduler_even_load_without_missed_deadlines():
+    """20,000 locations every 5 minutes within a 100/s quota: steady load, every location on time."""
+    locations = {f"Location{i}": {"lat": 0, "lon": 0} for i in range(20000)}
+    scheduler, polls = simulate(locations, rate=100, burst=100, duration=3600, fetch_seconds=0.05)
+
+    assert scheduler.missed == 0
+    assert scheduler.max_lateness < 1
+    assert all(len(times) >= 11 for times in polls.values())
+    for times in list(polls.values())[:1000]:
+        gaps = [later - earlier for earlier, later in zip(times, times[1:])]
+        assert max(gaps) <= 300 * 1.2 + 1
+    per_second = {}
+    for times in polls.values():
+        for moment in times:
+            per_second[int(moment)] = per_second.get(int(moment), 0) + 1
+    assert max(per_second.values()) <= 100 + 100  # Quota plus the initial burst
+    per_minute = [sum(per_second.get(second, 0) for second in range(minute * 60, minute * 60 + 60))
+                  for minute in range(6, 60)]  # From the end of the first interval, plus its jitter
+    mean = 20000 / 300 * 60
+    assert all(abs(count - mean) < 0.1 * mean for count in per_minute)
+    # Every location is polled within the first interval after a start
+    assert max(times[0] for times in polls.values()) < 300 + 1
+    assert min(times[0] for times in polls.values()) < 1
+
+def test_scheduler_respects_quota_when_overloaded():
+    """Demand above the quota is throttled to the quota and reported as missed deadlines."""
+    locations = {f"Location{i}": {"lat": 0, "lon": 0} for i in range(3000)}
+    scheduler, polls = simulate(locations, rate=5, burst=10, duration=1200, interval=300)
+    assert scheduler.dispatched <= 5 * 1200 + 10
+    assert scheduler.missed > 0
+
+def test_scheduler_per_location_intervals():
+    locations = {"Fast": {"lat": 0, "lon": 0, "interval": 60}, "Slow": {"lat": 0, "lon": 0, "interval": 600}}
+    _, polls = simulate(locations, rate=1, burst=1, duration=6000)
+    assert 90 <= len(polls["Fast"]) <= 110
+    assert 9 <= len(polls["Slow"]) <= 11
+
+def test_forecasts_share_the_poll_quota(weather_service):
+    """Dashboard forecasts take tokens from the polls' bucket, so together they stay within the API quota."""
+    clock = SimulatedClock()
+    weather_service.quota = TokenBucket(5, 5, clock)
+    requests_at = []
+    response = MagicMock()
+    response.json.return_value = {"list": []}
+
+    def get(url, params, timeout):
+        requests_at.append(clock.now)
+        return response
+
+    weather_service.session = MagicMock()
+    weather_service.session.get.side_effect = get
+    # 1200 locations every 5 minutes need 4 of the 5 requests a second
+    locations = {f"Location{i}": {"lat": 0, "lon": 0} for i in range(1200)}
+    scheduler = PollScheduler(locations, weather_service.quota, 300, clock=clock, rng=random.Random(0))
+    forecasts = []
+
+    def dispatch(batch):
+        requests_at.extend(clock.now for _ in batch)  # One request per polled location
+        for _ in range(3):
+            forecasts.append(weather_service.fetch_weather_forecast("Delhi", CITIES["Delhi"]))
+        clock.sleep(0.1)
+
+    scheduler.run(dispatch, lambda: clock.now < 600, sleep=clock.sleep)
+
+    assert len(requests_at) <= 5 * 600 + 5
+    per_second = {}
+    for moment in requests_at:
+        per_second[int(moment)] = per_second.get(int(moment), 0) + 1
+    assert max(per_second.values()) <= 5 + 5
+    assert [] in forecasts and None in forecasts  # Some forecasts fetched, the rest deferred to the cache
+
+def test_locations_from_file_and_table(tmp_path):
+    csv_path = tmp_path / "locations.csv"
+    csv_path.write_text("name,lat,lon,interval\nDelhi,28.6,77.2,\nOslo,59.9,10.7,900\n")
+    json_path = tmp_path / "locations.json"
+    json_path.write_text(json.dumps([{"name": "Delhi", "lat": 28.6, "lon": 77.2}, {"name": "Oslo", "lat": 59.9, "lon": 10.7, "interval": 900}]))
+    expected = {"Delhi": {"lat": 28.6, "lon": 77.2}, "Oslo": {"lat": 59.9, "lon": 10.7, "interval": 900}}
+    assert load_locations(str(csv_path)) == expected
+    assert load_locations(str(json_path)) == expected
+
+    db = WeatherDB(str(tmp_path / "weather.db"))
+    assert db.get_locations() == {}
+    db.save_locations(expected)
+    assert db.get_locations() == expected
+    db.close()
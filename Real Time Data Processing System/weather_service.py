@@ -1,33 +1,67 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Dict, Optional, List
-from collections import Counter
 import time
 import threading
-import matplotlib.pyplot as plt
 from database import WeatherDB
-from config import CITIES, OPENWEATHER_API_KEY, UPDATE_INTERVAL, TEMPERATURE_THRESHOLD, CONSECUTIVE_ALERTS 
+from rolling_window import RollingWindow
+from forecast_cache import ForecastCache
+from scheduler import PollScheduler, TokenBucket, load_locations
+from data_cleanup import ROLLUP_RETENTION, purge_expired
+from config import CITIES, OPENWEATHER_API_KEY, OPENWEATHER_URL, UPDATE_INTERVAL, TEMPERATURE_THRESHOLD, CONSECUTIVE_ALERTS 
+from config import FETCH_CONCURRENCY, FETCH_TIMEOUT, FETCH_RETRIES, FETCH_BACKOFF, SUMMARY_WINDOW
+from config import FORECAST_TTL, FORECAST_RETRY, FORECAST_COLD_WAIT
+from config import LOCATIONS_FILE, POLL_JITTER, API_RATE_LIMIT, API_BURST
+from config import RAW_RETENTION, RETENTION_INTERVAL, HISTORY_POINTS
 import os
 
+def create_session(pool_size: int = FETCH_CONCURRENCY, retries: int = FETCH_RETRIES, backoff: float = FETCH_BACKOFF) -> requests.Session:
+    """Keep-alive session whose pool holds a connection per concurrent fetch, retrying transient failures."""
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 class WeatherService:
-    def __init__(self):
+    def __init__(self, concurrency: int = FETCH_CONCURRENCY):
         self.db = WeatherDB()
         self.consecutive_alerts = {city: 0 for city in CITIES}
         self.running = False
+        self.windows: Dict[str, RollingWindow] = {}
+        self.base_url = OPENWEATHER_URL
+        self.timeout = FETCH_TIMEOUT
+        self.concurrency = concurrency
+        self.locations = self.load_monitored_locations()
+        self.quota = TokenBucket(API_RATE_LIMIT, API_BURST)
+        self.session = create_session(concurrency)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="weather-fetch")
+        self.forecasts = ForecastCache(self.fetch_weather_forecast, self.fetch_pool, ttl=FORECAST_TTL,
+                                       retry_interval=FORECAST_RETRY, cold_wait=FORECAST_COLD_WAIT)
+
+    def load_monitored_locations(self) -> Dict[str, Dict]:
+        if LOCATIONS_FILE:
+            return load_locations(LOCATIONS_FILE)
+        return self.db.get_locations() or dict(CITIES)
 
     def kelvin_to_celsius(self, kelvin: float) -> float:
         return kelvin - 273.15
 
     def fetch_weather_data(self, city: str, coords: Dict[str, float]) -> Optional[Dict]:
         try:
-            url = "https://api.openweathermap.org/data/2.5/weather"
+            url = f"{self.base_url}/weather"
             params = {
                 "lat": coords["lat"],
                 "lon": coords["lon"],
                 "appid": OPENWEATHER_API_KEY
             }
             
-            response = requests.get(url, params=params)
+            response = self.session.get(url, params=params, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -43,74 +77,62 @@ class WeatherService:
             print(f"Error fetching weather data for {city}: {str(e)}")
             return None
 
-    def check_temperature_threshold(self, city: str, temperature: float):
+    def fetch_all_weather_data(self, cities: Dict[str, Dict[str, float]]) -> Dict[str, Optional[Dict]]:
+        # Every fetch is bounded by its timeouts and retries, so a hung city only delays the cycle by that much
+        futures = {city: self.fetch_pool.submit(self.fetch_weather_data, city, coords) for city, coords in cities.items()}
+        return {city: future.result() for city, future in futures.items()}
+
+    def temperature_alert(self, city: str, temperature: float) -> Optional[str]:
         if temperature > TEMPERATURE_THRESHOLD:
-            self.consecutive_alerts[city] += 1
+            self.consecutive_alerts[city] = self.consecutive_alerts.get(city, 0) + 1
             if self.consecutive_alerts[city] >= CONSECUTIVE_ALERTS:
-                alert_msg = f"High temperature alert for {city}: {temperature:.1f}°C"
-                self.db.save_alert(city, "temperature", alert_msg)
+                return f"High temperature alert for {city}: {temperature:.1f}°C"
         else:
             self.consecutive_alerts[city] = 0
+        return None
+
+    def check_temperature_threshold(self, city: str, temperature: float):
+        alert_msg = self.temperature_alert(city, temperature)
+        if alert_msg:
+            self.db.save_alert(city, "temperature", alert_msg)
 
     def calculate_daily_summary(self, city: str):
-        readings = self.db.get_recent_readings(city, 288)  # Last 24 hours (5-minute intervals)
-        if not readings:
-            return
-        
-        temperatures = [r["temperature"] for r in readings]
-        humidities = [r["humidity"] for r in readings]
-        wind_speeds = [r["wind_speed"] for r in readings]
-        conditions = [r["condition"] for r in readings]
-        
-        summary = {
-            "avg_temp": sum(temperatures) / len(temperatures),
-            "max_temp": max(temperatures),
-            "min_temp": min(temperatures),
-            "avg_humidity": sum(humidities) / len(humidities),
-            "avg_wind_speed": sum(wind_speeds) / len(wind_speeds),
-            "dominant_condition": Counter(conditions).most_common(1)[0][0]
-        }
-        
-        self.db.save_daily_summary(
-            city=city,
-            date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            avg_temp=summary["avg_temp"],
-            max_temp=summary["max_temp"],
-            min_temp=summary["min_temp"],
-            avg_humidity=summary["avg_humidity"],
-            avg_wind_speed=summary["avg_wind_speed"],
-            dominant_condition=summary["dominant_condition"],
-            summary_data={
-                "readings_count": len(readings),
-                "condition_distribution": dict(Counter(conditions))
+        summary = self.daily_summary(city)
+        if summary:
+            self.db.save_daily_summary(**summary)
+
+    def window(self, city: str) -> RollingWindow:
+        # Built from the stored readings the first time a city is seen, e.g. after a restart
+        window = self.windows.get(city)
+        if window is None:
+            window = RollingWindow.from_readings(SUMMARY_WINDOW, self.db.get_window_readings(city, SUMMARY_WINDOW))
+            self.windows[city] = window
+        return window
+
+    def daily_summary(self, city: str) -> Optional[Dict]:
+        """Summary of the city's rolling window as keyword arguments of WeatherDB.save_daily_summary."""
+        window = self.window(city)
+        aggregates = window.summary()
+        if not aggregates:
+            return None
+        return {
+            "city": city,
+            "date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "avg_temp": aggregates["avg_temp"],
+            "max_temp": aggregates["max_temp"],
+            "min_temp": aggregates["min_temp"],
+            "avg_humidity": aggregates["avg_humidity"],
+            "avg_wind_speed": aggregates["avg_wind_speed"],
+            "dominant_condition": aggregates["dominant_condition"],
+            "summary_data": {
+                "readings_count": aggregates["readings_count"],
+                "condition_distribution": aggregates["condition_distribution"],
+                "window_seconds": window.seconds
             }
-        )
-
-        self.generate_temperature_graph(city, readings)
-
-    def generate_temperature_graph(self, city: str, readings: List[Dict]):
-        if not readings:
-            print(f"No readings available for {city}.")
-            return
-
-        dates = [datetime.fromtimestamp(reading['timestamp']).strftime('%Y-%m-%d %H:%M') for reading in readings]
-        temps = [reading['temperature'] for reading in readings]
-
-        plt.figure(figsize=(10, 5))
-        plt.plot(dates, temps, marker='o', label='Temperature (°C)', color='b')
-        plt.title(f'Temperature Trend for {city}')
-        plt.xlabel('Time')
-        plt.ylabel('Temperature (°C)')
-        plt.xticks(rotation=45)
-        plt.grid()
-        plt.tight_layout()
-        plt.legend()
-
-        graph_path = f'static/graphs/{city}_temperature_graph.png'
-        plt.savefig(graph_path)
-        plt.close()
+        }
 
     def save_weather_reading(self, city: str, weather_data: Dict):
+        window = self.window(city)
         self.db.save_weather_reading(
             city=city,
             temp=weather_data["temperature"],
@@ -119,35 +141,95 @@ class WeatherService:
             wind_speed=weather_data["wind_speed"],
             condition=weather_data["condition"]
         )
+        self.add_to_window(window, int(time.time()), weather_data)
+
+    def add_to_window(self, window: RollingWindow, timestamp: int, weather_data: Dict):
+        window.add(timestamp, weather_data["temperature"], weather_data["humidity"],
+                   weather_data["wind_speed"], weather_data["condition"])
+
+    def process_weather_data(self, results: Dict[str, Optional[Dict]]):
+        """Store one cycle's readings, alerts and summaries in a single transaction, one executemany per table."""
+        fetched = {city: weather_data for city, weather_data in results.items() if weather_data}
+        now = int(time.time())
+        alerts, summaries = [], []
+        with self.db.transaction():
+            # Windows are rebuilt from the database before this cycle's readings are stored
+            windows = {city: self.window(city) for city in fetched}
+            self.db.save_weather_readings([
+                {"city": city, "temp": weather_data["temperature"], "feels_like": weather_data["feels_like"],
+                 "humidity": weather_data["humidity"], "wind_speed": weather_data["wind_speed"],
+                 "condition": weather_data["condition"], "timestamp": now}
+                for city, weather_data in fetched.items()
+            ])
+            for city, weather_data in fetched.items():
+                self.add_to_window(windows[city], now, weather_data)
+                alert_msg = self.temperature_alert(city, weather_data["temperature"])
+                if alert_msg:
+                    alerts.append({"city": city, "alert_type": "temperature", "message": alert_msg, "timestamp": now})
+                summary = self.daily_summary(city)
+                if summary:
+                    summaries.append(summary)
+            self.db.save_alerts(alerts)
+            self.db.save_daily_summaries(summaries)
 
     def update_weather_data(self):
         self.running = True
+        scheduler = PollScheduler(self.locations, self.quota, UPDATE_INTERVAL, jitter=POLL_JITTER)
+        scheduler.run(lambda batch: self.process_weather_data(self.fetch_all_weather_data(batch)),
+                      lambda: self.running, limit=self.concurrency)
+
+    def enforce_retention(self):
         while self.running:
-            for city, coords in CITIES.items():
-                weather_data = self.fetch_weather_data(city, coords)
-                if weather_data:
-                    self.save_weather_reading(city, weather_data)
-                    self.check_temperature_threshold(city, weather_data["temperature"])
-                    self.calculate_daily_summary(city)
-            
-            time.sleep(UPDATE_INTERVAL)
+            purge_expired(self.db, running=lambda: self.running)
+            deadline = time.monotonic() + RETENTION_INTERVAL
+            # Checked every second so a stop request is noticed
+            while self.running and time.monotonic() < deadline:
+                time.sleep(1)
+
+    def get_history(self, city: str, start: int, end: int) -> List[Dict]:
+        """Readings from start to end from the finest tier that still holds start and needs at most HISTORY_POINTS rows.
+
+        Ranges of a few hours read raw readings, longer ones the hourly or daily rollups, so the cost
+        depends on the rows returned and not on how much history is stored.
+        """
+        now = time.time()
+        if start >= now - RAW_RETENTION and (end - start) / UPDATE_INTERVAL <= HISTORY_POINTS:
+            return self.db.get_readings(city, start, end)
+        tiers = sorted(ROLLUP_RETENTION.items())
+        for resolution, seconds in tiers:
+            if start >= now - seconds and (end - start) / resolution <= HISTORY_POINTS:
+                return self.db.get_rollups(city, resolution, start, end)
+        return self.db.get_rollups(city, tiers[-1][0], start, end)
 
     def get_alerts(self, city: str):
         return self.db.get_alerts(city)
 
+    def get_forecast(self, city: str, coords: Dict[str, float]) -> Optional[List[Dict]]:
+        return self.forecasts.get(city, coords)
+
+    def warm_forecasts(self, cities: Dict[str, Dict[str, float]]):
+        for city, coords in cities.items():
+            self.forecasts.refresh(city, coords)
+
     def start_service(self):
+        self.running = True
         threading.Thread(target=self.update_weather_data).start()
+        threading.Thread(target=self.enforce_retention, daemon=True).start()
 
     def fetch_weather_forecast(self, city: str, coords: Dict[str, float]) -> Optional[Dict]:
+        # Forecasts spend the polls' API quota; when it is exhausted the cache keeps serving the last forecast
+        if not self.quota.take():
+            print(f"Forecast for {city} deferred: weather API quota exhausted")
+            return None
         try:
-            url = "https://api.openweathermap.org/data/2.5/forecast"
+            url = f"{self.base_url}/forecast"
             params = {
                 "lat": coords["lat"],
                 "lon": coords["lon"],
                 "appid": OPENWEATHER_API_KEY
             }
             
-            response = requests.get(url, params=params)
+            response = self.session.get(url, params=params, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
 
@@ -0,0 +1,85 @@
+"""Load test for rule database access: a new connection per request versus the pooled WAL layer.
+
+Worker threads run the API's statements against a copy of the sample database, a mix of
+rule reads (as /evaluate_rule does on a cache miss) and rule inserts (as /create_rule does),
+and the script reports throughput and failed requests for each access mode.
+
+    python benchmark_db_pool.py [threads] [requests_per_thread] [write_percent]
+"""
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from rule_db import ConnectionPool
+from database_init import migrate_db
+
+SOURCE_DATABASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "database", "rules.db")
+
+@contextmanager
+def connection_per_request(path):
+    # How the API opened connections before the pool: default rollback journal, a new handle each time
+    conn = sqlite3.connect(path, timeout=5)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def prepare_database(directory, wal):
+    path = os.path.join(directory, "wal.db" if wal else "rollback.db")
+    shutil.copy(SOURCE_DATABASE, path)
+    conn = sqlite3.connect(path)
+    migrate_db(conn)
+    conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")
+    conn.close()
+    return path
+
+def run(connection, threads, requests_per_thread, write_percent):
+    errors = []
+    counter = iter(range(threads * requests_per_thread))
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        for request in range(requests_per_thread):
+            try:
+                with connection() as conn:
+                    if request % 100 < write_percent:
+                        with lock:
+                            number = next(counter)
+                        conn.execute("INSERT INTO rules (name, rule_string) VALUES (?, ?)",
+                                     (f"load {worker_id}-{number}", "age > 30"))
+                    else:
+                        conn.execute("SELECT ast, optimized_ast, operand_stats FROM rules WHERE id = ?",
+                                     (1 + request % 2,)).fetchone()
+            except sqlite3.Error as e:
+                errors.append(str(e))
+
+    workers = [threading.Thread(target=worker, args=(worker_id,)) for worker_id in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return threads * requests_per_thread / elapsed, errors
+
+def main(threads=8, requests_per_thread=500, write_percent=10):
+    with tempfile.TemporaryDirectory() as directory:
+        path = prepare_database(directory, wal=False)
+        throughput, errors = run(lambda: connection_per_request(path), threads, requests_per_thread, write_percent)
+        print(f"connection per request: {throughput:9.0f} requests/s, {len(errors)} failed"
+              + (f" ({errors[0]})" if errors else ""))
+
+        pool = ConnectionPool(prepare_database(directory, wal=True), size=threads)
+        throughput, errors = run(pool.connection, threads, requests_per_thread, write_percent)
+        pool.close()
+        print(f"pooled WAL connections: {throughput:9.0f} requests/s, {len(errors)} failed"
+              + (f" ({errors[0]})" if errors else ""))
+
+if __name__ == "__main__":
+    main(*[int(argument) for argument in sys.argv[1:4]])
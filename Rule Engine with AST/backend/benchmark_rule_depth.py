@@ -0,0 +1,77 @@
+"""Depth scaling benchmark for the iterative parser, binary storage format and evaluators.
+
+Builds left-deep combined rules (as /combine_rules does) of increasing depth and reports
+the time per stage and per node. Linear scaling shows up as a flat per-node column.
+
+    python benchmark_rule_depth.py [depth ...]
+"""
+import json
+import sys
+import time
+import tracemalloc
+from rule_engine_api import create_ast, combine_ast, deserialize_ast, evaluate_ast
+from rule_compiler import compile_ast, compile_optimized_ast
+from rule_optimizer import optimize_ast
+from rule_storage import dumps_tree, loads_tree, tree_to_postfix, compile_stored
+
+DEFAULT_DEPTHS = [1000, 5000, 10000, 20000, 40000]
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+def benchmark(depth):
+    data = {"age": depth + 1, "salary": 0}
+    asts, parse_time = timed(lambda: [create_ast(f"age > {i} AND salary < {i + 100000}") for i in range(depth)])
+    combined = combine_ast(asts)
+    nodes = 4 * depth - 1
+
+    stored, dump_time = timed(lambda: dumps_tree(combined))
+    restored, load_time = timed(lambda: deserialize_ast(stored))
+    optimized, optimize_time = timed(lambda: optimize_ast(loads_tree(stored)))
+    compiled, compile_time = timed(lambda: compile_optimized_ast(optimized))
+    # Loading a stored rule for evaluation, from the JSON postfix text used before and from the node table
+    optimized_json = json.dumps(tree_to_postfix(optimized))
+    optimized_blob = dumps_tree(optimized)
+    _, load_json_time = timed(lambda: compile_optimized_ast(loads_tree(optimized_json)))
+    _, load_blob_time = timed(lambda: compile_stored(optimized_blob))
+    _, evaluate_time = timed(lambda: compiled.evaluate(data))
+    _, walk_time = timed(lambda: evaluate_ast(restored, data))
+
+    tracemalloc.start()
+    compile_ast(combined).evaluate(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "depth": depth,
+        "nodes": nodes,
+        "parse_s": parse_time,
+        "dump_s": dump_time,
+        "load_s": load_time,
+        "optimize_s": optimize_time,
+        "compile_s": compile_time,
+        "evaluate_compiled_s": evaluate_time,
+        "evaluate_ast_s": walk_time,
+        "load_json_s": load_json_time,
+        "load_blob_s": load_blob_time,
+        "json_bytes": len(optimized_json),
+        "blob_bytes": len(optimized_blob),
+        "compile_and_evaluate_peak_bytes": peak,
+    }
+
+def main(depths):
+    stages = ["parse_s", "dump_s", "load_s", "optimize_s", "compile_s", "evaluate_compiled_s", "evaluate_ast_s",
+              "load_json_s", "load_blob_s"]
+    print(f"{'depth':>7} {'nodes':>7} " + " ".join(f"{stage[:-2]:>17}" for stage in stages)
+          + f" {'peak KiB':>9} {'JSON KiB':>9} {'BLOB KiB':>9}")
+    for depth in depths:
+        result = benchmark(depth)
+        cells = [f"{result[stage] * 1000:8.1f}ms {result[stage] / result['nodes'] * 1e6:5.2f}us" for stage in stages]
+        print(f"{result['depth']:>7} {result['nodes']:>7} " + " ".join(cells)
+              + f" {result['compile_and_evaluate_peak_bytes'] / 1024:9.0f}"
+              + f" {result['json_bytes'] / 1024:9.0f} {result['blob_bytes'] / 1024:9.0f}")
+
+if __name__ == "__main__":
+    main([int(depth) for depth in sys.argv[1:]] or DEFAULT_DEPTHS)
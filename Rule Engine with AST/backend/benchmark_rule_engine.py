@@ -0,0 +1,251 @@
+"""Benchmark suite for the rule engine on synthetic rules and records.
+
+A seeded generator builds rules of a given parenthesis depth and operand count over a pool of
+numeric and string attributes (string attributes draw from `cardinality` distinct values), and
+records over the same attributes. Two groups of scenarios are run:
+
+    shape   parse, deserialize and storage per rule; single-record latency percentiles for the
+            compiled program and the AST walk; batch throughput of the vectorized evaluator
+    rules   rule-count scaling of /match_rules (index pruning plus the shared network) and
+            memory per stored rule
+
+Results are written as JSON; --compare reports each metric against an earlier run and exits
+with status 1 when any metric regressed by more than the tolerance.
+
+    python benchmark_rule_engine.py [--quick] [--seed N] [--output results.json]
+                                    [--compare baseline.json] [--tolerance 0.1]
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from rule_engine_api import create_ast, deserialize_ast, evaluate_ast
+from rule_batch import evaluate_batch, records_to_columns, referenced_keys
+from rule_index import RuleIndex
+from rule_network import RuleNetwork
+from rule_optimizer import optimize_ast
+from rule_storage import dumps_tree, compile_stored
+
+NUMERIC_ATTRIBUTES = 8
+STRING_ATTRIBUTES = 4
+NUMERIC_RANGE = 100
+MISSING_PROBABILITY = 0.05
+# Rules whose batch throughput is averaged in each shape scenario
+BATCH_RULES = 10
+# Only the comparisons /create_rule accepts; is_valid_rule rejects "!"
+COMPARISONS = (">", "<", ">=", "<=", "=")
+
+SHAPE_SCENARIOS = [
+    {"depth": depth, "operands": operands, "cardinality": 10}
+    for depth in (1, 3, 6) for operands in (4, 16, 64)
+]
+RULE_SCENARIOS = [
+    {"rules": rules, "depth": 2, "operands": 8, "cardinality": cardinality}
+    for rules in (10, 100, 1000) for cardinality in (10, 1000)
+]
+QUICK_SHAPE_SCENARIOS = [{"depth": 1, "operands": 4, "cardinality": 10}, {"depth": 3, "operands": 16, "cardinality": 10}]
+QUICK_RULE_SCENARIOS = [{"rules": 10, "depth": 2, "operands": 8, "cardinality": 10},
+                        {"rules": 100, "depth": 2, "operands": 8, "cardinality": 1000}]
+
+def attribute_names():
+    return ([f"num{i}" for i in range(NUMERIC_ATTRIBUTES)],
+            [f"cat{i}" for i in range(STRING_ATTRIBUTES)])
+
+def generate_condition(rng, cardinality):
+    numeric, strings = attribute_names()
+    if rng.random() < 0.7:
+        return f"{rng.choice(numeric)} {rng.choice(COMPARISONS)} {rng.randrange(NUMERIC_RANGE)}"
+    return f"{rng.choice(strings)} = 'v{rng.randrange(cardinality)}'"
+
+def generate_rule(rng, depth, operands, cardinality):
+    """Return a rule string with `operands` conditions nested `depth` parenthesis levels deep."""
+    if operands == 1:
+        return generate_condition(rng, cardinality)
+    if depth == 0:
+        parts = [generate_condition(rng, cardinality) for _ in range(operands)]
+        rule = parts[0]
+        for part in parts[1:]:
+            rule += f" {rng.choice(('AND', 'OR'))} {part}"
+        return rule
+    split = rng.randint(1, operands - 1)
+    left = generate_rule(rng, depth - 1, split, cardinality)
+    right = generate_rule(rng, depth - 1, operands - split, cardinality)
+    return f"({left}) {rng.choice(('AND', 'OR'))} ({right})"
+
+def generate_record(rng, cardinality):
+    numeric, strings = attribute_names()
+    record = {}
+    for key in numeric:
+        if rng.random() >= MISSING_PROBABILITY:
+            record[key] = rng.randrange(NUMERIC_RANGE)
+    for key in strings:
+        if rng.random() >= MISSING_PROBABILITY:
+            record[key] = f"v{rng.randrange(cardinality)}"
+    return record
+
+def percentiles(samples):
+    samples = sorted(samples)
+    last = len(samples) - 1
+    return {f"p{q}_us": samples[round(last * q / 100)] / 1000 for q in (50, 90, 99)}
+
+def latencies(function, arguments):
+    samples = []
+    for argument in arguments:
+        start = time.perf_counter_ns()
+        function(argument)
+        samples.append(time.perf_counter_ns() - start)
+    return samples
+
+def timed(function, count):
+    """Return items per second for a call handling count items, and the call's result."""
+    start = time.perf_counter()
+    result = function()
+    return count / (time.perf_counter() - start), result
+
+def allocated(function):
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size
+
+def run_shape(scenario, rng, rule_count, record_count, batch_size):
+    depth, operands, cardinality = scenario["depth"], scenario["operands"], scenario["cardinality"]
+    rule_strings = [generate_rule(rng, depth, operands, cardinality) for _ in range(rule_count)]
+    records = [generate_record(rng, cardinality) for _ in range(record_count)]
+    batch = [generate_record(rng, cardinality) for _ in range(batch_size)]
+
+    parse_rate, written = timed(lambda: [create_ast(rule) for rule in rule_strings], rule_count)
+    stored = [dumps_tree(optimize_ast(ast)) for ast in written]
+    deserialize_rate, _ = timed(lambda: [deserialize_ast(blob) for blob in stored], rule_count)
+    compile_rate, compiled = timed(lambda: [compile_stored(blob) for blob in stored], rule_count)
+
+    # Each record is evaluated against the next rule in turn, so percentiles cover the whole rule mix.
+    # The tree walk runs on the rules as written; optimized trees may fold to constants it does not handle.
+    pairs = [(index % rule_count, data) for index, data in enumerate(records)]
+    compiled_samples = latencies(lambda pair: compiled[pair[0]].evaluate(pair[1]), pairs)
+    walk_samples = latencies(lambda pair: evaluate_ast(written[pair[0]], pair[1]), pairs)
+
+    batch_rules = compiled[:BATCH_RULES]
+    columns = [records_to_columns(batch, referenced_keys(rule)) for rule in batch_rules]
+    batch_rate, _ = timed(lambda: [evaluate_batch(rule, rule_columns, batch_size)
+                                   for rule, rule_columns in zip(batch_rules, columns)], batch_size * len(batch_rules))
+
+    result = dict(scenario)
+    result["parse_rules_per_s"] = parse_rate
+    result["deserialize_rules_per_s"] = deserialize_rate
+    result["compile_rules_per_s"] = compile_rate
+    result["stored_bytes_per_rule"] = sum(len(blob) for blob in stored) / rule_count
+    result.update({f"evaluate_compiled_{name}": value for name, value in percentiles(compiled_samples).items()})
+    result.update({f"evaluate_ast_{name}": value for name, value in percentiles(walk_samples).items()})
+    result["batch_records_per_s"] = batch_rate
+    return result
+
+def run_rules(scenario, rng, record_count):
+    rules, cardinality = scenario["rules"], scenario["cardinality"]
+    rule_strings = [generate_rule(rng, scenario["depth"], scenario["operands"], cardinality) for _ in range(rules)]
+    records = [generate_record(rng, cardinality) for _ in range(record_count)]
+    stored = [dumps_tree(optimize_ast(create_ast(rule))) for rule in rule_strings]
+
+    compiled, compiled_bytes = allocated(lambda: [compile_stored(blob) for blob in stored])
+
+    def build_matchers():
+        network = RuleNetwork()
+        index = RuleIndex()
+        for rule_id, rule in enumerate(compiled):
+            network.add_rule(rule_id, rule)
+            index.add_rule(rule_id, rule)
+        return network, index
+
+    (network, index), matcher_bytes = allocated(build_matchers)
+
+    def match(data):
+        network.match(data, index.candidates(data))
+
+    result = dict(scenario)
+    result["stored_bytes_per_rule"] = sum(len(blob) for blob in stored) / rules
+    result["compiled_bytes_per_rule"] = compiled_bytes / rules
+    result["matcher_bytes_per_rule"] = matcher_bytes / rules
+    result["network_nodes_per_rule"] = len(network.nodes) / rules
+    result.update({f"match_{name}": value for name, value in percentiles(latencies(match, records)).items()})
+    result["match_records_per_s"], _ = timed(lambda: [match(data) for data in records], record_count)
+    return result
+
+def run(seed=0, quick=False):
+    rng = random.Random(seed)
+    rule_count, record_count, batch_size = (50, 200, 2000) if quick else (500, 5000, 100000)
+    shape = [run_shape(scenario, rng, rule_count, record_count, batch_size)
+             for scenario in (QUICK_SHAPE_SCENARIOS if quick else SHAPE_SCENARIOS)]
+    rules = [run_rules(scenario, rng, record_count)
+             for scenario in (QUICK_RULE_SCENARIOS if quick else RULE_SCENARIOS)]
+    return {
+        "meta": {"seed": seed, "quick": quick, "python": platform.python_version(),
+                 "platform": platform.platform(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "shape": shape,
+        "rules": rules,
+    }
+
+SCENARIO_KEYS = ("rules", "depth", "operands", "cardinality")
+
+def scenario_key(result):
+    return tuple((key, result[key]) for key in SCENARIO_KEYS if key in result)
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+def compare(results, baseline, tolerance):
+    """Yield (group, scenario, metric, baseline, current, change, regressed) for metrics present in both runs."""
+    for group in ("shape", "rules"):
+        previous = {scenario_key(result): result for result in baseline.get(group, [])}
+        for result in results[group]:
+            key = scenario_key(result)
+            if key not in previous:
+                continue
+            for metric, value in result.items():
+                old = previous[key].get(metric)
+                if metric in SCENARIO_KEYS or not isinstance(old, (int, float)) or not old:
+                    continue
+                change = value / old - 1
+                regressed = change < -tolerance if higher_is_better(metric) else change > tolerance
+                yield group, key, metric, old, value, change, regressed
+
+def print_results(results):
+    for group in ("shape", "rules"):
+        for result in results[group]:
+            scenario = " ".join(f"{key}={value}" for key, value in scenario_key(result))
+            metrics = "  ".join(f"{metric}={value:.4g}" for metric, value in result.items() if metric not in SCENARIO_KEYS)
+            print(f"{group:5} {scenario}: {metrics}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--quick", action="store_true", help="small sizes, for a smoke run")
+    parser.add_argument("--output", help="write results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="relative change counted as a regression")
+    arguments = parser.parse_args(argv)
+
+    results = run(arguments.seed, arguments.quick)
+    print_results(results)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        regressions = 0
+        for group, key, metric, old, value, change, regressed in compare(results, baseline, arguments.tolerance):
+            scenario = " ".join(f"{name}={setting}" for name, setting in key)
+            marker = "REGRESSION" if regressed else ""
+            print(f"{group:5} {scenario:45} {metric:28} {old:12.4g} -> {value:12.4g} {change:+7.1%} {marker}")
+            regressions += regressed
+        print(f"{regressions} regression(s) beyond {arguments.tolerance:.0%}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
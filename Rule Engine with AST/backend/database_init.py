@@ -1,12 +1,63 @@
 import sqlite3
 import os
+from rule_optimizer import optimize_ast
+from rule_storage import dumps_tree, loads_tree
+from rule_dag import create_node_table, store_tree
+from rule_db import configure
 
 DATABASE_PATH = "./database/rules.db"
 
 os.makedirs(os.path.dirname(DATABASE_PATH), exist_ok=True)
 
+# Generation of the rule listing: triggers bump it whenever a rule is added, removed or renamed,
+# or its rule string or tree changes, whichever connection or process makes the change.
+# Re-ordering only rewrites optimized_ast and operand_stats, which the listing does not include.
+GENERATION_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS rules_generation (id INTEGER PRIMARY KEY CHECK (id = 1), generation INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO rules_generation (id, generation) VALUES (1, 0)",
+    """CREATE TRIGGER IF NOT EXISTS rules_generation_insert AFTER INSERT ON rules
+       BEGIN UPDATE rules_generation SET generation = generation + 1 WHERE id = 1; END""",
+    """CREATE TRIGGER IF NOT EXISTS rules_generation_delete AFTER DELETE ON rules
+       BEGIN UPDATE rules_generation SET generation = generation + 1 WHERE id = 1; END""",
+    """CREATE TRIGGER IF NOT EXISTS rules_generation_update AFTER UPDATE OF name, rule_string, ast, root_node ON rules
+       BEGIN UPDATE rules_generation SET generation = generation + 1 WHERE id = 1; END""",
+)
+
+def rules_generation(conn):
+    return conn.execute("SELECT generation FROM rules_generation WHERE id = 1").fetchone()[0]
+
+def migrate_db(conn):
+    # Bring databases created by older versions up to the current schema
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(rules)")}
+    if "optimized_ast" not in columns:
+        conn.execute("ALTER TABLE rules ADD COLUMN optimized_ast BLOB")
+    if "operand_stats" not in columns:
+        conn.execute("ALTER TABLE rules ADD COLUMN operand_stats TEXT")
+    if "root_node" not in columns:
+        conn.execute("ALTER TABLE rules ADD COLUMN root_node INTEGER REFERENCES rule_nodes (id)")
+    create_node_table(conn)
+    for statement in GENERATION_SCHEMA:
+        conn.execute(statement)
+
+    # Rows written before rules were stored as binary node tables still hold JSON
+    rows = conn.execute("SELECT id, optimized_ast FROM rules WHERE typeof(optimized_ast) = 'text'").fetchall()
+    for rule_id, optimized_ast in rows:
+        conn.execute("UPDATE rules SET optimized_ast = ? WHERE id = ?", (dumps_tree(loads_tree(optimized_ast)), rule_id))
+
+    rows = conn.execute("SELECT id, ast FROM rules WHERE optimized_ast IS NULL").fetchall()
+    for rule_id, ast in rows:
+        conn.execute("UPDATE rules SET optimized_ast = ? WHERE id = ?", (dumps_tree(optimize_ast(loads_tree(ast))), rule_id))
+
+    # Rules written before the shared node store embed a full copy of their tree
+    rows = conn.execute("SELECT id, ast FROM rules WHERE root_node IS NULL AND ast IS NOT NULL").fetchall()
+    for rule_id, ast in rows:
+        conn.execute("UPDATE rules SET root_node = ?, ast = NULL WHERE id = ?", (store_tree(conn, loads_tree(ast)), rule_id))
+    conn.commit()
+
 def init_db():
     conn = sqlite3.connect(DATABASE_PATH)
+    # Switches the database file to WAL, which persists for every later connection
+    configure(conn)
     cursor = conn.cursor()
     
     cursor.execute('''
@@ -14,11 +65,15 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT UNIQUE,
             rule_string TEXT,
-            ast TEXT
+            ast BLOB,
+            optimized_ast BLOB,
+            operand_stats TEXT,
+            root_node INTEGER REFERENCES rule_nodes (id)
         )
     ''')
 
     conn.commit()
+    migrate_db(conn)
     conn.close()
     print("Database and table created successfully!")
 
@@ -0,0 +1,86 @@
+from fastapi import HTTPException
+import numpy as np
+from rule_compiler import AND, OR
+
+NUMERIC_TYPES = {int, float, bool}
+
+class Column:
+    """Values of one attribute across a batch: a mask of present (non-None) rows and a typed array of those values."""
+    __slots__ = ("present", "values")
+
+    def __init__(self, present, values):
+        self.present = present
+        self.values = values
+
+def build_column(values):
+    size = len(values)
+    kinds = set(map(type, values))
+    if type(None) in kinds:
+        present = np.fromiter((value is not None for value in values), dtype=bool, count=size)
+        values = [value for value in values if value is not None]
+        kinds.discard(type(None))
+    else:
+        present = np.ones(size, dtype=bool)
+
+    if kinds and kinds <= NUMERIC_TYPES:
+        try:
+            array = np.asarray(values)
+        except OverflowError:
+            array = np.asarray(values, dtype=object)
+    elif kinds == {str}:
+        array = np.asarray(values, dtype=str)
+    else:
+        # Mixed or non-scalar values fall back to per-element Python comparisons
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+    return Column(present, array)
+
+def records_to_columns(records, keys):
+    return {key: build_column([record.get(key) for record in records]) for key in keys}
+
+def lists_to_columns(columns, keys):
+    if not all(isinstance(values, list) for values in columns.values()):
+        raise HTTPException(status_code=400, detail="Every column must be a list of values.")
+    sizes = {len(values) for values in columns.values()}
+    if len(sizes) > 1:
+        raise HTTPException(status_code=400, detail="All columns must have the same length.")
+    size = sizes.pop() if sizes else 0
+    missing = [None] * size
+    return {key: build_column(columns.get(key, missing)) for key in keys}, size
+
+def operand_mask(operand, column, size):
+    mask = np.zeros(size, dtype=bool)
+    if column is None or not column.values.size:
+        return mask
+    try:
+        mask[column.present] = operand.compare(column.values, operand.literal)
+    except Exception:
+        # Some values cannot be compared with the literal; decide row by row as single evaluation does
+        mask[column.present] = [operand.matches(value) for value in column.values]
+    return mask
+
+def evaluate_batch(compiled, columns, size):
+    if not compiled.program:
+        return np.zeros(size, dtype=bool)
+
+    # Identical conditions inside one rule share a single array comparison
+    masks = {}
+    stack = []
+    for instruction in compiled.program:
+        if instruction is AND:
+            right = stack.pop()
+            stack[-1] = stack[-1] & right
+        elif instruction is OR:
+            right = stack.pop()
+            stack[-1] = stack[-1] | right
+        else:
+            signature = (instruction.key, instruction.operator, repr(instruction.literal))
+            mask = masks.get(signature)
+            if mask is None:
+                mask = operand_mask(instruction, columns.get(instruction.key), size)
+                masks[signature] = mask
+            stack.append(mask)
+    return stack[0]
+
+def referenced_keys(compiled):
+    return {operand.key for operand in compiled.operands()}
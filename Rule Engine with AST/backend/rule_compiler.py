@@ -0,0 +1,316 @@
+from fastapi import HTTPException
+from collections import OrderedDict
+from ast import literal_eval
+import operator
+from time import perf_counter_ns
+import threading
+import re
+
+COMPARISON_FUNCTIONS = {
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+CONDITION_PATTERN = re.compile(r'^\s*(\w+)\s*(<=|>=|!=|=|>|<)\s*(.+?)\s*$')
+
+class Connective:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+# Instructions of a compiled program: operands push a boolean, AND/OR pop two and push one
+AND = Connective("AND")
+OR = Connective("OR")
+
+class CompiledOperand:
+    __slots__ = ("condition", "key", "operator", "literal", "compare", "true_count", "false_count", "elapsed_ns")
+
+    def __init__(self, condition, key, operator_symbol, literal):
+        self.condition = condition
+        self.key = key
+        self.operator = operator_symbol
+        self.literal = literal
+        self.compare = COMPARISON_FUNCTIONS[operator_symbol]
+        self.true_count = 0
+        self.false_count = 0
+        # Only evaluate_timed adds to this
+        self.elapsed_ns = 0
+
+    def evaluate(self, data):
+        data_value = data.get(self.key)
+        if data_value is None:
+            return False
+        return self.matches(data_value)
+
+    def matches(self, data_value):
+        # A value that cannot be compared with the literal does not satisfy the condition, like a
+        # missing one. Every evaluation path shares this, so results never depend on operand order.
+        try:
+            return bool(self.compare(data_value, self.literal))
+        except Exception:
+            return False
+
+    def __repr__(self):
+        return f'CompiledOperand({self.key} {self.operator} {self.literal!r})'
+
+def compile_operand(condition):
+    match = CONDITION_PATTERN.match(condition)
+    if not match:
+        raise HTTPException(status_code=400, detail=f"Error evaluating condition: cannot parse '{condition}'")
+    key, operator_symbol, literal = match.groups()
+    try:
+        value = literal_eval(literal)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error evaluating condition: {str(e)}")
+    return CompiledOperand(condition, key, operator_symbol, value)
+
+class JumpIfFalse:
+    __slots__ = ("target",)
+
+    def __init__(self, target=None):
+        self.target = target
+
+class JumpIfTrue:
+    __slots__ = ("target",)
+
+    def __init__(self, target=None):
+        self.target = target
+
+class CompiledRule:
+    """A compiled rule in two equivalent forms.
+
+    program is a postfix list of operands and AND/OR instructions, used by the batch,
+    network and index consumers. code is a short-circuiting accumulator program where
+    each AND/OR child is followed by a conditional jump to the end of its group.
+    Every evaluation counts how often each reached operand was true or false.
+    keys holds the attributes the rule reads, sorted.
+    """
+    __slots__ = ("program", "code", "evaluations", "keys")
+
+    def __init__(self, program, code):
+        self.program = program
+        self.code = code
+        self.evaluations = 0
+        self.keys = tuple(sorted({instruction.key for instruction in program if instruction is not AND and instruction is not OR}))
+
+    def evaluate(self, data):
+        self.evaluations += 1
+        code = self.code
+        end = len(code)
+        value = False
+        position = 0
+        while position < end:
+            instruction = code[position]
+            instruction_type = type(instruction)
+            if instruction_type is JumpIfFalse:
+                if not value:
+                    position = instruction.target
+                    continue
+            elif instruction_type is JumpIfTrue:
+                if value:
+                    position = instruction.target
+                    continue
+            else:
+                value = instruction.evaluate(data)
+                if value:
+                    instruction.true_count += 1
+                else:
+                    instruction.false_count += 1
+            position += 1
+        return bool(value)
+
+    def evaluate_timed(self, data):
+        # evaluate() plus the time spent in each reached operand; kept separate so evaluate() pays nothing for it
+        self.evaluations += 1
+        code = self.code
+        end = len(code)
+        value = False
+        position = 0
+        while position < end:
+            instruction = code[position]
+            instruction_type = type(instruction)
+            if instruction_type is JumpIfFalse:
+                if not value:
+                    position = instruction.target
+                    continue
+            elif instruction_type is JumpIfTrue:
+                if value:
+                    position = instruction.target
+                    continue
+            else:
+                start = perf_counter_ns()
+                value = instruction.evaluate(data)
+                instruction.elapsed_ns += perf_counter_ns() - start
+                if value:
+                    instruction.true_count += 1
+                else:
+                    instruction.false_count += 1
+            position += 1
+        return bool(value)
+
+    def operands(self):
+        return [instruction for instruction in self.program if instruction is not AND and instruction is not OR]
+
+    def statistics(self):
+        operands = {}
+        for operand in self.operands():
+            counts = operands.setdefault(operand.condition, {"true": 0, "false": 0})
+            counts["true"] += operand.true_count
+            counts["false"] += operand.false_count
+        return {"evaluations": self.evaluations, "operands": operands}
+
+    def load_statistics(self, statistics):
+        # Counts are kept per condition, so an operand repeated in the tree carries the combined totals once
+        self.evaluations = statistics.get("evaluations", 0)
+        seen = set()
+        for operand in self.operands():
+            counts = statistics.get("operands", {}).get(operand.condition)
+            if counts and operand.condition not in seen:
+                operand.true_count = counts["true"]
+                operand.false_count = counts["false"]
+                seen.add(operand.condition)
+
+def describe(node):
+    """Return (node_type, value, children) for Node objects, legacy left/right dicts and n-ary dicts."""
+    if isinstance(node, dict):
+        node_type = node["node_type"]
+        if node_type != "operator":
+            return node_type, node["value"], ()
+        if "children" in node:
+            return node_type, node["value"], node["children"]
+        return node_type, node["value"], (node["left"], node["right"])
+    if node.node_type != "operator":
+        return node.node_type, node.value, ()
+    return node.node_type, node.value, (node.left, node.right)
+
+def prefix_items(root):
+    # Pre-order walk of a rule tree as (kind, payload, arity) items, the form emit() consumes
+    stack = [root]
+    while stack:
+        node_type, value, children = describe(stack.pop())
+        if node_type == "operand":
+            yield "operand", compile_operand(value), 0
+        elif node_type == "constant":
+            yield "constant", value, 0
+        elif value in ("AND", "OR"):
+            yield value, None, len(children)
+            stack.extend(reversed(children))
+        else:
+            raise HTTPException(status_code=400, detail=f"Unsupported operator: {value}")
+
+def emit(items):
+    """Compile a pre-order stream of (kind, payload, arity) items in one pass.
+
+    Operands carry their CompiledOperand, AND/OR their number of children, and a constant
+    (only ever a whole folded rule) its value.
+    """
+    program = []
+    code = []
+    # Open AND/OR groups: [connective, jump type, arity, finished children, pending jumps]
+    groups = []
+    for kind, payload, arity in items:
+        if kind == "constant":
+            # Only an always-false rule survives folding; an empty program evaluates to False everywhere
+            if payload:
+                raise HTTPException(status_code=400, detail="Rule is always true.")
+            return CompiledRule([], [])
+        if kind != "operand":
+            if kind == "AND":
+                groups.append([AND, JumpIfFalse, arity, 0, []])
+            else:
+                groups.append([OR, JumpIfTrue, arity, 0, []])
+            continue
+
+        program.append(payload)
+        code.append(payload)
+        # Close every group this operand was the last child of
+        while groups:
+            group = groups[-1]
+            group[3] += 1
+            if group[3] > 1:
+                program.append(group[0])
+            if group[3] < group[2]:
+                jump = group[1]()
+                code.append(jump)
+                group[4].append(jump)
+                break
+            for jump in group[4]:
+                jump.target = len(code)
+            groups.pop()
+
+    # Thread jumps that land on a jump of the same kind straight to its target. Targets always
+    # point forward, so walking backwards means the jump landed on is already fully threaded.
+    for instruction in reversed(code):
+        if type(instruction) in (JumpIfFalse, JumpIfTrue):
+            if instruction.target < len(code) and type(code[instruction.target]) is type(instruction):
+                instruction.target = code[instruction.target].target
+
+    return CompiledRule(program, code)
+
+def compile_ast(root):
+    """Compile a rule tree: Node objects, or stored/optimized trees decoded into dicts."""
+    if root is None:
+        return CompiledRule([], [])
+    return emit(prefix_items(root))
+
+# Optimized trees compile exactly like trees as written; the alias keeps call sites explicit
+compile_optimized_ast = compile_ast
+
+def compile_packed(packed):
+    """Compile a rule straight from its stored node table, without re-parsing any condition."""
+    return emit(packed.items())
+
+class RuleCache:
+    """Thread-safe LRU cache of compiled rules keyed by rule id."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, rule_id):
+        with self._lock:
+            compiled = self._entries.get(rule_id)
+            if compiled is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(rule_id)
+            self.hits += 1
+            return compiled
+
+    def put(self, rule_id, compiled):
+        with self._lock:
+            self._entries[rule_id] = compiled
+            self._entries.move_to_end(rule_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, rule_id):
+        with self._lock:
+            self._entries.pop(rule_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def items(self):
+        with self._lock:
+            return list(self._entries.items())
+
+    def __contains__(self, rule_id):
+        with self._lock:
+            return rule_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
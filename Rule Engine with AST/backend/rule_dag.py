@@ -0,0 +1,85 @@
+import json
+from rule_compiler import describe
+
+# Rule trees as written are kept in one shared, hash-consed node store: each distinct
+# (node_type, value, children) exists once, so a combined rule adds only its new AND nodes
+# and refers to the subtrees of its source rules by id instead of copying them.
+NODE_TABLE = '''
+    CREATE TABLE IF NOT EXISTS rule_nodes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        node_type TEXT NOT NULL,
+        value TEXT NOT NULL,
+        children TEXT NOT NULL,
+        UNIQUE (node_type, value, children)
+    )
+'''
+
+# Every node reachable from a root, each once however many parents share it
+REACHABLE_NODES = '''
+    WITH RECURSIVE reachable(id) AS (
+        SELECT ?
+        UNION
+        SELECT child.value FROM rule_nodes JOIN reachable ON rule_nodes.id = reachable.id, json_each(rule_nodes.children) AS child
+    )
+    SELECT id, node_type, value, children FROM rule_nodes WHERE id IN reachable
+'''
+
+def create_node_table(conn):
+    conn.execute(NODE_TABLE)
+
+def intern_node(conn, node_type, value, children=(), interned=None):
+    """Return the id of the node with this type, value and child ids, inserting it if it is new."""
+    key = (node_type, value, json.dumps(list(children)))
+    if interned is not None and key in interned:
+        return interned[key]
+    row = conn.execute("SELECT id FROM rule_nodes WHERE node_type = ? AND value = ? AND children = ?", key).fetchone()
+    node_id = row[0] if row else conn.execute(
+        "INSERT INTO rule_nodes (node_type, value, children) VALUES (?, ?, ?)", key).lastrowid
+    if interned is not None:
+        interned[key] = node_id
+    return node_id
+
+def store_tree(conn, root):
+    """Intern every node of a rule tree bottom-up and return the root's id."""
+    interned = {}
+    ids = []
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        node_type, value, children = describe(node)
+        if node_type != "operator":
+            ids.append(intern_node(conn, node_type, value, (), interned))
+        elif visited:
+            child_ids = ids[len(ids) - len(children):]
+            del ids[len(ids) - len(children):]
+            ids.append(intern_node(conn, node_type, value, child_ids, interned))
+        else:
+            stack.append((node, True))
+            for child in reversed(children):
+                stack.append((child, False))
+    return ids[0]
+
+def combine_nodes(conn, connective, node_ids):
+    """Join stored subtrees into a left-deep chain, as combine_ast does, without re-storing them."""
+    if not node_ids:
+        return None
+    interned = {}
+    root = node_ids[0]
+    for node_id in node_ids[1:]:
+        root = intern_node(conn, "operator", connective, (root, node_id), interned)
+    return root
+
+def load_tree(conn, root_id):
+    """Load a stored tree as nested n-ary dicts; shared subtrees become one shared dict."""
+    rows = conn.execute(REACHABLE_NODES, (root_id,)).fetchall()
+    if not rows:
+        return None
+    nodes = {}
+    children = {}
+    for node_id, node_type, value, child_ids in rows:
+        nodes[node_id] = {"node_type": node_type, "value": value}
+        if node_type == "operator":
+            children[node_id] = json.loads(child_ids)
+    for node_id, child_ids in children.items():
+        nodes[node_id]["children"] = [nodes[child_id] for child_id in child_ids]
+    return nodes[root_id]
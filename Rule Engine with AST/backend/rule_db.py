@@ -0,0 +1,100 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# WAL lets readers proceed while a writer commits, and busy_timeout makes writers wait for each
+# other instead of failing with "database is locked". journal_mode is stored in the database
+# file; the others apply per connection.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Compiled statements kept per connection; pooled connections keep them across requests
+CACHED_STATEMENTS = 256
+
+def configure(conn):
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+def connect(path, timeout=5):
+    conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False, cached_statements=CACHED_STATEMENTS)
+    conn.row_factory = sqlite3.Row
+    configure(conn)
+    return conn
+
+class ConnectionPool:
+    """Bounded pool of WAL-mode connections to one SQLite database, shared by request threads.
+
+    Connections are opened on demand up to size and reused afterwards, so each keeps its
+    prepared statement cache. connection() commits on success and rolls back on any error.
+    """
+
+    def __init__(self, path, size=8, timeout=5):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.created = 0
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool is closed.")
+            can_open = self.created < self.size
+            if can_open:
+                self.created += 1
+        if can_open:
+            try:
+                return connect(self.path, self.timeout)
+            except Exception:
+                with self._lock:
+                    self.created -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a database connection.") from None
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if not self._closed:
+                self._idle.put(conn)
+                return
+            self.created -= 1
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self.created -= 1
@@ -1,17 +1,206 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from starlette.responses import StreamingResponse, PlainTextResponse, JSONResponse, Response
 from pydantic import BaseModel
-import sqlite3
 import re
 import json
-
-app = FastAPI()
+import base64
+from typing import Optional
+from rule_compiler import RuleCache, compile_optimized_ast
+from rule_optimizer import optimize_ast, reorder_ast
+from rule_storage import dumps_tree, loads_tree, tree_to_postfix, compile_stored, is_packed
+from database_init import migrate_db, rules_generation
+from rule_dag import store_tree, combine_nodes, load_tree
+from rule_db import ConnectionPool
+from rule_batch import evaluate_batch, records_to_columns, lists_to_columns, referenced_keys
+from rule_network import RuleNetwork
+from rule_index import RuleIndex
+from rule_stream import evaluate_chunk
+from rule_metrics import Metrics, NULL_TIMER, node_families, render
+from rule_result_cache import ResultCache
+from rule_session import EvaluationSession
+from rule_store import SharedRuleStore
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, OrderedDict
+import multiprocessing
+import tempfile
+import asyncio
+import os
+import threading
+import queue
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app):
+    open_db_pool(DATABASE_PATH)
+    open_rule_store(DATABASE_PATH)
+    with db_connection() as conn:
+        migrate_db(conn)
+    # The first worker to start publishes the shared rule snapshot; the others attach to it
+    publish_rule_store(only_if_stale=True)
+    load_rule_matchers()
+    yield
+    close_stream_executor()
+    flush_rule_store()
+    close_rule_store()
+    close_db_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 DATABASE_PATH = "./database/rules.db"
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH, timeout=5)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Compiled rules keyed by rule id, so repeated evaluations skip the DB read, JSON decode and literal parsing
+rule_cache = RuleCache(maxsize=1024)
+
+# Opt-in cache of /evaluate_rule results keyed by rule, rule version and the record's referenced attributes,
+# for traffic that repeats identical records. Cached results skip evaluation, so they add no operand statistics.
+RESULT_CACHE_ENABLED = False
+result_cache = ResultCache(maxsize=65536, ttl=60.0)
+
+# Phase latencies of create_rule, evaluate_rule and combine_rules, served at /metrics. Disabled, the
+# endpoints get a no-op timer; metrics.node_timing additionally times every condition evaluate_rule reaches.
+metrics = Metrics(enabled=True, node_timing=False)
+
+# Evaluations of a rule between re-orderings of its AND/OR children from observed operand statistics.
+# Re-ordering runs on a background worker so it never adds a DB write to an evaluation request.
+REORDER_INTERVAL = 1000
+reorder_lock = threading.Lock()
+reorder_due = {}
+reorder_queue = queue.Queue()
+reorder_worker = None
+
+# Shared-predicate network and candidate index over all stored rules, loaded at startup and extended as rules are added
+rule_network = None
+rule_index = None
+rule_matchers_generation = None
+rule_matchers_lock = threading.Lock()
+# Rules this worker wrote before its matchers were built; the snapshot they are built from may not have them yet
+unmatched_written_rules = {}
+
+# Snapshot of every stored rule in a memory-mapped file shared by all worker processes. Compiling
+# from it needs no SQLite read, and its generation counter tells a worker about rules other workers added.
+rule_store = None
+rule_store_lock = threading.Lock()
+
+# A publish rewrites the whole snapshot, so rule writes only mark it stale and a background worker
+# republishes at most once per STORE_PUBLISH_INTERVAL seconds; a burst of writes shares one publish.
+# Until then this worker reads new rules from SQLite and other workers pick them up a little later.
+STORE_PUBLISH_INTERVAL = 0.5
+store_publish_pending = threading.Event()
+store_publisher = None
+store_publisher_lock = threading.Lock()
+store_publish_failures = 0
+
+# Incremental evaluation sessions by id, least recently used dropped first
+MAX_SESSIONS = 10000
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+
+# Streaming evaluation: records per chunk sent to a worker process, and chunks in flight per worker
+STREAM_WORKERS = os.cpu_count() or 1
+STREAM_CHUNK_SIZE = 5000
+STREAM_CHUNKS_PER_WORKER = 2
+STREAM_SPOOL_BYTES = 16 * 1024 * 1024
+STREAM_READ_SIZE = 64 * 1024
+stream_executor = None
+stream_executor_lock = threading.Lock()
+
+# Connections are pooled and reused across requests; the pool is opened once at startup
+DB_POOL_SIZE = 8
+db_pool = None
+db_pool_lock = threading.Lock()
+
+def open_db_pool(path):
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = ConnectionPool(path, size=DB_POOL_SIZE)
+        return db_pool
+
+def get_db_pool():
+    pool = db_pool
+    if pool is None:
+        raise RuntimeError("The database pool is not open; it is opened when the app starts.")
+    return pool
+
+def db_connection():
+    # Commits when the block succeeds, rolls back when it raises, and always returns the connection to the pool
+    return get_db_pool().connection()
+
+def close_db_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.close()
+            db_pool = None
+
+def open_rule_store(database_path):
+    global rule_store
+    with rule_store_lock:
+        if rule_store is None:
+            rule_store = SharedRuleStore(database_path)
+        return rule_store
+
+def get_rule_store():
+    store = rule_store
+    if store is None:
+        raise RuntimeError("The shared rule store is not open; it is opened when the app starts.")
+    return store
+
+def publish_rule_store(only_if_stale=False):
+    store = get_rule_store()
+    with store.publishing():
+        store.refresh()
+        with db_connection() as conn:
+            generation = rules_generation(conn)
+            if only_if_stale and store.rules_generation == generation:
+                return store
+            rows = conn.execute("SELECT id, optimized_ast, operand_stats FROM rules WHERE optimized_ast IS NOT NULL").fetchall()
+        store.publish([(row["id"], row["optimized_ast"], row["operand_stats"]) for row in rows], generation)
+    store.refresh()
+    return store
+
+def schedule_publish():
+    global store_publisher
+    store_publish_pending.set()
+    with store_publisher_lock:
+        if store_publisher is None:
+            store_publisher = threading.Thread(target=run_store_publisher, name="rule-store-publish", daemon=True)
+            store_publisher.start()
+
+def run_store_publisher():
+    global store_publish_failures
+    while True:
+        store_publish_pending.wait()
+        time.sleep(STORE_PUBLISH_INTERVAL)
+        # Writes made from here on set the flag again and get the next publish
+        store_publish_pending.clear()
+        try:
+            publish_rule_store()
+        except Exception:
+            # Other workers keep serving the previous snapshot; retried after the next interval
+            store_publish_failures += 1
+            logger.exception("Publishing the shared rule store failed")
+            store_publish_pending.set()
+
+def flush_rule_store():
+    # Publishes every write so far now, e.g. at shutdown, rather than waiting for the background worker.
+    # Unconditional once this worker has written, since a background publish may still be reading rows.
+    if store_publisher is not None:
+        store_publish_pending.clear()
+        publish_rule_store()
+
+def close_rule_store():
+    global rule_store
+    with rule_store_lock:
+        if rule_store is not None:
+            rule_store.close()
+            rule_store = None
 
 # Pydantic models for requests
 class RuleRequest(BaseModel):
@@ -22,11 +211,32 @@ class EvaluationRequest(BaseModel):
     rule_id: int
     data: dict
 
+class BatchEvaluationRequest(BaseModel):
+    rule_id: int
+    records: Optional[list] = None
+    columns: Optional[dict] = None
+
+class MatchRequest(BaseModel):
+    data: dict
+
+class MultiEvaluationRequest(BaseModel):
+    rule_ids: list[int]
+    data: dict
+
+class SessionRequest(BaseModel):
+    rule_ids: list[int]
+    data: dict
+
+class DeltaRequest(BaseModel):
+    delta: dict
+
 class CombineRulesRequest(BaseModel):
     rule_name: str
     rule_strings: list
 
 class Node:
+    __slots__ = ("node_type", "value", "left", "right")
+
     def __init__(self, node_type, value=None, left=None, right=None):
         self.node_type = node_type
         self.value = value
@@ -34,7 +244,19 @@ class Node:
         self.right = right
 
     def __repr__(self):
-        return f'Node(type={self.node_type}, value={self.value}, left={self.left}, right={self.right})'
+        # Built with an explicit stack so deep combined trees do not hit the recursion limit
+        parts = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif item is None:
+                parts.append('None')
+            else:
+                stack.extend((')', item.right, ', right=', item.left,
+                              f'Node(type={item.node_type}, value={item.value}, left='))
+        return ''.join(parts)
 
 # Helper functions for rule parsing and evaluation
 def validate_condition(condition):
@@ -87,18 +309,18 @@ def is_valid_rule(rule_string):
     if re.search(r'AND\s*AND|OR\s*OR', rule_string):
         raise HTTPException(status_code=400, detail="Invalid sequence of operators.")
 
-def evaluate_ast(node, data):
-    if node.node_type == "operand":
-        # Extract the operand's condition and evaluate it
+def evaluate_operand(node, data):
+    # Extract the operand's condition and evaluate it
+    try:
+        # The operand should be a condition in the form of "key operator value"
+        key, operator, value = node.value.split()
+        key = key.strip()
+        value = eval(value.strip())  # Evaluate value for numbers
+        data_value = data.get(key)
+        if data_value is None:
+            return False
+        # Perform the comparison based on the operator
         try:
-            # The operand should be a condition in the form of "key operator value"
-            key, operator, value = node.value.split()
-            key = key.strip()
-            value = eval(value.strip())  # Evaluate value for numbers
-            data_value = data.get(key)
-            if data_value is None:
-                return False
-            # Perform the comparison based on the operator
             if operator == '>':
                 return data_value > value
             elif operator == '<':
@@ -111,91 +333,460 @@ def evaluate_ast(node, data):
                 return data_value <= value
             elif operator == '!=':
                 return data_value != value
+        except TypeError:
+            # Values that cannot be compared with the literal do not satisfy the condition
+            return False
+        raise HTTPException(status_code=400, detail=f"Unsupported operator: {operator}")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Error evaluating condition: {str(e)}")
+
+def evaluate_ast(node, data):
+    # Post-order walk with an explicit stack, so deep combined rules do not hit the recursion limit
+    results = []
+    stack = [(node, False)]
+    while stack:
+        current, visited = stack.pop()
+        if current.node_type == "operand":
+            results.append(evaluate_operand(current, data))
+        elif visited:
+            right_eval = results.pop()
+            left_eval = results.pop()
+            if current.value == "AND":
+                results.append(left_eval and right_eval)
+            elif current.value == "OR":
+                results.append(left_eval or right_eval)
             else:
-                raise HTTPException(status_code=400, detail=f"Unsupported operator: {operator}")
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Error evaluating condition: {str(e)}")
-    elif node.node_type == "operator":
-        left_eval = evaluate_ast(node.left, data)
-        right_eval = evaluate_ast(node.right, data)
-        if node.value == "AND":
-            return left_eval and right_eval
-        elif node.value == "OR":
-            return left_eval or right_eval
-
-# Function to deserialize the AST
-def deserialize_ast(ast_dict):
-    if isinstance(ast_dict, dict):
-        node = Node(ast_dict['node_type'], ast_dict['value'])
-        node.left = deserialize_ast(ast_dict['left']) if 'left' in ast_dict else None
-        node.right = deserialize_ast(ast_dict['right']) if 'right' in ast_dict else None
-        return node
-    return None
+                results.append(None)
+        else:
+            stack.append((current, True))
+            stack.append((current.right, False))
+            stack.append((current.left, False))
+    return results[0]
+
+# Function to deserialize the AST, from the stored node table, a postfix list or the legacy nested dict
+def deserialize_ast(stored):
+    if is_packed(stored):
+        stored = loads_tree(stored)
+    if isinstance(stored, dict):
+        stored = tree_to_postfix(stored)
+    if not stored:
+        return None
+    stack = []
+    for item in stored:
+        if item["node_type"] != "operator":
+            stack.append(Node(item["node_type"], item["value"]))
+            continue
+        # n-ary operators from optimized trees become left-deep chains of binary nodes
+        arity = item.get("arity", 2)
+        children = stack[len(stack) - arity:]
+        del stack[len(stack) - arity:]
+        node = children[0]
+        for child in children[1:]:
+            node = Node("operator", value=item["value"], left=node, right=child)
+        stack.append(node)
+    return stack[0]
 
 # API Endpoints
 @app.post("/create_rule", status_code=201)
 def create_rule(rule_request: RuleRequest):
+    timer = metrics.timer("create_rule")
     rule_string = rule_request.rule_string
     is_valid_rule(rule_string)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Check if rule name already exists
-    cursor.execute("SELECT * FROM rules WHERE name = ?", (rule_request.rule_name,))
-    if cursor.fetchone() is not None:
-        raise HTTPException(status_code=400, detail="Rule name already exists.")
-    
-    ast = create_ast(rule_string)
-    cursor.execute("INSERT INTO rules (name, rule_string, ast) VALUES (?, ?, ?)",
-                   (rule_request.rule_name, rule_string, json.dumps(ast, default=lambda x: x.__dict__)))
-    
-    conn.commit()
-    conn.close()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Check if rule name already exists
+        cursor.execute("SELECT id FROM rules WHERE name = ?", (rule_request.rule_name,))
+        if cursor.fetchone() is not None:
+            raise HTTPException(status_code=400, detail="Rule name already exists.")
+        timer.mark("db_fetch")
+
+        ast = create_ast(rule_string)
+        optimized = optimize_ast(ast)
+        timer.mark("parse")
+        cursor.execute("INSERT INTO rules (name, rule_string, root_node, optimized_ast) VALUES (?, ?, ?, ?)",
+                       (rule_request.rule_name, rule_string, store_tree(conn, ast), dumps_tree(optimized)))
+
+    timer.mark("store")
+    invalidate_rule(cursor.lastrowid)
+    add_to_rule_matchers(cursor.lastrowid, optimized)
+    schedule_publish()
+    timer.mark("publish")
+    timer.done()
 
     return {"message": "Rule created successfully"}
 
+def load_written_tree(conn, rule):
+    # The tree as written lives in the shared node store; rows not yet migrated still embed it
+    if rule["root_node"] is not None:
+        return load_tree(conn, rule["root_node"])
+    return loads_tree(rule["ast"])
+
+def compile_stored_rule(rule):
+    if rule["optimized_ast"] is not None:
+        return compile_stored(rule["optimized_ast"])
+    return compile_optimized_ast(optimize_ast(loads_tree(rule["ast"])))
+
+def reorder_rule(rule_id, compiled):
+    # Works from a snapshot of the counters, so evaluations can continue on compiled meanwhile
+    statistics = compiled.statistics()
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT ast, root_node, optimized_ast FROM rules WHERE id = ?", (rule_id,))
+        rule = cursor.fetchone()
+        if not rule:
+            return compiled
+
+        current = loads_tree(rule["optimized_ast"]) if rule["optimized_ast"] is not None else optimize_ast(load_written_tree(conn, rule))
+        reordered = reorder_ast(current, statistics["operands"])
+        reordered_blob = dumps_tree(reordered)
+        cursor.execute("UPDATE rules SET optimized_ast = ?, operand_stats = ? WHERE id = ?",
+                       (reordered_blob, json.dumps(statistics), rule_id))
+
+    if reordered_blob == dumps_tree(current):
+        return compiled
+    recompiled = compile_optimized_ast(reordered)
+    # Carry over the counts gathered while the new order was being computed
+    recompiled.load_statistics(compiled.statistics())
+    rule_cache.put(rule_id, recompiled)
+    return recompiled
+
+def run_reorder_worker():
+    while True:
+        rule_id, compiled = reorder_queue.get()
+        try:
+            reorder_rule(rule_id, compiled)
+            # New workers start from the new orders once the publisher runs
+            schedule_publish()
+        except Exception:
+            pass  # A failed re-ordering leaves the current order in place; the next interval retries
+        finally:
+            reorder_queue.task_done()
+
+def schedule_reorder(rule_id, compiled):
+    global reorder_worker
+    evaluations = compiled.evaluations
+    due = reorder_due.get(rule_id)
+    if due is not None and evaluations < due:
+        return
+    with reorder_lock:
+        # Compare against a threshold rather than testing evaluations % REORDER_INTERVAL, so
+        # concurrent requests can neither skip an interval nor queue it twice
+        due = reorder_due.get(rule_id)
+        if due is None:
+            # First evaluation seen for this rule: the interval it falls in is still pending
+            previous = evaluations - 1
+            due = previous - previous % REORDER_INTERVAL + REORDER_INTERVAL
+        if evaluations < due:
+            reorder_due[rule_id] = due
+            return
+        reorder_due[rule_id] = evaluations - evaluations % REORDER_INTERVAL + REORDER_INTERVAL
+        if reorder_worker is None:
+            reorder_worker = threading.Thread(target=run_reorder_worker, name="rule-reorder", daemon=True)
+            reorder_worker.start()
+    reorder_queue.put((rule_id, compiled))
+
+def invalidate_rule(rule_id):
+    # Drops the compiled rule and moves cached results to a new rule version
+    rule_cache.invalidate(rule_id)
+    result_cache.invalidate_rule(rule_id)
+
+def get_compiled_rule(rule_id, timer=NULL_TIMER):
+    compiled = rule_cache.get(rule_id)
+    if compiled is not None:
+        timer.mark("cache_lookup")
+        return compiled
+
+    store = get_rule_store()
+    store.refresh()
+    stored = store.get(rule_id)
+    if stored is not None:
+        tree, statistics = stored
+        timer.mark("store_fetch")
+        compiled = compile_stored(tree)
+    else:
+        # Rules newer than the shared snapshot
+        with db_connection() as conn:
+            rule = conn.execute("SELECT ast, optimized_ast, operand_stats FROM rules WHERE id = ?", (rule_id,)).fetchone()
+
+        if not rule:
+            raise HTTPException(status_code=404, detail="Rule not found")
+        timer.mark("db_fetch")
+        compiled = compile_stored_rule(rule)
+        statistics = rule["operand_stats"]
+
+    if statistics is not None:
+        compiled.load_statistics(json.loads(statistics))
+    rule_cache.put(rule_id, compiled)
+    timer.mark("deserialize")
+    return compiled
+
+def load_rule_matchers():
+    global rule_network, rule_index, rule_matchers_generation
+    store = get_rule_store()
+    store.refresh()
+    if rule_network is not None and rule_matchers_generation == store.generation:
+        return rule_network, rule_index
+    if not store.generation:
+        store = publish_rule_store(only_if_stale=True)
+    with rule_matchers_lock:
+        warm = rule_network is None
+        if warm:
+            rule_network, rule_index = RuleNetwork(), RuleIndex()
+        # Adds the rules other workers published since the last check; add_rule skips known ones
+        for rule_id, tree, statistics in store.items():
+            if rule_id in rule_network:
+                continue
+            try:
+                compiled = compile_stored(tree)
+            except HTTPException:
+                continue  # Rules that cannot be compiled can never match
+            rule_network.add_rule(rule_id, compiled)
+            rule_index.add_rule(rule_id, compiled)
+            if warm and len(rule_cache) < rule_cache.maxsize and rule_id not in rule_cache:
+                # A freshly started worker serves its first evaluations from the cache
+                if statistics is not None:
+                    compiled.load_statistics(json.loads(statistics))
+                rule_cache.put(rule_id, compiled)
+        for rule_id, compiled in unmatched_written_rules.items():
+            if rule_id not in rule_network:
+                rule_network.add_rule(rule_id, compiled)
+                rule_index.add_rule(rule_id, compiled)
+        unmatched_written_rules.clear()
+        rule_matchers_generation = store.generation
+        return rule_network, rule_index
+
+def add_to_rule_matchers(rule_id, optimized):
+    try:
+        compiled = compile_optimized_ast(optimized)
+    except HTTPException:
+        return
+    add_compiled_to_rule_matchers(rule_id, compiled)
+
+def add_compiled_to_rule_matchers(rule_id, compiled):
+    with rule_matchers_lock:
+        if rule_network is None:
+            unmatched_written_rules[rule_id] = compiled
+        elif rule_id not in rule_network:
+            rule_network.add_rule(rule_id, compiled)
+            rule_index.add_rule(rule_id, compiled)
+
 @app.post("/evaluate_rule")
 def evaluate_rule(eval_request: EvaluationRequest):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM rules WHERE id = ?", (eval_request.rule_id,))
-    rule = cursor.fetchone()
-
-    if not rule:
-        raise HTTPException(status_code=404, detail="Rule not found")
-    
-    ast = deserialize_ast(json.loads(rule["ast"]))
-    data = eval_request.data
-    result = evaluate_ast(ast, data)
+    timer = metrics.timer("evaluate_rule")
+    compiled = get_compiled_rule(eval_request.rule_id, timer)
+    if RESULT_CACHE_ENABLED:
+        key = result_cache.key(eval_request.rule_id, compiled, eval_request.data)
+        result = result_cache.get(key)
+        if result is not None:
+            timer.mark("result_cache")
+            timer.done()
+            return {"evaluation_result": result}
+    if metrics.node_timing:
+        result = compiled.evaluate_timed(eval_request.data)
+    else:
+        result = compiled.evaluate(eval_request.data)
+    metrics.observe_rule(eval_request.rule_id, timer.mark("evaluate"))
+    if RESULT_CACHE_ENABLED:
+        result_cache.put(key, result)
+    schedule_reorder(eval_request.rule_id, compiled)
+    timer.done()
     
     return {"evaluation_result": result}
 
+@app.get("/rule_statistics/{rule_id}")
+def rule_statistics(rule_id: int):
+    compiled = get_compiled_rule(rule_id)
+    return {"rule_id": rule_id, **compiled.statistics()}
+
+@app.post("/evaluate_rule_batch")
+def evaluate_rule_batch(batch_request: BatchEvaluationRequest):
+    if (batch_request.records is None) == (batch_request.columns is None):
+        raise HTTPException(status_code=400, detail="Provide either records or columns.")
+
+    compiled = get_compiled_rule(batch_request.rule_id)
+    keys = referenced_keys(compiled)
+    if batch_request.records is not None:
+        if not all(isinstance(record, dict) for record in batch_request.records):
+            raise HTTPException(status_code=400, detail="Each record must be a JSON object.")
+        size = len(batch_request.records)
+        columns = records_to_columns(batch_request.records, keys)
+    else:
+        columns, size = lists_to_columns(batch_request.columns, keys)
+
+    results = evaluate_batch(compiled, columns, size)
+    return {"evaluation_results": results.tolist()}
+
+def get_stream_executor():
+    global stream_executor
+    with stream_executor_lock:
+        if stream_executor is None:
+            # Spawned workers import only the rule modules, not this app or its threads
+            stream_executor = ProcessPoolExecutor(max_workers=STREAM_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return stream_executor
+
+def close_stream_executor():
+    global stream_executor
+    with stream_executor_lock:
+        if stream_executor is not None:
+            stream_executor.shutdown(wait=False, cancel_futures=True)
+            stream_executor = None
+
+def stored_rule_tree(rule_id):
+    get_compiled_rule(rule_id)  # Reports missing or uncompilable rules before the stream starts
+    with db_connection() as conn:
+        rule = conn.execute("SELECT ast, root_node, optimized_ast FROM rules WHERE id = ?", (rule_id,)).fetchone()
+        if rule["optimized_ast"] is not None:
+            return rule["optimized_ast"]
+        return dumps_tree(optimize_ast(load_written_tree(conn, rule)))
+
+async def dispatch_chunks(stored, body, spool):
+    # Reads the body line by line and evaluates chunks of lines on the worker pool. Chunks that
+    # finish while the upload continues are written to the spool in input order, so memory holds
+    # at most the partial line, the chunk being filled and the chunks in flight.
+    loop = asyncio.get_running_loop()
+    executor = get_stream_executor()
+    max_pending = STREAM_WORKERS * STREAM_CHUNKS_PER_WORKER
+    pending = deque()
+    lines = []
+    buffer = b""
+    try:
+        async for data in body:
+            buffer += data
+            *complete, buffer = buffer.split(b"\n")
+            for line in complete:
+                if line.strip():
+                    lines.append(line)
+                if len(lines) >= STREAM_CHUNK_SIZE:
+                    pending.append(loop.run_in_executor(executor, evaluate_chunk, stored, lines))
+                    lines = []
+                    if len(pending) >= max_pending:
+                        spool.write(await pending.popleft())
+        if buffer.strip():
+            lines.append(buffer)
+        if lines:
+            pending.append(loop.run_in_executor(executor, evaluate_chunk, stored, lines))
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        raise
+    return pending
+
+async def stream_results(spool, pending):
+    try:
+        spool.seek(0)
+        while True:
+            data = spool.read(STREAM_READ_SIZE)
+            if not data:
+                break
+            yield data
+        while pending:
+            yield await pending.popleft()
+    finally:
+        spool.close()
+        for future in pending:
+            future.cancel()
+
+# Evaluates a rule against a newline-delimited JSON body of records, returning one result line per record in input order.
+# Most HTTP clients send the whole body before reading the response, so results produced during the upload are
+# spooled (in memory up to STREAM_SPOOL_BYTES, then on disk) and streamed once the body has been read.
+@app.post("/evaluate_rule_stream")
+async def evaluate_rule_stream(rule_id: int, request: Request):
+    stored = await run_in_threadpool(stored_rule_tree, rule_id)
+    spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_BYTES)
+    try:
+        pending = await dispatch_chunks(stored, request.stream(), spool)
+    except BaseException:
+        spool.close()
+        raise
+    return StreamingResponse(stream_results(spool, pending), media_type="application/x-ndjson")
+
+@app.post("/evaluate_rules")
+def evaluate_rules(multi_request: MultiEvaluationRequest):
+    # Rules sharing conditions or sub-expressions evaluate each shared node once for the record
+    network, _ = load_rule_matchers()
+    for rule_id in multi_request.rule_ids:
+        if rule_id not in network:
+            # Written after the snapshot the network was built from; get_compiled_rule reports missing or uncompilable rules
+            add_compiled_to_rule_matchers(rule_id, get_compiled_rule(rule_id))
+    matched = set(network.match(multi_request.data, multi_request.rule_ids))
+    return {"evaluation_results": [rule_id in matched for rule_id in multi_request.rule_ids]}
+
+@app.post("/match_rules")
+def match_rules(match_request: MatchRequest):
+    network, index = load_rule_matchers()
+    candidates = index.candidates(match_request.data)
+    return {"matching_rule_ids": network.match(match_request.data, candidates)}
+
+# A session keeps the value of every condition and AND/OR node of its rules for one record; deltas then
+# re-evaluate only the conditions on changed attributes and the nodes above them
+@app.post("/sessions", status_code=201)
+def create_session(session_request: SessionRequest):
+    rules = [(rule_id, get_compiled_rule(rule_id)) for rule_id in session_request.rule_ids]
+    session = EvaluationSession(rules, session_request.data)
+    session_id = uuid.uuid4().hex
+    with sessions_lock:
+        sessions[session_id] = session
+        while len(sessions) > MAX_SESSIONS:
+            sessions.popitem(last=False)
+    results = session.results()
+    return {"session_id": session_id, "evaluation_results": [results[rule_id] for rule_id in session_request.rule_ids]}
+
+def get_session(session_id):
+    with sessions_lock:
+        session = sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+        sessions.move_to_end(session_id)
+        return session
+
+@app.post("/sessions/{session_id}/delta")
+def update_session(session_id: str, delta_request: DeltaRequest):
+    flipped = get_session(session_id).update(delta_request.delta)
+    return {"flipped": [{"rule_id": rule_id, "evaluation_result": flipped[rule_id]} for rule_id in sorted(flipped)]}
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    with sessions_lock:
+        if sessions.pop(session_id, None) is None:
+            raise HTTPException(status_code=404, detail="Session not found")
+    return {"message": "Session deleted"}
+
 @app.post("/combine_rules", status_code=201)
 def combine_rules(combine_request: CombineRulesRequest):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    # Check if rule name already exists
-    cursor.execute("SELECT * FROM rules WHERE name = ?", (combine_request.rule_name,))
-    if cursor.fetchone() is not None:
-        raise HTTPException(status_code=400, detail="Combined rule name already exists.")
-
-    asts = []
-    for rule_string in combine_request.rule_strings:
-        is_valid_rule(rule_string)
-        ast = create_ast(rule_string)
-        asts.append(ast)
-
-    # Combine rules by creating a new AST
-    combined_ast = combine_ast(asts)
-
-    cursor.execute("INSERT INTO rules (name, rule_string, ast) VALUES (?, ?, ?)",
-                   (combine_request.rule_name, " AND ".join(combine_request.rule_strings), json.dumps(combined_ast, default=lambda x: x.__dict__)))
-    
-    conn.commit()
-    conn.close()
+    timer = metrics.timer("combine_rules")
+    with db_connection() as conn:
+        cursor = conn.cursor()
+
+        # Check if rule name already exists
+        cursor.execute("SELECT id FROM rules WHERE name = ?", (combine_request.rule_name,))
+        if cursor.fetchone() is not None:
+            raise HTTPException(status_code=400, detail="Combined rule name already exists.")
+        timer.mark("db_fetch")
+
+        roots = []
+        for rule_string in combine_request.rule_strings:
+            is_valid_rule(rule_string)
+            # Hash-consing finds the nodes of a source that is already stored, so nothing is written twice
+            roots.append(store_tree(conn, create_ast(rule_string)))
+
+        # Combine rules by joining their stored trees; only the new AND nodes are added to the node store
+        combined_root = combine_nodes(conn, "AND", roots)
+        timer.mark("store_sources")
+        combined = load_tree(conn, combined_root) if combined_root is not None else None
+        timer.mark("deserialize")
+        optimized = optimize_ast(combined)
+        timer.mark("optimize")
+        cursor.execute("INSERT INTO rules (name, rule_string, root_node, optimized_ast) VALUES (?, ?, ?, ?)",
+                       (combine_request.rule_name, " AND ".join(combine_request.rule_strings), combined_root, dumps_tree(optimized)))
+
+    timer.mark("store")
+    invalidate_rule(cursor.lastrowid)
+    add_to_rule_matchers(cursor.lastrowid, optimized)
+    schedule_publish()
+    timer.mark("publish")
+    timer.done()
 
     return {"message": "Rules combined successfully"}
 
@@ -209,21 +800,74 @@ def combine_ast(asts):
 
 # Debugging function to print AST
 def print_ast(node, level=0):
-    if node:
-        print(' ' * (level * 2) + repr(node))
-        print_ast(node.left, level + 1)
-        print_ast(node.right, level + 1)
+    stack = [(node, level)]
+    while stack:
+        current, depth = stack.pop()
+        if current:
+            print(' ' * (depth * 2) + repr(current))
+            stack.append((current.right, depth + 1))
+            stack.append((current.left, depth + 1))
+
+# Rule listing: pages of rules ordered by id, starting after after_id, with only the requested fields.
+# The ETag is the rules table generation, so a client holding the current listing gets a 304.
+LISTING_FIELDS = ("id", "name", "rule_string", "root_node", "ast")
+DEFAULT_LISTING_FIELDS = "id,name,rule_string"
+DEFAULT_LISTING_LIMIT = 100
+MAX_LISTING_LIMIT = 1000
 
 @app.get("/current_rules")
-def current_rules():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT * FROM rules")
-    rules = cursor.fetchall()
-    
-    conn.close()
-    return {"rules": [dict(rule) for rule in rules]}
+def current_rules(request: Request, after_id: int = 0, limit: int = DEFAULT_LISTING_LIMIT, fields: str = DEFAULT_LISTING_FIELDS):
+    fields = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in fields if field not in LISTING_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    if not 1 <= limit <= MAX_LISTING_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_LISTING_LIMIT}.")
+
+    with db_connection() as conn:
+        # Read before the rows: a rule added in between makes the listing newer than its ETag, never older
+        etag = f'"{rules_generation(conn)}"'
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        columns = ["id"] + [field for field in ("name", "rule_string", "root_node") if field in fields]
+        if "ast" in fields:
+            columns += ["ast", "root_node"]
+        rows = conn.execute(f"SELECT {', '.join(dict.fromkeys(columns))} FROM rules WHERE id > ? ORDER BY id LIMIT ?",
+                            (after_id, limit + 1)).fetchall()
+        rules = [encode_rule(conn, rule, fields) for rule in rows[:limit]]
+
+    next_after_id = rows[limit - 1]["id"] if len(rows) > limit else None
+    return JSONResponse({"rules": rules, "next_after_id": next_after_id}, headers={"ETag": etag})
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def encode_rule(conn, rule, fields=LISTING_FIELDS):
+    encoded = {key: rule[key] for key in fields if key != "ast"}
+    if "ast" in fields:
+        # The optimized tree and operand statistics are internal; the tree is sent as a base64-encoded binary node table
+        tree = load_written_tree(conn, rule) if rule["ast"] is not None or rule["root_node"] is not None else None
+        encoded["ast"] = base64.b64encode(dumps_tree(tree)).decode("ascii")
+    return encoded
+
+@app.get("/metrics")
+def get_metrics():
+    families = list(metrics.families())
+    families.append(("rule_engine_rule_cache_requests_total", "counter", "Compiled rule cache lookups by result.",
+                     [("rule_engine_rule_cache_requests_total", (("result", "hit"),), rule_cache.hits),
+                      ("rule_engine_rule_cache_requests_total", (("result", "miss"),), rule_cache.misses)]))
+    families.append(("rule_engine_result_cache_requests_total", "counter", "Evaluation result cache lookups by result.",
+                     [("rule_engine_result_cache_requests_total", (("result", "hit"),), result_cache.hits),
+                      ("rule_engine_result_cache_requests_total", (("result", "miss"),), result_cache.misses)]))
+    families.append(("rule_engine_result_cache_entries", "gauge", "Evaluation results currently cached.",
+                     [("rule_engine_result_cache_entries", (), len(result_cache))]))
+    families.append(("rule_engine_store_publish_failures_total", "counter", "Failed background publishes of the shared rule snapshot.",
+                     [("rule_engine_store_publish_failures_total", (), store_publish_failures)]))
+    families.extend(node_families(rule_cache.items(), metrics.node_timing))
+    return PlainTextResponse(render(families), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,203 @@
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from numbers import Number
+import math
+import threading
+from rule_compiler import AND, OR
+
+# Constraint a rule places on one attribute: if the rule is true, the attribute's value satisfies it.
+# ANY only requires the attribute to be present, since missing values make every operand false.
+ANY = ("any",)
+
+def is_number(value):
+    return isinstance(value, Number) and not isinstance(value, complex)
+
+def interval(lo=-math.inf, lo_strict=False, hi=math.inf, hi_strict=False):
+    return ("interval", lo, lo_strict, hi, hi_strict)
+
+def operand_constraint(operand):
+    literal = operand.literal
+    if operand.operator == '=':
+        try:
+            return ("values", frozenset([literal]))
+        except TypeError:
+            return ANY
+    if not is_number(literal):
+        return ANY
+    if operand.operator == '>':
+        return interval(lo=literal, lo_strict=True)
+    if operand.operator == '>=':
+        return interval(lo=literal)
+    if operand.operator == '<':
+        return interval(hi=literal, hi_strict=True)
+    if operand.operator == '<=':
+        return interval(hi=literal)
+    return ANY
+
+def intersect(first, second):
+    if first is ANY:
+        return second
+    if second is ANY:
+        return first
+    if first[0] == "values" and second[0] == "values":
+        return ("values", first[1] & second[1])
+    if first[0] == "interval" and second[0] == "interval":
+        _, lo1, lo_strict1, hi1, hi_strict1 = first
+        _, lo2, lo_strict2, hi2, hi_strict2 = second
+        lo, lo_strict = max((lo1, lo_strict1), (lo2, lo_strict2))
+        hi, hi_strict = min((hi1, not hi_strict1), (hi2, not hi_strict2))
+        return interval(lo, lo_strict, hi, not hi_strict)
+    # A value set is already a superset of its intersection with an interval
+    return first if first[0] == "values" else second
+
+def union(first, second):
+    if first is ANY or second is ANY:
+        return ANY
+    if first[0] == "values" and second[0] == "values":
+        return ("values", first[1] | second[1])
+    if first[0] == "values":
+        first, second = second, first
+    if second[0] == "values":
+        if not second[1] or not all(is_number(value) for value in second[1]):
+            return ANY
+        second = interval(min(second[1]), False, max(second[1]), False)
+    _, lo1, lo_strict1, hi1, hi_strict1 = first
+    _, lo2, lo_strict2, hi2, hi_strict2 = second
+    lo, lo_strict = min((lo1, lo_strict1), (lo2, lo_strict2))
+    hi, hi_strict = max((hi1, not hi_strict1), (hi2, not hi_strict2))
+    return interval(lo, lo_strict, hi, not hi_strict)
+
+def is_unsatisfiable(constraint):
+    if constraint is ANY:
+        return False
+    if constraint[0] == "values":
+        return not constraint[1]
+    _, lo, lo_strict, hi, hi_strict = constraint
+    return lo > hi or (lo == hi and (lo_strict or hi_strict))
+
+def rule_constraints(compiled):
+    stack = []
+    for instruction in compiled.program:
+        if instruction is AND:
+            right = stack.pop()
+            left = stack.pop()
+            merged = dict(left)
+            for key, constraint in right.items():
+                merged[key] = intersect(merged[key], constraint) if key in merged else constraint
+            stack.append(merged)
+        elif instruction is OR:
+            right = stack.pop()
+            left = stack.pop()
+            # Only attributes constrained on both sides are constrained by the disjunction
+            stack.append({key: union(left[key], right[key]) for key in left.keys() & right.keys()})
+        else:
+            stack.append({instruction.key: operand_constraint(instruction)})
+    return stack[0] if stack else {}
+
+class AttributeIndex:
+    """Rules constraining one attribute, bucketed for lookup by a record's value."""
+
+    def __init__(self):
+        self.present = set()
+        self.values = {}
+        self.lower = []      # (lo, lo_strict, rule_id) for intervals bounded below only
+        self.upper = []      # (hi, hi_strict, rule_id) for intervals bounded above only
+        self.bounded = []    # (lo, lo_strict, hi, hi_strict, rule_id) for intervals bounded on both sides
+        self.lower_keys = []
+        self.upper_keys = []
+        self.bounded_keys = []
+
+    def add(self, rule_id, constraint):
+        if constraint is ANY:
+            self.present.add(rule_id)
+        elif constraint[0] == "values":
+            for value in constraint[1]:
+                self.values.setdefault(value, set()).add(rule_id)
+        else:
+            _, lo, lo_strict, hi, hi_strict = constraint
+            if hi == math.inf:
+                position = bisect_right(self.lower_keys, lo)
+                self.lower_keys.insert(position, lo)
+                self.lower.insert(position, (lo, lo_strict, rule_id))
+            elif lo == -math.inf:
+                position = bisect_right(self.upper_keys, hi)
+                self.upper_keys.insert(position, hi)
+                self.upper.insert(position, (hi, hi_strict, rule_id))
+            else:
+                position = bisect_right(self.bounded_keys, lo)
+                self.bounded_keys.insert(position, lo)
+                self.bounded.insert(position, (lo, lo_strict, hi, hi_strict, rule_id))
+
+    def satisfied_by(self, value):
+        yield from self.present
+
+        try:
+            bucket = self.values.get(value, ())
+        except TypeError:
+            bucket = {rule_id for rules in self.values.values() for rule_id in rules}
+        yield from bucket
+
+        if not is_number(value) or value != value:
+            # Non-numeric or NaN values cannot be placed on the number line; let full evaluation decide
+            yield from (entry[-1] for entry in self.lower)
+            yield from (entry[-1] for entry in self.upper)
+            yield from (entry[-1] for entry in self.bounded)
+            return
+
+        end = bisect_right(self.lower_keys, value)
+        for lo, lo_strict, rule_id in self.lower[:end]:
+            if lo < value or not lo_strict:
+                yield rule_id
+
+        start = bisect_left(self.upper_keys, value)
+        for hi, hi_strict, rule_id in self.upper[start:]:
+            if hi > value or not hi_strict:
+                yield rule_id
+
+        end = bisect_right(self.bounded_keys, value)
+        for lo, lo_strict, hi, hi_strict, rule_id in self.bounded[:end]:
+            if (lo < value or not lo_strict) and (hi > value or (hi == value and not hi_strict)):
+                yield rule_id
+
+class RuleIndex:
+    """Prunes rules that cannot match a record using the attribute constraints implied by each rule.
+
+    candidates() always returns a superset of the matching rules; the caller still evaluates them.
+    """
+
+    def __init__(self):
+        self.attributes = {}
+        self.constraint_counts = {}
+        self.unconstrained = set()
+        self._lock = threading.Lock()
+
+    def add_rule(self, rule_id, compiled):
+        constraints = rule_constraints(compiled)
+        with self._lock:
+            if rule_id in self.constraint_counts:
+                # Adding twice would double the rule's hit count so it could never be a candidate
+                return
+            self.constraint_counts[rule_id] = len(constraints)
+            if not compiled.program:
+                return  # Rules folded to FALSE never match
+            if not constraints:
+                self.unconstrained.add(rule_id)
+            for key, constraint in constraints.items():
+                self.attributes.setdefault(key, AttributeIndex()).add(rule_id, constraint)
+
+    def __contains__(self, rule_id):
+        return rule_id in self.constraint_counts
+
+    def __len__(self):
+        return len(self.constraint_counts)
+
+    def candidates(self, data):
+        with self._lock:
+            hits = Counter()
+            for key, attribute_index in self.attributes.items():
+                value = data.get(key)
+                if value is not None:
+                    hits.update(attribute_index.satisfied_by(value))
+            candidates = set(self.unconstrained)
+            candidates.update(rule_id for rule_id, count in hits.items() if count == self.constraint_counts[rule_id])
+            return candidates
@@ -0,0 +1,153 @@
+import threading
+import time
+from bisect import bisect_left
+
+# Upper bounds in seconds; evaluations of cached rules take microseconds, DB writes milliseconds
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                   0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}" if labels else ""
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count", "_lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        index = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            yield f"{name}_bucket", labels + (("le", bound if bound == "+Inf" else repr(bound)),), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, count
+
+class PhaseTimer:
+    """Times consecutive phases of one request: mark(phase) records the time since the previous mark."""
+    __slots__ = ("metrics", "endpoint", "start", "last")
+
+    def __init__(self, metrics, endpoint):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self.last
+        self.last = now
+        self.metrics.observe(self.endpoint, phase, elapsed)
+        return elapsed
+
+    def done(self):
+        self.metrics.observe(self.endpoint, "total", time.perf_counter() - self.start)
+
+class NullTimer:
+    """Stands in for PhaseTimer while metrics are disabled, so instrumented code takes no timings."""
+    __slots__ = ()
+
+    def mark(self, phase):
+        return 0.0
+
+    def done(self):
+        pass
+
+NULL_TIMER = NullTimer()
+
+class Metrics:
+    """Request phase latency histograms and per-rule evaluation totals, rendered in Prometheus text format.
+
+    Only successful requests are recorded. node_timing switches evaluate_rule to the evaluator
+    that also times every condition; it is off by default because it times each node.
+    """
+
+    def __init__(self, enabled=True, node_timing=False):
+        self.enabled = enabled
+        self.node_timing = node_timing
+        self.histograms = {}
+        self.rule_evaluations = {}
+        self.rule_seconds = {}
+        self._lock = threading.Lock()
+
+    def timer(self, endpoint):
+        return PhaseTimer(self, endpoint) if self.enabled else NULL_TIMER
+
+    def observe(self, endpoint, phase, seconds):
+        key = (endpoint, phase)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(seconds)
+
+    def observe_rule(self, rule_id, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.rule_evaluations[rule_id] = self.rule_evaluations.get(rule_id, 0) + 1
+            self.rule_seconds[rule_id] = self.rule_seconds.get(rule_id, 0.0) + seconds
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.rule_evaluations.clear()
+            self.rule_seconds.clear()
+
+    def families(self):
+        # (name, type, help, samples) with samples as (sample name, label pairs, value)
+        with self._lock:
+            histograms = sorted(self.histograms.items())
+            evaluations = sorted(self.rule_evaluations.items())
+            seconds = sorted(self.rule_seconds.items())
+        yield ("rule_engine_request_phase_seconds", "histogram",
+               "Latency of API requests by endpoint and phase (db_fetch, deserialize, evaluate, ...).",
+               [sample for (endpoint, phase), histogram in histograms
+                for sample in histogram.samples("rule_engine_request_phase_seconds",
+                                                (("endpoint", endpoint), ("phase", phase)))])
+        yield ("rule_engine_rule_evaluations_total", "counter", "Evaluations of each rule through /evaluate_rule.",
+               [("rule_engine_rule_evaluations_total", (("rule_id", rule_id),), count) for rule_id, count in evaluations])
+        yield ("rule_engine_rule_evaluate_seconds_total", "counter", "Time spent evaluating each rule in /evaluate_rule.",
+               [("rule_engine_rule_evaluate_seconds_total", (("rule_id", rule_id),), total) for rule_id, total in seconds])
+
+def node_families(compiled_rules, node_timing):
+    """Per-condition counters for compiled rules, given as (rule_id, CompiledRule) pairs."""
+    hits = []
+    timings = []
+    for rule_id, compiled in compiled_rules:
+        for position, operand in enumerate(compiled.operands()):
+            labels = (("rule_id", rule_id), ("node", position), ("condition", operand.condition))
+            hits.append(("rule_engine_node_hits_total", labels + (("result", "true"),), operand.true_count))
+            hits.append(("rule_engine_node_hits_total", labels + (("result", "false"),), operand.false_count))
+            if node_timing:
+                timings.append(("rule_engine_node_seconds_total", labels, operand.elapsed_ns / 1e9))
+    yield ("rule_engine_node_hits_total", "counter", "Evaluations of each condition of a cached rule, by result.", hits)
+    if node_timing:
+        yield ("rule_engine_node_seconds_total", "counter", "Time spent evaluating each condition of a cached rule.", timings)
+
+def render(families):
+    lines = []
+    for name, metric_type, description, samples in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+    lines.append("")
+    return "\n".join(lines)
@@ -0,0 +1,131 @@
+import threading
+from rule_compiler import AND, OR
+
+class RuleNetwork:
+    """Discrimination network over every stored rule.
+
+    Identical conditions become one shared predicate node and identical AND/OR
+    combinations become one shared join node, so matching a record costs one
+    evaluation per distinct node rather than one per rule and tree position.
+    Comparisons that fail for a record's value types count as unsatisfied, as in CompiledOperand.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.predicate_ids = {}
+        self.predicates_by_key = {}
+        self.join_ids = {}
+        self.joins = []
+        self.terminals = {}
+        self._lock = threading.Lock()
+
+    def _predicate(self, operand):
+        signature = (operand.key, operand.operator, repr(operand.literal))
+        node_id = self.predicate_ids.get(signature)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(operand)
+            self.predicate_ids[signature] = node_id
+            self.predicates_by_key.setdefault(operand.key, []).append((node_id, operand))
+        return node_id
+
+    def _join(self, connective, left, right):
+        # AND/OR are commutative, so both operand orders share one node
+        signature = (connective, min(left, right), max(left, right))
+        node_id = self.join_ids.get(signature)
+        if node_id is None:
+            node_id = len(self.nodes)
+            join = (connective is AND, left, right)
+            self.nodes.append(join)
+            self.join_ids[signature] = node_id
+            self.joins.append((node_id,) + join)
+        return node_id
+
+    def add_rule(self, rule_id, compiled):
+        with self._lock:
+            if rule_id in self.terminals:
+                return
+            stack = []
+            for instruction in compiled.program:
+                if instruction is AND or instruction is OR:
+                    right = stack.pop()
+                    left = stack.pop()
+                    stack.append(self._join(instruction, left, right))
+                else:
+                    stack.append(self._predicate(instruction))
+            self.terminals[rule_id] = stack[0] if stack else None
+
+    def __contains__(self, rule_id):
+        return rule_id in self.terminals
+
+    def __len__(self):
+        return len(self.terminals)
+
+    def match(self, data, rule_ids=None):
+        """Return the sorted ids of matching rules, optionally restricted to the given candidate ids."""
+        with self._lock:
+            if rule_ids is None:
+                return self._match_all(data)
+            values = {}
+            matched = []
+            for rule_id in rule_ids:
+                terminal = self.terminals.get(rule_id)
+                if terminal is not None and self._evaluate_node(terminal, data, values):
+                    matched.append(rule_id)
+            return sorted(matched)
+
+    def _match_all(self, data):
+        values = [False] * len(self.nodes)
+        for key, predicates in self.predicates_by_key.items():
+            data_value = data.get(key)
+            if data_value is None:
+                continue
+            for node_id, operand in predicates:
+                values[node_id] = operand.matches(data_value)
+
+        # Joins were created after their inputs, so list order is a valid evaluation order
+        for node_id, is_and, left, right in self.joins:
+            if is_and:
+                values[node_id] = values[left] and values[right]
+            else:
+                values[node_id] = values[left] or values[right]
+
+        return sorted(rule_id for rule_id, terminal in self.terminals.items()
+                      if terminal is not None and values[terminal])
+
+    def _evaluate_node(self, node_id, data, values):
+        # Memoized, short-circuiting walk over only the nodes reachable from one terminal
+        stack = [node_id]
+        while stack:
+            current = stack[-1]
+            if current in values:
+                stack.pop()
+                continue
+            node = self.nodes[current]
+            if type(node) is tuple:
+                is_and, left, right = node
+                left_value = values.get(left)
+                if left_value is None:
+                    stack.append(left)
+                    continue
+                if left_value is not is_and:
+                    values[current] = left_value
+                    stack.pop()
+                    continue
+                right_value = values.get(right)
+                if right_value is None:
+                    stack.append(right)
+                    continue
+                values[current] = right_value
+            else:
+                data_value = data.get(node.key)
+                values[current] = False if data_value is None else node.matches(data_value)
+            stack.pop()
+        return values[node_id]
+
+    def stats(self):
+        return {
+            "rules": len(self.terminals),
+            "predicates": len(self.predicate_ids),
+            "joins": len(self.joins),
+        }
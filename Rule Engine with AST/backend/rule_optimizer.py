@@ -0,0 +1,178 @@
+from fastapi import HTTPException
+from rule_compiler import compile_operand, describe
+from rule_index import operand_constraint, intersect, is_unsatisfiable
+
+# Static estimates of how often an operand is true, used until live statistics exist
+SELECTIVITY = {'=': 0.1, '!=': 0.9, '>': 0.5, '<': 0.5, '>=': 0.5, '<=': 0.5}
+DEFAULT_SELECTIVITY = 0.5
+
+# Observations an operand needs before its live true rate replaces the static estimate
+MIN_OBSERVATIONS = 100
+
+FALSE = {"node_type": "constant", "value": False}
+TRUE = {"node_type": "constant", "value": True}
+
+class Optimized:
+    """An optimized subtree with its canonical signature, evaluation cost and probability of being true."""
+    __slots__ = ("node", "signature", "cost", "probability", "operand", "children")
+
+    def __init__(self, node, signature, cost, probability, operand=None, children=()):
+        self.node = node
+        self.signature = signature
+        self.cost = cost
+        self.probability = probability
+        self.operand = operand
+        self.children = children
+
+def optimize_operand(condition):
+    try:
+        operand = compile_operand(condition)
+    except HTTPException:
+        # Leave conditions that cannot be compiled as written; evaluation reports the error
+        return Optimized({"node_type": "operand", "value": condition}, ("operand", condition), 1, DEFAULT_SELECTIVITY)
+    signature = ("operand", operand.key, operand.operator, repr(operand.literal))
+    return Optimized({"node_type": "operand", "value": condition}, signature, 1, SELECTIVITY[operand.operator], operand)
+
+def constant(value):
+    return Optimized(TRUE if value else FALSE, ("constant", value), 0, 1.0 if value else 0.0)
+
+def contradicts(children):
+    constraints = {}
+    for child in children:
+        if child.operand is None:
+            continue
+        key = child.operand.key
+        constraint = operand_constraint(child.operand)
+        constraints[key] = intersect(constraints[key], constraint) if key in constraints else constraint
+        if is_unsatisfiable(constraints[key]):
+            return True
+    return False
+
+def short_circuit_rank(child, connective):
+    # Expected cost per short-circuit: AND stops on false, OR stops on true
+    stop_probability = 1 - child.probability if connective == "AND" else child.probability
+    return child.cost / stop_probability if stop_probability > 0 else float("inf")
+
+def optimize_operator(connective, children):
+    flattened = []
+    for child in children:
+        if child.node["node_type"] == "operator" and child.node["value"] == connective:
+            flattened.extend(child.children)
+        else:
+            flattened.append(child)
+
+    absorbing = connective == "OR"
+    unique = {}
+    for child in flattened:
+        if child.signature[0] == "constant":
+            if child.signature[1] == absorbing:
+                return constant(absorbing)
+            continue
+        unique.setdefault(child.signature, child)
+    children = list(unique.values())
+
+    if connective == "AND" and contradicts(children):
+        return constant(False)
+    if not children:
+        return constant(not absorbing)
+    if len(children) == 1:
+        return children[0]
+
+    signature = (connective, frozenset(child.signature for child in children))
+    return order_children(connective, children, signature)
+
+def order_children(connective, children, signature=None):
+    children.sort(key=lambda child: short_circuit_rank(child, connective))
+
+    # A child is only reached while every earlier child failed to short-circuit
+    cost = 0.0
+    reach = 1.0
+    for child in children:
+        cost += reach * child.cost
+        reach *= child.probability if connective == "AND" else 1 - child.probability
+    probability = reach if connective == "AND" else 1 - reach
+
+    node = {"node_type": "operator", "value": connective, "children": [child.node for child in children]}
+    return Optimized(node, signature, cost, probability, children=children)
+
+def flatten_children(node, connective):
+    # Collect the children of a whole same-operator chain up front, so a left-deep chain of
+    # combined rules becomes one n-ary node in a single linear pass
+    flattened = []
+    pending = [node]
+    while pending:
+        current = pending.pop()
+        node_type, value, children = describe(current)
+        if node_type == "operator" and value == connective:
+            pending.extend(reversed(children))
+        else:
+            flattened.append(current)
+    return flattened
+
+def optimize_ast(root):
+    """Return the optimized, n-ary form of a rule tree as nested dicts.
+
+    Nested AND/OR chains are flattened, duplicate children removed, contradictory
+    conjunctions and constant children folded, and each node's children ordered
+    so the cheapest, most likely to short-circuit child is evaluated first.
+    """
+    if root is None:
+        return FALSE
+
+    results = []
+    stack = [(root, None)]
+    while stack:
+        node, connective = stack.pop()
+        if connective is not None:
+            # Every child of this operator has been optimized; node holds how many there are
+            optimized_children = results[-node:]
+            del results[-node:]
+            results.append(optimize_operator(connective, optimized_children))
+            continue
+        node_type, value, children = describe(node)
+        if node_type == "operand":
+            results.append(optimize_operand(value))
+        elif node_type == "constant":
+            results.append(constant(value))
+        else:
+            children = flatten_children(node, value)
+            stack.append((len(children), value))
+            for child in reversed(children):
+                stack.append((child, None))
+    return results[0].node
+
+def observed_probability(condition, statistics):
+    counts = statistics.get(condition)
+    if counts:
+        observations = counts["true"] + counts["false"]
+        if observations >= MIN_OBSERVATIONS:
+            return (counts["true"] + 1) / (observations + 2)
+    return optimize_operand(condition).probability
+
+def reorder_ast(optimized, statistics):
+    """Reorder the children of every AND/OR node of an optimized AST using observed operand true rates.
+
+    statistics maps each condition to its {"true": n, "false": n} counts. Only the order of
+    children changes, and an operand that cannot be compared is false rather than an error
+    whether or not it is reached, so the rule's result is the same for every record. The sort
+    is stable, so children whose estimates tie keep their current order.
+    """
+    results = []
+    stack = [(optimized, False)]
+    while stack:
+        node, visited = stack.pop()
+        node_type, value, children = describe(node)
+        if node_type == "operand":
+            results.append(Optimized(node, None, 1, observed_probability(value, statistics)))
+        elif node_type == "constant":
+            results.append(constant(value))
+        elif visited:
+            count = len(children)
+            ordered = results[-count:]
+            del results[-count:]
+            results.append(order_children(value, ordered))
+        else:
+            stack.append((node, True))
+            for child in reversed(children):
+                stack.append((child, False))
+    return results[0].node
@@ -0,0 +1,85 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+def fingerprint(data, keys):
+    """Canonical form of the attributes a rule references, usable as a dict key.
+
+    Attributes outside keys are ignored, so unrelated fields never cause a miss. A missing
+    attribute and None are the same: both fail every condition. Values that compare equal
+    (1, 1.0 and True) share an entry, since every comparison treats them alike; unhashable
+    values are keyed by their sorted JSON form.
+    """
+    values = tuple(map(data.get, keys))
+    try:
+        hash(values)
+        return values
+    except TypeError:
+        return tuple(value if is_hashable(value) else ("json", json.dumps(value, sort_keys=True, default=repr))
+                     for value in values)
+
+def is_hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+class ResultCache:
+    """LRU cache of evaluation results keyed by (rule id, rule version, record fingerprint).
+
+    invalidate_rule bumps the rule's version, so results computed for the old rule can no
+    longer be found; they age out through the size bound or their TTL.
+    """
+
+    def __init__(self, maxsize=65536, ttl=60.0, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.versions = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def key(self, rule_id, compiled, data):
+        return rule_id, self.versions.get(rule_id, 0), fingerprint(data, compiled.keys)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires = entry
+                if expires > self.clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            if key[1] != self.versions.get(key[0], 0):
+                return  # The rule changed while this result was being computed
+            self._entries[key] = (result, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_rule(self, rule_id):
+        with self._lock:
+            self.versions[rule_id] = self.versions.get(rule_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,91 @@
+import heapq
+import threading
+from rule_network import RuleNetwork
+
+class EvaluationSession:
+    """Truth values of every condition and AND/OR node of a set of rules for one record.
+
+    The rules share one RuleNetwork, so a condition used by several rules is one node. update()
+    re-evaluates only the conditions on changed attributes and the joins above the nodes whose
+    value changed, and reports the rules whose outcome flipped, so an update costs the affected
+    paths rather than the size of every rule.
+    """
+
+    def __init__(self, rules, data):
+        self.network = RuleNetwork()
+        for rule_id, compiled in rules:
+            self.network.add_rule(rule_id, compiled)
+        self.parents = [[] for _ in self.network.nodes]
+        for node_id, _, left, right in self.network.joins:
+            self.parents[left].append(node_id)
+            if right != left:
+                self.parents[right].append(node_id)
+        self.rules_by_terminal = {}
+        for rule_id, terminal in self.network.terminals.items():
+            if terminal is not None:
+                self.rules_by_terminal.setdefault(terminal, []).append(rule_id)
+        self.data = {key: value for key, value in data.items() if value is not None}
+        self.values = self._evaluate_all()
+        self._lock = threading.Lock()
+
+    def _evaluate_all(self):
+        values = [False] * len(self.network.nodes)
+        for predicates in self.network.predicates_by_key.values():
+            for node_id, operand in predicates:
+                values[node_id] = operand.evaluate(self.data)
+        # Joins were created after their inputs, so list order is a valid evaluation order
+        for node_id, is_and, left, right in self.network.joins:
+            values[node_id] = values[left] and values[right] if is_and else values[left] or values[right]
+        return values
+
+    def results(self):
+        with self._lock:
+            return {rule_id: terminal is not None and self.values[terminal]
+                    for rule_id, terminal in self.network.terminals.items()}
+
+    def update(self, delta):
+        """Apply changed attributes (None removes one) and return {rule_id: new result} for the rules that flipped."""
+        nodes = self.network.nodes
+        with self._lock:
+            values = self.values
+            changed = []
+            # Node ids grow from inputs to the joins above them, so taking the smallest pending id
+            # first recomputes each join once, after all of its changed inputs
+            pending = []
+            queued = set()
+
+            def changed_to(node_id, result):
+                values[node_id] = result
+                changed.append(node_id)
+                for parent in self.parents[node_id]:
+                    if parent not in queued:
+                        queued.add(parent)
+                        heapq.heappush(pending, parent)
+
+            for key, value in delta.items():
+                current = self.data.get(key)
+                if value is None:
+                    if current is None:
+                        continue
+                    del self.data[key]
+                elif type(current) is type(value) and current == value:
+                    continue
+                else:
+                    self.data[key] = value
+                for node_id, operand in self.network.predicates_by_key.get(key, ()):
+                    result = operand.evaluate(self.data)
+                    if result != values[node_id]:
+                        changed_to(node_id, result)
+
+            while pending:
+                node_id = heapq.heappop(pending)
+                is_and, left, right = nodes[node_id]
+                result = values[left] and values[right] if is_and else values[left] or values[right]
+                if result != values[node_id]:
+                    changed_to(node_id, result)
+
+            flipped = {}
+            for node_id in changed:
+                for rule_id in self.rules_by_terminal.get(node_id, ()):
+                    flipped[rule_id] = values[node_id]
+            return flipped
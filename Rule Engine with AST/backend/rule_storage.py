@@ -0,0 +1,230 @@
+import json
+import struct
+from ast import literal_eval
+from fastapi import HTTPException
+from rule_compiler import COMPARISON_FUNCTIONS, CompiledOperand, compile_operand, compile_optimized_ast, compile_packed, describe
+
+# Rule trees are stored as a compact binary node table (BLOB):
+#   header    magic, version, string count, literal count, node count
+#   strings   each distinct condition, attribute key or literal string once, length-prefixed UTF-8
+#   literals  each distinct pre-parsed literal once, as a type tag and its value
+#   nodes     fixed-size records in pre-order, so a rule compiles in one forward pass
+# Decoding is one pass over one buffer and builds no per-node dicts. Rows written by older
+# versions as JSON (flat postfix lists or nested dicts) are still read; migrate_db converts them.
+
+MAGIC = b"RAST"
+VERSION = 1
+HEADER = struct.Struct("<4sBIII")
+LENGTH = struct.Struct("<I")
+# kind, code, condition string, key string, literal: operand code is the comparison operator,
+# operator code is 0 for AND and 1 for OR with its arity in the condition field, constant code is its value
+NODE = struct.Struct("<BBIII")
+
+OPERAND, OPERATOR, CONSTANT = 0, 1, 2
+CONNECTIVES = ("AND", "OR")
+OPERATORS = tuple(COMPARISON_FUNCTIONS)
+# Operand code for conditions that do not compile; they are kept as written and report their error when compiled
+UNPARSED = 255
+
+INT64 = struct.Struct("<q")
+FLOAT64 = struct.Struct("<d")
+
+class PackedTree:
+    """A decoded node table: interned strings, pre-parsed literals and pre-order node tuples."""
+    __slots__ = ("strings", "literals", "nodes")
+
+    def __init__(self, strings, literals, nodes):
+        self.strings = strings
+        self.literals = literals
+        self.nodes = nodes
+
+    def items(self):
+        strings = self.strings
+        literals = self.literals
+        for kind, code, condition, key, literal in self.nodes:
+            if kind == OPERAND:
+                if code == UNPARSED:
+                    yield "operand", compile_operand(strings[condition]), 0
+                else:
+                    yield "operand", CompiledOperand(strings[condition], strings[key], OPERATORS[code], literals[literal]), 0
+            elif kind == OPERATOR:
+                yield CONNECTIVES[code], None, condition
+            else:
+                yield "constant", bool(code), 0
+
+class Packer:
+    def __init__(self):
+        self.strings = {}
+        self.literals = {}
+        self.literal_data = []
+        self.nodes = []
+
+    def string(self, text):
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.strings)
+        return index
+
+    def literal(self, value):
+        signature = (type(value), repr(value))
+        index = self.literals.get(signature)
+        if index is not None:
+            return index
+        if type(value) is bool:
+            data = b"b" + bytes([value])
+        elif type(value) is int and -2**63 <= value < 2**63:
+            data = b"i" + INT64.pack(value)
+        elif type(value) is float:
+            data = b"f" + FLOAT64.pack(value)
+        elif type(value) is str:
+            data = b"s" + LENGTH.pack(self.string(value))
+        elif value is None:
+            data = b"n"
+        else:
+            # Big integers, tuples and other literals keep their source form
+            data = b"r" + LENGTH.pack(self.string(repr(value)))
+        index = self.literals[signature] = len(self.literal_data)
+        self.literal_data.append(data)
+        return index
+
+    def add(self, node_type, value, arity):
+        if node_type == "operator":
+            if value not in CONNECTIVES:
+                raise HTTPException(status_code=400, detail=f"Unsupported operator: {value}")
+            self.nodes.append(NODE.pack(OPERATOR, CONNECTIVES.index(value), arity, 0, 0))
+        elif node_type == "constant":
+            self.nodes.append(NODE.pack(CONSTANT, int(bool(value)), 0, 0, 0))
+        else:
+            try:
+                operand = compile_operand(value)
+            except HTTPException:
+                self.nodes.append(NODE.pack(OPERAND, UNPARSED, self.string(value), 0, 0))
+                return
+            self.nodes.append(NODE.pack(OPERAND, OPERATORS.index(operand.operator), self.string(value),
+                                        self.string(operand.key), self.literal(operand.literal)))
+
+    def pack(self):
+        parts = [HEADER.pack(MAGIC, VERSION, len(self.strings), len(self.literal_data), len(self.nodes))]
+        for text in self.strings:
+            encoded = text.encode("utf-8")
+            parts.append(LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+        parts.extend(self.literal_data)
+        parts.extend(self.nodes)
+        return b"".join(parts)
+
+def dumps_tree(root):
+    """Encode a rule tree (Node objects or dicts) as a binary node table."""
+    packer = Packer()
+    if root is not None:
+        stack = [root]
+        while stack:
+            node_type, value, children = describe(stack.pop())
+            packer.add(node_type, value, len(children))
+            stack.extend(reversed(children))
+    return packer.pack()
+
+def load_packed(blob):
+    view = memoryview(blob)
+    magic, version, string_count, literal_count, node_count = HEADER.unpack_from(view)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a packed rule tree.")
+    offset = HEADER.size
+
+    strings = []
+    for _ in range(string_count):
+        length, = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        strings.append(str(view[offset:offset + length], "utf-8"))
+        offset += length
+
+    literals = []
+    for _ in range(literal_count):
+        tag = view[offset]
+        offset += 1
+        if tag == ord("i"):
+            value, = INT64.unpack_from(view, offset)
+            offset += INT64.size
+        elif tag == ord("f"):
+            value, = FLOAT64.unpack_from(view, offset)
+            offset += FLOAT64.size
+        elif tag == ord("b"):
+            value = bool(view[offset])
+            offset += 1
+        elif tag == ord("n"):
+            value = None
+        else:
+            index, = LENGTH.unpack_from(view, offset)
+            offset += LENGTH.size
+            value = strings[index] if tag == ord("s") else literal_eval(strings[index])
+        literals.append(value)
+
+    nodes = list(NODE.iter_unpack(view[offset:offset + node_count * NODE.size]))
+    return PackedTree(strings, literals, nodes)
+
+def is_packed(stored):
+    return isinstance(stored, (bytes, bytearray, memoryview)) and bytes(stored[:4]) == MAGIC
+
+def tree_to_postfix(root):
+    postfix = []
+    if root is None:
+        return postfix
+    stack = [(root, False)]
+    while stack:
+        node, visited = stack.pop()
+        node_type, value, children = describe(node)
+        if node_type != "operator":
+            postfix.append({"node_type": node_type, "value": value})
+        elif visited:
+            item = {"node_type": "operator", "value": value}
+            if len(children) != 2:
+                item["arity"] = len(children)
+            postfix.append(item)
+        else:
+            stack.append((node, True))
+            for child in reversed(children):
+                stack.append((child, False))
+    return postfix
+
+def postfix_to_tree(postfix):
+    stack = []
+    for item in postfix:
+        if item["node_type"] != "operator":
+            stack.append({"node_type": item["node_type"], "value": item["value"]})
+            continue
+        arity = item.get("arity", 2)
+        children = stack[len(stack) - arity:]
+        del stack[len(stack) - arity:]
+        stack.append({"node_type": "operator", "value": item["value"], "children": children})
+    return stack[0] if stack else None
+
+def packed_to_tree(packed):
+    # Walking pre-order nodes backwards completes every child before its parent
+    stack = []
+    strings = packed.strings
+    for kind, code, condition, _, _ in reversed(packed.nodes):
+        if kind == OPERAND:
+            stack.append({"node_type": "operand", "value": strings[condition]})
+        elif kind == CONSTANT:
+            stack.append({"node_type": "constant", "value": bool(code)})
+        else:
+            children = stack[len(stack) - condition:]
+            del stack[len(stack) - condition:]
+            children.reverse()
+            stack.append({"node_type": "operator", "value": CONNECTIVES[code], "children": children})
+    return stack[0] if stack else None
+
+def loads_tree(stored):
+    """Decode a stored tree into nested n-ary dicts, accepting the older JSON formats too."""
+    if is_packed(stored):
+        return packed_to_tree(load_packed(stored))
+    decoded = json.loads(stored)
+    if isinstance(decoded, list):
+        return postfix_to_tree(decoded)
+    return postfix_to_tree(tree_to_postfix(decoded)) if decoded is not None else None
+
+def compile_stored(stored):
+    """Compile a stored tree, straight from the node table when it is in the binary format."""
+    if is_packed(stored):
+        return compile_packed(load_packed(stored))
+    return compile_optimized_ast(loads_tree(stored))
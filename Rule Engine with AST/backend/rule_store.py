@@ -0,0 +1,164 @@
+import glob
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: publishers are not serialized across processes
+    fcntl = None
+
+# A read-only snapshot of every rule's stored tree and operand statistics, shared by all worker
+# processes through the page cache. Each publish writes a new snapshot file, named by its
+# generation, and then bumps an 8-byte generation counter that every worker keeps mapped; a
+# worker notices a new snapshot by reading that counter, without touching SQLite.
+#
+#   header   magic, version, store generation, rules-table generation it was built from, rule count
+#   entries  (rule id, data offset, tree length, statistics length), sorted by rule id
+#   data     each rule's binary node table followed by its statistics JSON
+
+MAGIC = b"RSTR"
+VERSION = 1
+HEADER = struct.Struct("<4sBQQI")
+ENTRY = struct.Struct("<qQII")
+GENERATION = struct.Struct("<Q")
+
+class SharedRuleStore:
+    """Memory-mapped rule snapshot for one database, with a shared generation counter.
+
+    get() looks a rule up by binary search in the mapped entries and returns a view of its
+    tree without copying it; refresh() attaches to a newer snapshot when the counter moved.
+    """
+
+    def __init__(self, database_path):
+        self.prefix = f"{database_path}-store"
+        self._lock = threading.Lock()
+        self._publish_lock = threading.Lock()
+        self._counter_file = open(f"{self.prefix}.generation", "a+b")
+        if os.fstat(self._counter_file.fileno()).st_size < GENERATION.size:
+            self._counter_file.write(bytes(GENERATION.size))
+            self._counter_file.flush()
+        self._counter = mmap.mmap(self._counter_file.fileno(), GENERATION.size)
+        # (generation, mapping, rules-table generation, count), swapped as one tuple
+        self._snapshot = (0, None, None, 0)
+
+    def counter(self):
+        return GENERATION.unpack_from(self._counter)[0]
+
+    @property
+    def generation(self):
+        return self._snapshot[0]
+
+    @property
+    def rules_generation(self):
+        return self._snapshot[2]
+
+    def refresh(self):
+        """Attach to the latest published snapshot; returns True when it changed."""
+        generation = self.counter()
+        if generation == self._snapshot[0]:
+            return False
+        with self._lock:
+            while generation != self._snapshot[0]:
+                try:
+                    with open(f"{self.prefix}.{generation}", "rb") as file:
+                        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    # Replaced and cleaned up meanwhile; a newer generation has been published
+                    generation = self.counter()
+                    continue
+                magic, version, stored_generation, rules_generation, count = HEADER.unpack_from(mapping)
+                if magic != MAGIC or version != VERSION:
+                    raise ValueError("Not a rule store snapshot.")
+                # The previous mapping is released once no evaluation still holds a view of it
+                self._snapshot = (stored_generation, mapping, rules_generation, count)
+        return True
+
+    def _entry(self, index, mapping):
+        return ENTRY.unpack_from(mapping, HEADER.size + index * ENTRY.size)
+
+    def get(self, rule_id):
+        """Return (tree view, statistics JSON or None) for a rule, or None if the snapshot lacks it."""
+        _, mapping, _, count = self._snapshot
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            entry_id, offset, tree_length, statistics_length = self._entry(middle, mapping)
+            if entry_id < rule_id:
+                low = middle + 1
+            elif entry_id > rule_id:
+                high = middle
+            else:
+                view = memoryview(mapping)
+                statistics = str(view[offset + tree_length:offset + tree_length + statistics_length], "utf-8")
+                return view[offset:offset + tree_length], statistics or None
+        return None
+
+    def items(self):
+        """Yield (rule id, tree view, statistics JSON or None) for every rule in the snapshot."""
+        _, mapping, _, count = self._snapshot
+        if mapping is None:
+            return
+        view = memoryview(mapping)
+        for index in range(count):
+            rule_id, offset, tree_length, statistics_length = self._entry(index, mapping)
+            statistics = str(view[offset + tree_length:offset + tree_length + statistics_length], "utf-8")
+            yield rule_id, view[offset:offset + tree_length], statistics or None
+
+    def __len__(self):
+        return self._snapshot[3]
+
+    @contextmanager
+    def publishing(self):
+        # Serializes publishers across threads and processes, so snapshots are written in generation order
+        with self._publish_lock:
+            if fcntl is not None:
+                fcntl.flock(self._counter_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._counter_file.fileno(), fcntl.LOCK_UN)
+
+    def publish(self, rows, rules_generation):
+        """Write rows of (rule id, tree bytes, statistics JSON or None) as the next snapshot.
+
+        Call inside publishing(), reading the rows there too, so the newest rows are published last.
+        """
+        rows = sorted((rule_id, bytes(tree), (statistics or "").encode("utf-8")) for rule_id, tree, statistics in rows)
+        generation = self.counter() + 1
+        entries = []
+        offset = HEADER.size + len(rows) * ENTRY.size
+        for rule_id, tree, statistics in rows:
+            entries.append(ENTRY.pack(rule_id, offset, len(tree), len(statistics)))
+            offset += len(tree) + len(statistics)
+
+        path = f"{self.prefix}.{generation}"
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, generation, rules_generation, len(rows)))
+            file.writelines(entries)
+            for _, tree, statistics in rows:
+                file.write(tree)
+                file.write(statistics)
+        os.replace(f"{path}.tmp", path)
+        GENERATION.pack_into(self._counter, 0, generation)
+        self._counter.flush()
+
+        # Older snapshots stay mapped by workers that have not refreshed yet; unlinking leaves
+        # those mappings valid on POSIX, and where it fails the next publish tries again
+        for old in glob.glob(glob.escape(self.prefix) + ".*"):
+            suffix = old[len(self.prefix) + 1:]
+            if suffix.isdigit() and int(suffix) < generation:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+        return generation
+
+    def close(self):
+        with self._lock:
+            self._snapshot = (0, None, None, 0)
+        self._counter.close()
+        self._counter_file.close()
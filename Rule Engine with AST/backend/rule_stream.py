@@ -0,0 +1,48 @@
+import json
+from hashlib import blake2b
+from rule_storage import compile_stored
+from rule_batch import evaluate_batch, records_to_columns, referenced_keys
+
+# Runs inside the worker processes of the streaming endpoint. Each worker compiles a stored
+# rule once and keeps it for later chunks, keyed by a digest of the stored tree so a rule
+# that was re-ordered or replaced is compiled afresh.
+MAX_COMPILED_RULES = 64
+compiled_rules = {}
+
+TRUE_LINE = b'{"evaluation_result": true}'
+FALSE_LINE = b'{"evaluation_result": false}'
+
+def compiled_rule(stored):
+    key = blake2b(stored, digest_size=16).digest()
+    compiled = compiled_rules.get(key)
+    if compiled is None:
+        if len(compiled_rules) >= MAX_COMPILED_RULES:
+            compiled_rules.clear()
+        compiled = compiled_rules[key] = compile_stored(stored)
+    return compiled
+
+def evaluate_chunk(stored, lines):
+    """Evaluate a chunk of NDJSON record lines and return one NDJSON result line per record, in order."""
+    compiled = compiled_rule(stored)
+    records = []
+    errors = {}
+    for position, line in enumerate(lines):
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            errors[position] = f"Invalid JSON: {e}"
+            record = {}
+        if not isinstance(record, dict):
+            errors[position] = "Each record must be a JSON object."
+            record = {}
+        records.append(record)
+
+    results = evaluate_batch(compiled, records_to_columns(records, referenced_keys(compiled)), len(records))
+    output = []
+    for position, result in enumerate(results.tolist()):
+        if position in errors:
+            output.append(json.dumps({"error": errors[position]}).encode())
+        else:
+            output.append(TRUE_LINE if result else FALSE_LINE)
+    output.append(b"")
+    return b"\n".join(output)
@@ -1,6 +1,42 @@
 import pytest
+import json
+import base64
+import os
+import shutil
+import sqlite3
+import threading
+import time
 from httpx import AsyncClient, ASGITransport
-from rule_engine_api import app  # Ensure you import your FastAPI app
+import rule_engine_api
+from rule_engine_api import app, create_ast, evaluate_ast, deserialize_ast, combine_ast, print_ast, rule_cache  # Ensure you import your FastAPI app
+from database_init import migrate_db
+from rule_storage import dumps_tree, loads_tree, tree_to_postfix, compile_stored
+from rule_compiler import compile_ast, compile_optimized_ast, RuleCache
+from rule_optimizer import optimize_ast, reorder_ast
+from rule_network import RuleNetwork
+from rule_index import RuleIndex
+from rule_dag import create_node_table, store_tree, combine_nodes, load_tree
+from rule_db import ConnectionPool
+from rule_result_cache import ResultCache, fingerprint
+from rule_session import EvaluationSession
+from rule_store import SharedRuleStore
+import benchmark_rule_engine
+
+@pytest.fixture(autouse=True, scope="session")
+def temporary_database(tmp_path_factory):
+    # Run against a migrated copy of the sample database so the tracked rules.db is never modified
+    path = tmp_path_factory.mktemp("database") / "rules.db"
+    shutil.copy(os.path.join(os.path.dirname(__file__), "database", "rules.db"), path)
+    conn = sqlite3.connect(path)
+    migrate_db(conn)
+    conn.close()
+    # Opened here as the app's lifespan would; the tests' client does not run it
+    rule_engine_api.open_db_pool(str(path))
+    rule_engine_api.open_rule_store(str(path))
+    yield path
+    rule_engine_api.flush_rule_store()
+    rule_engine_api.close_rule_store()
+    rule_engine_api.close_db_pool()
 
 @pytest.mark.asyncio
 async def test_create_rule_success():
@@ -104,9 +140,760 @@ async def test_create_rule_invalid_syntax():
 @pytest.mark.asyncio
 async def test_current_rules():
     async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
-        response = await client.get("/current_rules")
+        response = await client.get("/current_rules", params={"fields": "id,name,rule_string,ast"})
         assert response.status_code == 200
         assert isinstance(response.json().get("rules"), list)
+        rule = response.json()["rules"][0]
+        assert compile_stored(base64.b64decode(rule["ast"])).evaluate({"age": 35, "department": "Sales", "salary": 60000})
+
+@pytest.mark.asyncio
+async def test_current_rules_pages_and_etag(temporary_database):
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.get("/current_rules")
+        assert set(response.json()["rules"][0]) == {"id", "name", "rule_string"}
+        etag = response.headers["etag"]
+
+        listed = []
+        after_id = 0
+        while after_id is not None:
+            page = (await client.get("/current_rules", params={"after_id": after_id, "limit": 2, "fields": "id,name"})).json()
+            assert len(page["rules"]) <= 2 and all(set(rule) == {"id", "name"} for rule in page["rules"])
+            listed += [rule["id"] for rule in page["rules"]]
+            after_id = page["next_after_id"]
+        with sqlite3.connect(temporary_database) as conn:
+            assert listed == [row[0] for row in conn.execute("SELECT id FROM rules ORDER BY id")]
+
+        response = await client.get("/current_rules", headers={"If-None-Match": etag})
+        assert response.status_code == 304 and response.headers["etag"] == etag and response.content == b""
+        assert (await client.get("/current_rules", headers={"If-None-Match": f'"0", W/{etag}'})).status_code == 304
+
+        # Re-ordering rewrites only the optimized tree, which the listing does not show
+        with sqlite3.connect(temporary_database) as conn:
+            conn.execute("UPDATE rules SET operand_stats = NULL WHERE id = 1")
+        assert (await client.get("/current_rules", headers={"If-None-Match": etag})).status_code == 304
+        response = await client.post("/create_rule", json={"rule_name": "Listing Rule", "rule_string": "age > 70"})
+        assert response.status_code == 201
+        response = await client.get("/current_rules", headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["etag"] != etag
+
+        assert (await client.get("/current_rules", params={"fields": "id,password"})).status_code == 400
+        assert (await client.get("/current_rules", params={"limit": 0})).status_code == 400
+
+def test_compiled_rule_matches_evaluate_ast():
+    rule_string = "((age > 30 AND department = 'Sales') OR (age < 25 AND department = 'Marketing')) AND (salary > 50000 OR experience > 5)"
+    ast = create_ast(rule_string)
+    compiled = compile_ast(ast)
+    records = [
+        {"age": 35, "department": "Sales", "salary": 60000, "experience": 6},
+        {"age": 22, "department": "Marketing", "salary": 40000, "experience": 2},
+        {"age": 22, "department": "Marketing", "salary": 40000, "experience": 7},
+        {"age": 35},
+        {},
+    ]
+    for data in records:
+        assert compiled.evaluate(data) == evaluate_ast(ast, data)
+
+def test_optimize_ast_flattens_and_folds():
+    rule = "(age > 30 AND department = 'Sales') AND (age > 30 AND salary > 50000)"
+    optimized = optimize_ast(create_ast(rule))
+    assert optimized["node_type"] == "operator" and optimized["value"] == "AND"
+    assert [child["value"] for child in optimized["children"]] == ["department = 'Sales'", "age > 30", "salary > 50000"]
+
+    contradiction = "(age > 30 AND age < 25) OR department = 'Sales'"
+    optimized = optimize_ast(json.loads(json.dumps(create_ast(contradiction), default=lambda x: {slot: getattr(x, slot) for slot in x.__slots__})))  # legacy nested JSON
+    assert optimized == {"node_type": "operand", "value": "department = 'Sales'"}
+
+def test_optimized_rule_matches_evaluate_ast():
+    rule_strings = [
+        "((age > 30 AND department = 'Sales') OR (age < 25 AND department = 'Marketing')) AND (salary > 50000 OR experience > 5)",
+        "age > 30 AND department = 'Sales' AND age < 25 AND department = 'Marketing'",
+        "(age > 30 OR age > 30) AND (salary >= 50000 OR department != 'HR')",
+    ]
+    records = [
+        {"age": 35, "department": "Sales", "salary": 60000, "experience": 6},
+        {"age": 22, "department": "Marketing", "salary": 40000, "experience": 7},
+        {"age": 31, "department": "HR", "salary": 50000},
+        {"age": 35},
+        {},
+    ]
+    for rule_string in rule_strings:
+        ast = create_ast(rule_string)
+        compiled = compile_optimized_ast(optimize_ast(ast))
+        for data in records:
+            assert compiled.evaluate(data) == evaluate_ast(ast, data)
+
+def test_reorder_ast_uses_observed_selectivity():
+    rule = "salary > 50000 AND age > 30 AND department = 'Sales'"
+    optimized = optimize_ast(create_ast(rule))
+    compiled = compile_optimized_ast(optimized)
+    records = [{"salary": 60000, "age": 40, "department": "Sales" if i % 20 == 0 else "HR"} for i in range(400)]
+    expected = [compiled.evaluate(data) for data in records]
+
+    statistics = compiled.statistics()
+    assert statistics["evaluations"] == 400
+    assert statistics["operands"]["department = 'Sales'"] == {"true": 20, "false": 380}
+
+    # Records mostly fail on department, so it should move ahead of the two always-true conditions
+    written_order = {"node_type": "operator", "value": "AND", "children": list(reversed(optimized["children"]))}
+    compiled = compile_optimized_ast(written_order)
+    for data in records:
+        compiled.evaluate(data)
+    reordered = reorder_ast(written_order, compiled.statistics()["operands"])
+    assert reordered["children"][0]["value"] == "department = 'Sales'"
+    assert len(reordered["children"]) == 3
+    assert [compile_optimized_ast(reordered).evaluate(data) for data in records] == expected
+
+def test_reorder_keeps_results_for_uncomparable_values():
+    # Short-circuiting skips the failing comparison in one order and reaches it in the other
+    optimized = optimize_ast(create_ast("age > 30 AND name > 5"))
+    data = {"age": 20, "name": "x"}
+    statistics = {"name > 5": {"true": 0, "false": 500}, "age > 30": {"true": 500, "false": 0}}
+    reordered = reorder_ast(optimized, statistics)
+    assert [child["value"] for child in reordered["children"]] == ["name > 5", "age > 30"]
+    assert compile_optimized_ast(optimized).evaluate(data) is False
+    assert compile_optimized_ast(reordered).evaluate(data) is False
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_reorders_in_background(temporary_database, monkeypatch):
+    monkeypatch.setattr(rule_engine_api, "REORDER_INTERVAL", 150)
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/create_rule", json={"rule_name": "Reorder Rule", "rule_string": "department = 'Sales' AND age > 30"})
+        assert response.status_code == 201
+        conn = sqlite3.connect(temporary_database)
+        rule_id, = conn.execute("SELECT id FROM rules WHERE name = 'Reorder Rule'").fetchone()
+        assert loads_tree(conn.execute("SELECT optimized_ast FROM rules WHERE id = ?", (rule_id,)).fetchone()[0])["children"][0]["value"] == "department = 'Sales'"
+
+        # Every record passes the department check and fails on age, so age should move first
+        for _ in range(150):
+            response = await client.post("/evaluate_rule", json={"rule_id": rule_id, "data": {"department": "Sales", "age": 20}})
+            assert response.json()["evaluation_result"] is False
+        rule_engine_api.reorder_queue.join()
+
+        optimized_ast, operand_stats = conn.execute("SELECT optimized_ast, operand_stats FROM rules WHERE id = ?", (rule_id,)).fetchone()
+        conn.close()
+        assert loads_tree(optimized_ast)["children"][0]["value"] == "age > 30"
+        assert json.loads(operand_stats)["evaluations"] == 150
+
+        rule_cache.clear()
+        response = await client.get(f"/rule_statistics/{rule_id}")
+        assert response.json()["evaluations"] == 150
+        assert response.json()["operands"]["age > 30"] == {"true": 0, "false": 150}
+        assert rule_engine_api.get_compiled_rule(rule_id).operands()[0].condition == "age > 30"
+
+@pytest.mark.asyncio
+async def test_rule_statistics():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        await client.post("/evaluate_rule", json={"rule_id": 1, "data": {"age": 35, "department": "Sales", "salary": 60000}})
+        response = await client.get("/rule_statistics/1")
+        assert response.status_code == 200
+        statistics = response.json()
+        assert statistics["evaluations"] >= 1
+        assert "age > 30" in statistics["operands"]
+
+        response = await client.get("/rule_statistics/9999")
+        assert response.status_code == 404
+
+def test_deep_combined_rule_without_recursion():
+    # Deeper than the default recursion limit; depth scaling is covered by benchmark_rule_depth.py
+    depth = 2000
+    asts = [create_ast(f"age > {i} AND salary < {i + 100000}") for i in range(depth)]
+    combined = combine_ast(asts)
+    data = {"age": depth + 1, "salary": 0}
+
+    stored = dumps_tree(combined)
+    restored = deserialize_ast(stored)
+    assert evaluate_ast(restored, data) is True
+    assert compile_ast(combined).evaluate(data) is True
+    assert compile_optimized_ast(loads_tree(dumps_tree(optimize_ast(combined)))).evaluate({"age": 5, "salary": 0}) is False
+    assert repr(restored).startswith("Node(type=operator, value=AND, left=Node(type=operator")
+
+    alternating = loads_tree(json.dumps([{"node_type": "operand", "value": "age > 0"}] + [
+        item for i in range(depth) for item in (
+            {"node_type": "operand", "value": f"salary = {i}"},
+            {"node_type": "operator", "value": "AND" if i % 2 else "OR"},
+        )
+    ]))
+    optimized = optimize_ast(alternating)
+    assert compile_optimized_ast(loads_tree(dumps_tree(optimized))).evaluate({"age": 1, "salary": 1}) == \
+        compile_ast(alternating).evaluate({"age": 1, "salary": 1})
+
+def test_binary_storage_round_trip():
+    rule_string = "(age >= 30 AND flag = True) OR (name = 'Bob' AND ratio < 1.5) OR big > 99999999999999999999 OR age > 30"
+    ast = create_ast(rule_string)
+    stored = dumps_tree(ast)
+    assert isinstance(stored, bytes)
+    assert len(stored) < len(json.dumps(tree_to_postfix(ast)))
+    assert dumps_tree(loads_tree(stored)) == stored
+
+    compiled = compile_stored(stored)
+    for data in [{"age": 31, "flag": True}, {"name": "Bob", "ratio": 1.2}, {"big": 10 ** 21}, {"age": 29, "flag": True}, {}]:
+        assert compiled.evaluate(data) == evaluate_ast(ast, data)
+    assert [operand.literal for operand in compiled.operands()] == [30, True, "Bob", 1.5, 99999999999999999999, 30]
+
+def test_benchmark_generator_and_comparison():
+    rng = benchmark_rule_engine.random.Random(1)
+    records = [benchmark_rule_engine.generate_record(rng, 5) for _ in range(20)]
+    for depth, operands in [(0, 1), (0, 5), (3, 12)]:
+        rule_string = benchmark_rule_engine.generate_rule(rng, depth, operands, 5)
+        rule_engine_api.is_valid_rule(rule_string)
+        assert rule_string.count("(") == rule_string.count(")") <= 2 * (operands - 1)
+        ast = create_ast(rule_string)
+        compiled = compile_stored(dumps_tree(optimize_ast(ast)))
+        for data in records:
+            assert compiled.evaluate(data) == evaluate_ast(ast, data)
+
+    baseline = {"shape": [{"depth": 1, "operands": 4, "cardinality": 10, "parse_rules_per_s": 1000, "evaluate_compiled_p50_us": 2.0}], "rules": []}
+    current = {"shape": [{"depth": 1, "operands": 4, "cardinality": 10, "parse_rules_per_s": 800, "evaluate_compiled_p50_us": 2.1}], "rules": []}
+    regressed = {metric: flag for _, _, metric, _, _, _, flag in benchmark_rule_engine.compare(current, baseline, 0.1)}
+    assert regressed == {"parse_rules_per_s": True, "evaluate_compiled_p50_us": False}
+
+def test_migrate_db_converts_json_rows(tmp_path):
+    ast = create_ast("age > 30 AND department = 'Sales'")
+    legacy = json.dumps(ast, default=lambda x: {slot: getattr(x, slot) for slot in x.__slots__})
+    conn = sqlite3.connect(tmp_path / "rules.db")
+    conn.execute("CREATE TABLE rules (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, rule_string TEXT, ast TEXT)")
+    conn.execute("INSERT INTO rules (name, rule_string, ast) VALUES ('legacy', '', ?)", (legacy,))
+    migrate_db(conn)
+    ast_type, optimized_type, optimized_ast, root_node = conn.execute(
+        "SELECT typeof(ast), typeof(optimized_ast), optimized_ast, root_node FROM rules").fetchone()
+    assert (ast_type, optimized_type) == ("null", "blob")
+    assert compile_stored(optimized_ast).evaluate({"age": 35, "department": "Sales"}) is True
+    assert dumps_tree(load_tree(conn, root_node)) == dumps_tree(ast)
+    conn.close()
+
+def test_node_store_shares_subtrees(tmp_path):
+    conn = sqlite3.connect(tmp_path / "rules.db")
+    create_node_table(conn)
+    first_ast = create_ast("(age > 30 AND department = 'Sales') OR salary > 50000")
+    second_ast = create_ast("age > 30 AND department = 'Sales'")
+    first = store_tree(conn, first_ast)
+    second = store_tree(conn, second_ast)
+    assert conn.execute("SELECT COUNT(*) FROM rule_nodes").fetchone()[0] == 5
+    assert store_tree(conn, create_ast("age > 30 AND department = 'Sales'")) == second
+
+    # Combining combined rules adds one node per join, however large the sources are
+    combined = combine_nodes(conn, "AND", [first, second])
+    combined_again = combine_nodes(conn, "AND", [combined, first, second])
+    assert conn.execute("SELECT COUNT(*) FROM rule_nodes").fetchone()[0] == 8
+    expected = combine_ast([combine_ast([first_ast, second_ast]), first_ast, second_ast])
+    assert dumps_tree(load_tree(conn, combined_again)) == dumps_tree(expected)
+    conn.close()
+
+@pytest.mark.asyncio
+async def test_combine_rules_references_stored_sources(temporary_database):
+    rule_string = "age > 40 AND salary > 1000"
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/create_rule", json={"rule_name": "Shared Source", "rule_string": rule_string})
+        assert response.status_code == 201
+        conn = sqlite3.connect(temporary_database)
+        source_rule_string, = conn.execute("SELECT rule_string FROM rules WHERE id = 1").fetchone()
+        nodes_before = conn.execute("SELECT COUNT(*) FROM rule_nodes").fetchone()[0]
+
+        response = await client.post("/combine_rules", json={"rule_name": "Shared Combined", "rule_strings": [rule_string, source_rule_string]})
+        assert response.status_code == 201
+        assert conn.execute("SELECT COUNT(*) FROM rule_nodes").fetchone()[0] == nodes_before + 1
+        rule_ids = [1] + [row[0] for row in conn.execute(
+            "SELECT id FROM rules WHERE name IN ('Shared Source', 'Shared Combined') ORDER BY id")]
+        conn.close()
+
+        data = {"age": 45, "department": "Sales", "salary": 60000}
+        response = await client.post("/evaluate_rules", json={"rule_ids": rule_ids, "data": data})
+        assert response.status_code == 200
+        expected = []
+        for rule_id in rule_ids:
+            single = await client.post("/evaluate_rule", json={"rule_id": rule_id, "data": data})
+            expected.append(single.json()["evaluation_result"])
+        assert response.json()["evaluation_results"] == expected == [True, True, True]
+
+        response = await client.post("/evaluate_rules", json={"rule_ids": [9999], "data": data})
+        assert response.status_code == 404
+
+def test_connection_pool(tmp_path):
+    pool = ConnectionPool(str(tmp_path / "pool.db"), size=2)
+    with pool.connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        conn.execute("CREATE TABLE items (value INTEGER)")
+        first = conn
+    with pool.connection() as conn:
+        assert conn is first
+
+    # A failed block is rolled back and its connection still returns to the pool
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            conn.execute("INSERT INTO items VALUES (1)")
+            raise ValueError()
+
+    def insert_rows():
+        for value in range(50):
+            with pool.connection() as conn:
+                conn.execute("INSERT INTO items VALUES (?)", (value,))
+    threads = [threading.Thread(target=insert_rows) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 300
+    assert pool.created <= 2
+    pool.close()
+    assert pool.created == 0
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_stream(monkeypatch):
+    monkeypatch.setattr(rule_engine_api, "STREAM_CHUNK_SIZE", 4)
+    records = [
+        {"age": 35 + i % 3, "department": "Sales" if i % 2 else "HR", "salary": 60000, "experience": i % 7}
+        for i in range(30)
+    ]
+    lines = [json.dumps(record) for record in records]
+    lines[7] = "not json"
+    lines[12] = "[1, 2]"
+    body = ("\n".join(lines[:20]) + "\n\n" + "\n".join(lines[20:])).encode()
+
+    async def chunks():
+        # Split the body mid-line to exercise incremental line assembly
+        for start in range(0, len(body), 37):
+            yield body[start:start + 37]
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/evaluate_rule_stream", params={"rule_id": 1}, content=chunks())
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        results = [json.loads(line) for line in response.text.splitlines()]
+        assert len(results) == len(records)
+        assert "error" in results[7] and "error" in results[12]
+        for position, record in enumerate(records):
+            if position not in (7, 12):
+                single = await client.post("/evaluate_rule", json={"rule_id": 1, "data": record})
+                assert results[position] == single.json()
+
+        response = await client.post("/evaluate_rule_stream", params={"rule_id": 9999}, content=b"{}\n")
+        assert response.status_code == 404
+
+def test_print_ast(capsys):
+    print_ast(create_ast("age > 30 AND department = 'Sales'"))
+    assert capsys.readouterr().out.splitlines() == [
+        "Node(type=operator, value=AND, left=Node(type=operand, value=age > 30, left=None, right=None), "
+        "right=Node(type=operand, value=department = 'Sales', left=None, right=None))",
+        "  Node(type=operand, value=age > 30, left=None, right=None)",
+        "  Node(type=operand, value=department = 'Sales', left=None, right=None)",
+    ]
+
+def test_rule_cache_lru_eviction():
+    cache = RuleCache(maxsize=2)
+    cache.put(1, "a")
+    cache.put(2, "b")
+    assert cache.get(1) == "a"
+    cache.put(3, "c")
+    assert 2 not in cache
+    assert 1 in cache and 3 in cache
+    cache.invalidate(1)
+    assert cache.get(1) is None
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_uses_compiled_cache():
+    rule_cache.clear()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        for _ in range(2):
+            response = await client.post("/evaluate_rule", json={
+                "rule_id": 1,
+                "data": {"age": 35, "department": "Sales", "salary": 60000, "experience": 6}
+            })
+            assert response.status_code == 200
+            assert response.json().get("evaluation_result") is True
+    assert 1 in rule_cache
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(monkeypatch):
+    metrics = rule_engine_api.metrics
+    metrics.reset()
+    rule_cache.clear()
+    monkeypatch.setattr(metrics, "node_timing", True)
+    record = {"age": 35, "department": "Sales", "salary": 60000, "experience": 6}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        for _ in range(3):
+            response = await client.post("/evaluate_rule", json={"rule_id": 1, "data": record})
+            assert response.status_code == 200
+        response = await client.post("/create_rule", json={"rule_name": "Metrics Rule", "rule_string": "age > 30 AND salary > 1000"})
+        assert response.status_code == 201
+        response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+
+    assert "# TYPE rule_engine_request_phase_seconds histogram" in lines
+    for endpoint, phase, count in [("evaluate_rule", "store_fetch", 1), ("evaluate_rule", "deserialize", 1),
+                                   ("evaluate_rule", "cache_lookup", 2), ("evaluate_rule", "evaluate", 3),
+                                   ("evaluate_rule", "total", 3), ("create_rule", "parse", 1), ("create_rule", "total", 1)]:
+        labels = f'endpoint="{endpoint}",phase="{phase}"'
+        assert f"rule_engine_request_phase_seconds_count{{{labels}}} {count}" in lines
+        assert f'rule_engine_request_phase_seconds_bucket{{{labels},le="+Inf"}} {count}' in lines
+    assert 'rule_engine_rule_evaluations_total{rule_id="1"} 3' in lines
+    assert any(line.startswith('rule_engine_node_hits_total{rule_id="1",node="0",condition=') for line in lines)
+    assert any(line.startswith('rule_engine_node_seconds_total{rule_id="1"') for line in lines)
+
+    # Disabled, requests record nothing
+    monkeypatch.setattr(metrics, "enabled", False)
+    metrics.reset()
+    assert rule_engine_api.evaluate_rule(rule_engine_api.EvaluationRequest(rule_id=1, data=record)) == {"evaluation_result": True}
+    assert metrics.histograms == {} and metrics.rule_evaluations == {}
+
+def test_result_cache_bounds_and_versions():
+    now = [0.0]
+    cache = ResultCache(maxsize=2, ttl=10, clock=lambda: now[0])
+    compiled = compile_ast(create_ast("age > 30 AND department = 'Sales'"))
+    assert compiled.keys == ("age", "department")
+    assert fingerprint({"age": 31, "department": "Sales", "name": "A"}, compiled.keys) == fingerprint({"department": "Sales", "age": 31.0}, compiled.keys)
+    assert fingerprint({"age": None}, compiled.keys) == fingerprint({}, compiled.keys)
+    assert fingerprint({"age": [1, {"b": 2, "a": 1}]}, compiled.keys) == fingerprint({"age": [1, {"a": 1, "b": 2}]}, compiled.keys)
+
+    first = cache.key(1, compiled, {"age": 31, "department": "Sales"})
+    cache.put(first, True)
+    assert cache.get(cache.key(1, compiled, {"age": 31, "department": "Sales", "unrelated": 1})) is True
+    cache.invalidate_rule(1)
+    assert cache.get(cache.key(1, compiled, {"age": 31, "department": "Sales"})) is None
+    cache.put(first, True)  # A result computed before the invalidation is not stored
+    assert len(cache) == 1
+
+    for age in (40, 41, 42):
+        cache.put(cache.key(2, compiled, {"age": age}), False)
+    assert len(cache) == 2 and cache.evictions == 2
+    now[0] = 11
+    assert cache.get(cache.key(2, compiled, {"age": 42})) is None
+    assert cache.expirations == 1
+    assert (cache.hits, cache.misses) == (1, 2)
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_result_cache(monkeypatch):
+    monkeypatch.setattr(rule_engine_api, "RESULT_CACHE_ENABLED", True)
+    monkeypatch.setattr(rule_engine_api, "result_cache", ResultCache())
+    cache = rule_engine_api.result_cache
+    record = {"age": 35, "department": "Sales", "salary": 60000, "experience": 6}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        for extra in ({}, {"request_id": "a"}, {"request_id": "b"}):
+            response = await client.post("/evaluate_rule", json={"rule_id": 1, "data": {**record, **extra}})
+            assert response.json() == {"evaluation_result": True}
+        assert (cache.hits, cache.misses) == (2, 1)
+
+        rule_engine_api.invalidate_rule(1)
+        response = await client.post("/evaluate_rule", json={"rule_id": 1, "data": {**record, "age": 20}})
+        assert response.json() == {"evaluation_result": False}
+        response = await client.post("/evaluate_rule", json={"rule_id": 1, "data": record})
+        assert response.json() == {"evaluation_result": True}
+        assert (cache.hits, cache.misses) == (2, 3)
+
+def test_evaluation_session_matches_full_evaluation():
+    rng = benchmark_rule_engine.random.Random(7)
+    rules = [(rule_id, compile_optimized_ast(optimize_ast(create_ast(benchmark_rule_engine.generate_rule(rng, 3, 10, 4)))))
+             for rule_id in range(40)]
+    data = benchmark_rule_engine.generate_record(rng, 4)
+    session = EvaluationSession(rules, data)
+    assert session.results() == {rule_id: compiled.evaluate(data) for rule_id, compiled in rules}
+
+    for _ in range(300):
+        key = rng.choice(["num0", "num3", "num5", "cat1", "cat2", "unused"])
+        value = None if rng.random() < 0.1 else (f"v{rng.randrange(4)}" if key.startswith("cat") else rng.randrange(100))
+        before = {rule_id: compiled.evaluate(data) for rule_id, compiled in rules}
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+        after = {rule_id: compiled.evaluate(data) for rule_id, compiled in rules}
+        assert session.update({key: value}) == {rule_id: result for rule_id, result in after.items() if result != before[rule_id]}
+    assert session.update({"unused": 1}) == {}
+
+@pytest.mark.asyncio
+async def test_evaluation_session_endpoints():
+    record = {"age": 35, "department": "Sales", "salary": 60000, "experience": 6}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/sessions", json={"rule_ids": [1, 2], "data": record})
+        assert response.status_code == 201
+        session_id = response.json()["session_id"]
+        expected = [rule_engine_api.get_compiled_rule(rule_id).evaluate(record) for rule_id in (1, 2)]
+        assert response.json()["evaluation_results"] == expected
+
+        response = await client.post(f"/sessions/{session_id}/delta", json={"delta": {"age": 20}})
+        assert response.status_code == 200
+        flipped = response.json()["flipped"]
+        changed = {**record, "age": 20}
+        assert flipped == [{"rule_id": rule_id, "evaluation_result": not result}
+                           for rule_id, result in zip((1, 2), expected)
+                           if rule_engine_api.get_compiled_rule(rule_id).evaluate(changed) != result]
+        assert {"rule_id": 1, "evaluation_result": False} in flipped
+
+        response = await client.post(f"/sessions/{session_id}/delta", json={"delta": {"nickname": "x"}})
+        assert response.json() == {"flipped": []}
+
+        response = await client.post("/sessions", json={"rule_ids": [9999], "data": record})
+        assert response.status_code == 404
+        assert (await client.delete(f"/sessions/{session_id}")).status_code == 200
+        response = await client.post(f"/sessions/{session_id}/delta", json={"delta": {"age": 40}})
+        assert response.status_code == 404
+        assert response.json()["detail"] == "Session not found"
+
+def test_shared_rule_store(tmp_path):
+    path = str(tmp_path / "rules.db")
+    writer, reader = SharedRuleStore(path), SharedRuleStore(path)
+    assert not reader.refresh() and reader.get(1) is None and list(reader.items()) == []
+
+    trees = {rule_id: dumps_tree(optimize_ast(create_ast(f"age > {rule_id} AND department = 'Sales'"))) for rule_id in (5, 1, 3)}
+    with writer.publishing():
+        writer.publish([(rule_id, tree, None) for rule_id, tree in trees.items()], 7)
+    assert reader.refresh() and not reader.refresh()
+    assert (reader.generation, reader.rules_generation, len(reader)) == (1, 7, 3)
+    tree, statistics = reader.get(3)
+    assert isinstance(tree, memoryview) and bytes(tree) == trees[3] and statistics is None
+    assert compile_stored(tree).evaluate({"age": 4, "department": "Sales"})
+    assert reader.get(2) is None and reader.get(6) is None
+    assert [rule_id for rule_id, _, _ in reader.items()] == [1, 3, 5]
+
+    with writer.publishing():
+        writer.publish([(2, trees[1], '{"evaluations": 4}')], 8)
+    assert reader.refresh()
+    assert reader.get(2)[1] == '{"evaluations": 4}' and reader.get(3) is None
+    # The first snapshot is still mapped by nothing but its views, and was removed from disk
+    assert bytes(tree) == trees[3]
+    assert sorted(os.listdir(tmp_path)) == ["rules.db-store.2", "rules.db-store.generation"]
+    writer.close()
+    reader.close()
+
+@pytest.mark.asyncio
+async def test_rules_published_by_another_worker(temporary_database):
+    # Another worker process adds a rule straight to the database and publishes a new snapshot
+    with sqlite3.connect(temporary_database) as conn:
+        ast = create_ast("age > 90 AND department = 'Board'")
+        rule_id = conn.execute("INSERT INTO rules (name, rule_string, root_node, optimized_ast) VALUES (?, ?, ?, ?)",
+                               ("Other Worker Rule", "age > 90 AND department = 'Board'", store_tree(conn, ast),
+                                dumps_tree(optimize_ast(ast)))).lastrowid
+    other = SharedRuleStore(str(temporary_database))
+    with other.publishing():
+        with sqlite3.connect(temporary_database) as conn:
+            rows = conn.execute("SELECT id, optimized_ast, operand_stats FROM rules").fetchall()
+        other.publish(rows, 0)
+    other.close()
+
+    record = {"age": 95, "department": "Board"}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/match_rules", json={"data": record})
+        assert rule_id in response.json()["matching_rule_ids"]
+        response = await client.post("/evaluate_rule", json={"rule_id": rule_id, "data": record})
+        assert response.json() == {"evaluation_result": True}
+    assert rule_engine_api.get_rule_store().get(rule_id) is not None
+
+@pytest.mark.asyncio
+async def test_rule_writes_coalesce_store_publishes(monkeypatch, temporary_database):
+    # Every publish rewrites the whole snapshot; a burst of creates must share them, not publish per rule
+    publishes = []
+    publish = SharedRuleStore.publish
+
+    def counting_publish(self, rows, generation):
+        publishes.append(time.perf_counter())
+        return publish(self, rows, generation)
+
+    monkeypatch.setattr(SharedRuleStore, "publish", counting_publish)
+    creates = 200
+    start = time.perf_counter()
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        for i in range(creates):
+            response = await client.post("/create_rule", json={"rule_name": f"Bulk Rule {i}",
+                                                               "rule_string": f"age > {i} AND salary < {i * 1000}"})
+            assert response.status_code == 201
+    elapsed = time.perf_counter() - start
+    # At most one publish per interval, plus one already waiting when the burst began
+    assert len(publishes) <= elapsed / rule_engine_api.STORE_PUBLISH_INTERVAL + 1
+
+    rule_engine_api.flush_rule_store()
+    with sqlite3.connect(temporary_database) as conn:
+        rule_ids = [row[0] for row in conn.execute("SELECT id FROM rules WHERE name LIKE 'Bulk Rule %'")]
+    store = rule_engine_api.get_rule_store()
+    store.refresh()
+    assert len(rule_ids) == creates
+    assert all(store.get(rule_id) is not None for rule_id in rule_ids)
+
+@pytest.mark.asyncio
+async def test_failed_store_publish_is_reported_and_retried(monkeypatch, caplog):
+    calls = []
+
+    def flaky_publish(only_if_stale=False):
+        calls.append(time.perf_counter())
+        if len(calls) == 1:
+            raise OSError("disk full")
+
+    monkeypatch.setattr(rule_engine_api, "publish_rule_store", flaky_publish)
+    monkeypatch.setattr(rule_engine_api, "STORE_PUBLISH_INTERVAL", 0.01)
+    failures = rule_engine_api.store_publish_failures
+    rule_engine_api.schedule_publish()
+    deadline = time.perf_counter() + 5
+    while len(calls) < 2 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+
+    assert len(calls) == 2  # Retried without another write
+    assert rule_engine_api.store_publish_failures == failures + 1
+    assert "Publishing the shared rule store failed" in caplog.text
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.get("/metrics")
+    assert f"rule_engine_store_publish_failures_total {failures + 1}" in response.text
+
+@pytest.mark.asyncio
+async def test_new_rules_match_before_the_snapshot_is_published(monkeypatch):
+    # The background publisher has not run, and this worker builds its matchers only after the write
+    monkeypatch.setattr(rule_engine_api, "schedule_publish", lambda: None)
+    monkeypatch.setattr(rule_engine_api, "rule_network", None)
+    monkeypatch.setattr(rule_engine_api, "rule_index", None)
+    record = {"clearance": "Unpublished"}
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/create_rule", json={"rule_name": "Unpublished Rule",
+                                                           "rule_string": "clearance = 'Unpublished'"})
+        assert response.status_code == 201
+        response = await client.post("/match_rules", json={"data": record})
+        rule_ids = response.json()["matching_rule_ids"]
+        assert len(rule_ids) == 1
+        assert rule_engine_api.get_rule_store().get(rule_ids[0]) is None
+
+        # A rule another worker wrote is missing from this network until published, but explicit ids still evaluate
+        monkeypatch.setattr(rule_engine_api, "rule_network", None)
+        monkeypatch.setattr(rule_engine_api, "rule_index", None)
+        rule_engine_api.unmatched_written_rules.clear()
+        response = await client.post("/evaluate_rules", json={"rule_ids": rule_ids, "data": record})
+        assert response.json()["evaluation_results"] == [True]
+        response = await client.post("/match_rules", json={"data": record})
+        assert response.json()["matching_rule_ids"] == rule_ids
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_batch_matches_single_evaluation():
+    records = [
+        {"age": 35, "department": "Sales", "salary": 60000, "experience": 6},
+        {"age": 22, "department": "Marketing", "salary": 40000, "experience": 7},
+        {"age": 22, "department": "Marketing", "salary": 40000, "experience": 2},
+        {"age": 35},
+        {"age": 40.5, "department": "Sales", "experience": None, "salary": 70000},
+    ]
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/evaluate_rule_batch", json={"rule_id": 1, "records": records})
+        assert response.status_code == 200
+        expected = []
+        for data in records:
+            single = await client.post("/evaluate_rule", json={"rule_id": 1, "data": data})
+            expected.append(single.json()["evaluation_result"])
+        assert response.json()["evaluation_results"] == expected
+
+@pytest.mark.asyncio
+async def test_evaluate_rule_batch_columns():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/evaluate_rule_batch", json={"rule_id": 1, "columns": {
+            "age": [35, 22, 50],
+            "department": ["Sales", "Marketing", "Sales"],
+            "salary": [60000, 10000, 10000],
+            "experience": [1, 1, None],
+        }})
+        assert response.status_code == 200
+        assert response.json()["evaluation_results"] == [True, False, False]
+
+        response = await client.post("/evaluate_rule_batch", json={"rule_id": 1, "columns": {"age": [1, 2], "salary": [1]}})
+        assert response.status_code == 400
+        assert response.json().get("detail") == "All columns must have the same length."
+
+        response = await client.post("/evaluate_rule_batch", json={"rule_id": 1, "columns": {"age": 5}})
+        assert response.status_code == 400
+        assert response.json().get("detail") == "Every column must be a list of values."
+
+@pytest.mark.asyncio
+async def test_uncomparable_values_evaluate_as_false_on_every_path():
+    record = {"age": "unknown", "department": "Sales", "salary": 60000}
+    assert evaluate_ast(create_ast("age > 30 AND department = 'Sales'"), record) is False
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/evaluate_rule", json={"rule_id": 1, "data": record})
+        assert response.status_code == 200
+        assert response.json()["evaluation_result"] is False
+
+        response = await client.post("/evaluate_rule_batch", json={
+            "rule_id": 1, "records": [record, {"age": 35, "department": "Sales", "salary": 60000}]
+        })
+        assert response.status_code == 200
+        assert response.json()["evaluation_results"] == [False, True]
+
+        response = await client.post("/match_rules", json={"data": record})
+        assert response.status_code == 200
+        assert 1 not in response.json()["matching_rule_ids"]
+
+def test_rule_network_shares_predicates():
+    rule_strings = [
+        "age > 30 AND department = 'Sales'",
+        "department = 'Sales' AND age > 30",
+        "(age > 30 AND department = 'Sales') OR salary > 50000",
+        "age < 25 OR experience > 5",
+    ]
+    network = RuleNetwork()
+    compiled_rules = {}
+    for rule_id, rule_string in enumerate(rule_strings, start=1):
+        compiled_rules[rule_id] = compile_ast(create_ast(rule_string))
+        network.add_rule(rule_id, compiled_rules[rule_id])
+
+    assert network.stats() == {"rules": 4, "predicates": 5, "joins": 3}
+    for data in [{"age": 35, "department": "Sales"}, {"age": 20, "salary": 60000}, {"experience": 6}, {}]:
+        expected = [rule_id for rule_id, compiled in compiled_rules.items() if compiled.evaluate(data)]
+        assert network.match(data) == expected
+
+def test_rule_index_prunes_without_losing_matches():
+    rule_strings = [
+        "salary > 50000",
+        "age < 25 AND department = 'Marketing'",
+        "(age > 30 AND department = 'Sales') OR (age < 25 AND department = 'Marketing')",
+        "age >= 30 AND age <= 40",
+        "age > 30 AND age < 25",
+        "experience != 3 OR salary > 10",
+    ]
+    index = RuleIndex()
+    compiled_rules = {}
+    for rule_id, rule_string in enumerate(rule_strings, start=1):
+        compiled_rules[rule_id] = compile_ast(create_ast(rule_string))
+        index.add_rule(rule_id, compiled_rules[rule_id])
+
+    records = [
+        {"age": 35, "department": "Sales", "salary": 60000},
+        {"age": 20, "department": "Marketing", "salary": 20000},
+        {"age": 30, "department": "HR", "experience": 3},
+        {"age": 40, "salary": 50000},
+        {"age": "unknown", "department": "Sales"},
+        {},
+    ]
+    network = RuleNetwork()
+    for rule_id, compiled in compiled_rules.items():
+        network.add_rule(rule_id, compiled)
+    for data in records:
+        candidates = index.candidates(data)
+        assert set(network.match(data)) <= candidates
+        assert network.match(data, candidates) == network.match(data)
+
+    assert index.candidates({"age": 30, "department": "HR", "experience": 3}) == {4, 6}
+    assert 5 not in index.candidates({"age": 28})
+
+def test_rule_index_add_rule_is_idempotent():
+    index = RuleIndex()
+    network = RuleNetwork()
+    compiled = compile_ast(create_ast("age > 30 AND department = 'Sales'"))
+    for _ in range(2):
+        index.add_rule(1, compiled)
+        network.add_rule(1, compiled)
+    assert index.candidates({"age": 35, "department": "Sales"}) == {1}
+    assert network.stats()["rules"] == 1
+
+    # A contradiction folds to an empty program that no record can match
+    index.add_rule(2, compile_optimized_ast(optimize_ast(create_ast("age > 30 AND age < 25"))))
+    assert 2 in index
+    assert 2 not in index.candidates({})
+
+@pytest.mark.asyncio
+async def test_match_rules():
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://127.0.0.1:8000") as client:
+        response = await client.post("/match_rules", json={
+            "data": {"age": 35, "department": "Sales", "salary": 60000, "experience": 6}
+        })
+        assert response.status_code == 200
+        matching = response.json()["matching_rule_ids"]
+        assert 1 in matching
+        assert 2 not in matching
 
 if __name__ == "__main__":
     pytest.main()
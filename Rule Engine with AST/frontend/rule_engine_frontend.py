@@ -1,4 +1,6 @@
 from flask import Flask, render_template, request, redirect, url_for, flash
+from requests.adapters import HTTPAdapter
+import threading
 import requests
 
 app = Flask(__name__)
@@ -7,10 +9,34 @@ app.secret_key = "^>+W7MzlIk'0cq`"
 # API base URL
 API_URL = "http://127.0.0.1:8000"
 
+# One pooled session for every API call, so requests reuse kept-alive connections
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=16))
+
+# Last listing page received per after_id with its ETag; the API answers 304 while the rules are unchanged
+MAX_CACHED_PAGES = 1000
+listing_cache = {}
+listing_cache_lock = threading.Lock()
+
+def fetch_rules(after_id):
+    with listing_cache_lock:
+        cached = listing_cache.get(after_id)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    response = session.get(f"{API_URL}/current_rules", params={"after_id": after_id}, headers=headers)
+    if response.status_code == 304 and cached:
+        return cached[1]
+    page = response.json()
+    if "ETag" in response.headers:
+        with listing_cache_lock:
+            if len(listing_cache) >= MAX_CACHED_PAGES:
+                listing_cache.clear()
+            listing_cache[after_id] = (response.headers["ETag"], page)
+    return page
+
 @app.route('/')
 def index():
-    rules = requests.get(f"{API_URL}/current_rules").json().get("rules", [])
-    return render_template('index.html', rules=rules)
+    page = fetch_rules(request.args.get('after_id', 0, type=int))
+    return render_template('index.html', rules=page.get("rules", []), next_after_id=page.get("next_after_id"))
 
 @app.route('/create_rule', methods=['POST'])
 def create_rule():
@@ -21,7 +47,7 @@ def create_rule():
         flash("Please provide a rule name and rule string")
         return redirect(url_for('index'))
     
-    response = requests.post(f"{API_URL}/create_rule", json={"rule_name": rule_name, "rule_string": rule_string})
+    response = session.post(f"{API_URL}/create_rule", json={"rule_name": rule_name, "rule_string": rule_string})
     
     if response.status_code == 201:
         flash("Rule created successfully!")
@@ -45,7 +71,7 @@ def evaluate_rule():
         flash("Invalid data format")
         return redirect(url_for('index'))
     
-    response = requests.post(f"{API_URL}/evaluate_rule", json={"rule_id": int(rule_id), "data": data_dict})
+    response = session.post(f"{API_URL}/evaluate_rule", json={"rule_id": int(rule_id), "data": data_dict})
     
     if response.status_code == 200:
         result = response.json().get('evaluation_result')
@@ -64,7 +90,7 @@ def combine_rules():
         flash("Please provide a name for the combined rule and select at least one rule")
         return redirect(url_for('index'))
     
-    response = requests.post(f"{API_URL}/combine_rules", json={"rule_name": combined_rule_name, "rule_strings": selected_rules})
+    response = session.post(f"{API_URL}/combine_rules", json={"rule_name": combined_rule_name, "rule_strings": selected_rules})
     
     if response.status_code == 201:
         flash("Rules combined successfully!")